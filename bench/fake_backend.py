@@ -0,0 +1,84 @@
+"""
+基準測試用的確定性假推論後端。
+
+回覆內容依模型決定：architect 依序取出情境預先寫好的規劃 (可故意毀損)，
+coder / chatter 回固定內容。延遲以「首 token 延遲 + token 數 / 每秒 token 數」模擬，
+token 數以字元數粗估，同一份輸入每次的耗時都相同。
+"""
+
+import time
+
+from llm_runtime.backends import LLMBackend
+
+CODER_REPLY = (
+    "```python\n"
+    "def main():\n"
+    "    values = [i * i for i in range(10)]\n"
+    "    print(sum(values))\n"
+    "\n"
+    "\n"
+    "if __name__ == \"__main__\":\n"
+    "    main()\n"
+    "```\n"
+)
+ANALYSIS_REPLY = "這段程式以迴圈累加平方值，邏輯正確；建議把常數抽成參數並補上型別註記。"
+CHATTER_REPLY = "你好！有什麼我可以幫忙的嗎？"
+ARCHITECT_DONE = '{"content": "完成"}'
+
+
+def estimate_tokens(text):
+    # Qwen 的 tokenizer 大約每 3 個字元一個 token (中英混合)
+    return max(1, len(text) // 3)
+
+
+class FakeBackend(LLMBackend):
+    name = "fake"
+
+    def __init__(self, architect_replies=None, first_token_ms=20.0, tokens_per_sec=400.0,
+                 prefill_tokens_per_sec=4000.0, chunk_tokens=8):
+        """
+        :param architect_replies: architect 依序回覆的原始文字，用完後回 ARCHITECT_DONE
+        :param prefill_tokens_per_sec: 0 表示不模擬 prompt 處理時間
+        """
+        self.architect_replies = list(architect_replies or [])
+        self.first_token_ms = first_token_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.prefill_tokens_per_sec = prefill_tokens_per_sec
+        self.chunk_tokens = chunk_tokens
+        self.calls = []
+
+    def reply_for(self, model_key, prompt):
+        if model_key == "architect":
+            return self.architect_replies.pop(0) if self.architect_replies else ARCHITECT_DONE
+        if model_key == "coder":
+            return ANALYSIS_REPLY if "分析" in prompt else CODER_REPLY
+        return CHATTER_REPLY
+
+    def _prefill_delay(self, prompt, system_prompt):
+        delay = self.first_token_ms / 1000.0
+        if self.prefill_tokens_per_sec:
+            delay += estimate_tokens((system_prompt or "") + prompt) / self.prefill_tokens_per_sec
+        return delay
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        text = self.reply_for(model_key, prompt)
+        self.calls.append(model_key)
+        self._sleep(self._prefill_delay(prompt, system_prompt))
+        if self.tokens_per_sec:
+            self._sleep(min(estimate_tokens(text), n_tokens) / self.tokens_per_sec)
+        return text
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        text = self.reply_for(model_key, prompt)
+        self.calls.append(model_key)
+        self._sleep(self._prefill_delay(prompt, system_prompt))
+        step = self.chunk_tokens * 3
+        for i in range(0, len(text), step):
+            piece = text[i:i + step]
+            if self.tokens_per_sec:
+                self._sleep(estimate_tokens(piece) / self.tokens_per_sec)
+            yield piece
@@ -0,0 +1,116 @@
+"""
+冷啟動 (import) 時間基準。
+
+每則訊息都是新的 python 行程，所以量的是「全新行程 import 到可以開始處理」的時間：
+分別以 PI_AI_EAGER_TOOLS=1 (啟動時 import 全部工具模組) 與 manifest 延遲載入各跑數次，取中位數。
+
+    python3 bench/import_bench.py
+    python3 bench/import_bench.py --target llm_call_tools --repeat 20 --out import.json
+    python3 bench/import_bench.py --importtime     # 另列出延遲載入模式下最慢的 import
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BIN_DIR = os.path.join(os.path.dirname(BENCH_DIR), "bin")
+
+
+def _child_code(target):
+    # 只量 import 本身，不含直譯器啟動
+    return ("import sys, time; t0 = time.perf_counter(); "
+            f"sys.path.insert(0, {BIN_DIR!r}); import {target}; "
+            "print(time.perf_counter() - t0)")
+
+
+def run_child(target, workdir, eager, extra_args=()):
+    env = dict(os.environ)
+    env.pop("PI_AI_EAGER_TOOLS", None)
+    if eager:
+        env["PI_AI_EAGER_TOOLS"] = "1"
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, *extra_args, "-c", _child_code(target)], cwd=workdir, env=env,
+                          capture_output=True, text=True, timeout=120)
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip()[-500:])
+    import_s = float(proc.stdout.strip().splitlines()[-1])
+    return wall * 1000, import_s * 1000, proc.stderr
+
+
+def measure(target, workdir, eager, repeat):
+    walls, imports = [], []
+    for _ in range(repeat):
+        wall, imp, _ = run_child(target, workdir, eager)
+        walls.append(wall)
+        imports.append(imp)
+    return {"wall_ms": round(statistics.median(walls), 3), "import_ms": round(statistics.median(imports), 3),
+            "import_min_ms": round(min(imports), 3), "import_max_ms": round(max(imports), 3)}
+
+
+def slowest_imports(target, workdir, top):
+    """-X importtime 的累計時間前幾名 (延遲載入模式)"""
+    _, _, stderr = run_child(target, workdir, eager=False, extra_args=("-X", "importtime"))
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time:       123 |        456 |   module"
+        try:
+            self_part, cumulative_part, name = line[len("import time:"):].split("|", 2)
+            self_us, cumulative_us = int(self_part), int(cumulative_part)
+        except ValueError:
+            continue
+        rows.append({"module": name.strip(), "self_us": self_us, "cumulative_us": cumulative_us})
+    rows.sort(key=lambda r: r["cumulative_us"], reverse=True)
+    return rows[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="冷啟動 import 時間基準")
+    parser.add_argument("--target", default="chatcall", help="要 import 的模組 (預設 chatcall)")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--importtime", action="store_true", help="列出延遲載入模式下累計最慢的 import")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--out", help="結果 JSON 輸出路徑 (預設 stdout)")
+    args = parser.parse_args(argv)
+
+    # 在暫存目錄執行：manifest 與其他快取都寫在 CWD 下，不影響實際使用的目錄
+    workdir = tempfile.mkdtemp(prefix="pi_ai_import_bench_")
+    try:
+        eager = measure(args.target, workdir, True, args.repeat)
+        # 第一次延遲載入模式的啟動要建立 manifest
+        _, first_ms, _ = run_child(args.target, workdir, eager=False)
+        lazy = measure(args.target, workdir, False, args.repeat)
+        result = {
+            "target": args.target,
+            "python": sys.version.split()[0],
+            "repeat": args.repeat,
+            "eager": eager,
+            "lazy_manifest_build_ms": round(first_ms, 3),
+            "lazy": lazy,
+            "saved_import_ms": round(eager["import_ms"] - lazy["import_ms"], 3),
+        }
+        if args.importtime:
+            result["slowest_imports"] = slowest_imports(args.target, workdir, args.top)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
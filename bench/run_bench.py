@@ -0,0 +1,254 @@
+"""
+relay 流程的離線基準測試。
+
+以確定性的假後端 (bench/fake_backend.py) 跑完整的 PiAiRelaySystem.run_relay，
+對 bench/scenarios.py 的固定情境量測各階段耗時與峰值 RSS，輸出 JSON 方便在不同 commit 之間比較。
+
+    python3 bench/run_bench.py                              # 結果輸出到 stdout
+    python3 bench/run_bench.py --out bench_result.json
+    python3 bench/run_bench.py --compare base.json --fail-over 10
+    python3 bench/run_bench.py --scenario malformed_truncated --repeat 20
+
+階段 (毫秒，取各次執行的中位數)：
+    total        一次 run_relay 的總時間
+    router       快速意圖路由
+    llm          所有模型呼叫 (另有 llm.<model> 分項)
+    repair_json  規劃 JSON 修復/解析
+    tools        execute_tool (含工具內部的模型呼叫)
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "bin"))
+sys.path.insert(0, BENCH_DIR)
+
+import chatcall  # noqa: E402
+from fake_backend import FakeBackend  # noqa: E402
+from scenarios import SCENARIOS, FIXTURES  # noqa: E402
+
+
+class StageTimer:
+    def __init__(self):
+        self.ms = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.ms[stage] += (time.perf_counter() - t0) * 1000
+            self.calls[stage] += 1
+
+
+class BenchRelay(chatcall.PiAiRelaySystem):
+    """在模型呼叫與 JSON 修復外面加上計時"""
+
+    def __init__(self, backend, timer, use_router=True):
+        super().__init__(backend=backend)
+        self.timer = timer
+        self.response_cache = None  # 量的是實際生成，不讓快取命中影響結果
+        if not use_router:
+            self.router = None
+        elif self.router is not None:
+            route = self.router.route
+
+            def timed_route(*args, **kwargs):
+                with timer.measure("router"):
+                    return route(*args, **kwargs)
+            self.router.route = timed_route
+
+    def call_llm(self, model_key, prompt, *args, **kwargs):
+        with self.timer.measure("llm"), self.timer.measure(f"llm.{model_key}"):
+            return super().call_llm(model_key, prompt, *args, **kwargs)
+
+    def repair_json(self, raw_text):
+        with self.timer.measure("repair_json"):
+            return super().repair_json(raw_text)
+
+
+def write_fixtures(root, fixtures):
+    for rel, content in fixtures.items():
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+def peak_rss_kb():
+    # Linux 的 ru_maxrss 單位是 KB，macOS 是 bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_isolated(scenario, args):
+    """
+    每個情境在 fork 出的子行程執行：ru_maxrss 是整個行程的高水位，同一個行程裡最重的情境之後
+    每個情境都會回報相同的數字。子行程從相同的基準 (已 import 的模組) 開始，peak_rss_kb 只反映該情境。
+    """
+    if args.in_process or "fork" not in multiprocessing.get_all_start_methods():
+        return run_scenario(scenario, args)
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        return pool.apply(run_scenario, (scenario, args))
+
+
+def run_once(scenario, args):
+    timer = StageTimer()
+    workdir = tempfile.mkdtemp(prefix="pi_ai_bench_")
+    cwd = os.getcwd()
+    execute_tool = chatcall.execute_tool
+
+    def timed_execute_tool(name, params, sys_inst):
+        with timer.measure("tools"), timer.measure(f"tools.{name}"):
+            return execute_tool(name, params, sys_inst)
+
+    backend = FakeBackend(scenario.get("architect"), args.first_token_ms, args.tps, args.prefill_tps)
+    try:
+        os.chdir(workdir)
+        write_fixtures(workdir, FIXTURES)
+        write_fixtures(workdir, scenario.get("fixtures", {}))
+        chatcall.execute_tool = timed_execute_tool
+        relay = BenchRelay(backend, timer, use_router=not args.no_router)
+        sink = io.StringIO()
+        with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+            with timer.measure("total"):
+                relay.run_relay(scenario["input"])
+    finally:
+        chatcall.execute_tool = execute_tool
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return timer, backend.calls
+
+
+def run_scenario(scenario, args):
+    for _ in range(args.warmup):
+        run_once(scenario, args)
+    samples = defaultdict(list)
+    calls = defaultdict(list)
+    llm_calls = []
+    for _ in range(args.repeat):
+        timer, backend_calls = run_once(scenario, args)
+        stages = set(timer.ms) | {"total", "router", "llm", "repair_json", "tools"}
+        for stage in stages:
+            samples[stage].append(timer.ms.get(stage, 0.0))
+            calls[stage].append(timer.calls.get(stage, 0))
+        llm_calls.append(backend_calls)
+    total = samples["total"]
+    return {
+        "runs": args.repeat,
+        "total_ms": {"median": round(statistics.median(total), 3), "min": round(min(total), 3),
+                     "max": round(max(total), 3)},
+        "stages_ms": {s: round(statistics.median(v), 3) for s, v in sorted(samples.items())},
+        "stage_calls": {s: max(v) for s, v in sorted(calls.items())},
+        "llm_calls": llm_calls[-1],
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(result, baseline, fail_over):
+    """印出與基準的差異；有情境變慢超過 fail_over% 時回傳 False"""
+    ok = True
+    print(f"{'scenario':<28}{'base ms':>10}{'now ms':>10}{'delta':>9}", file=sys.stderr)
+    for name, now in result["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            print(f"{name:<28}{'-':>10}{now['total_ms']['median']:>10.1f}{'new':>9}", file=sys.stderr)
+            continue
+        b, n = base["total_ms"]["median"], now["total_ms"]["median"]
+        delta = (n - b) / b * 100 if b else 0.0
+        mark = ""
+        if fail_over is not None and delta > fail_over:
+            mark = "  <-- 變慢"
+            ok = False
+        print(f"{name:<28}{b:>10.1f}{n:>10.1f}{delta:>+8.1f}%{mark}", file=sys.stderr)
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="relay 流程離線基準測試")
+    parser.add_argument("--scenario", action="append", help="只跑指定情境 (可重複)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--first-token-ms", type=float, default=20.0, help="假後端首 token 延遲")
+    parser.add_argument("--tps", type=float, default=400.0, help="假後端生成速度 (token/s，0 = 不延遲)")
+    parser.add_argument("--prefill-tps", type=float, default=4000.0, help="假後端 prompt 處理速度 (0 = 不延遲)")
+    parser.add_argument("--no-router", action="store_true", help="停用快速意圖路由")
+    parser.add_argument("--rag", action="store_true", help="保留 RAG (預設停用以確保結果可重現)")
+    parser.add_argument("--out", help="結果 JSON 輸出路徑 (預設 stdout)")
+    parser.add_argument("--compare", help="與之前的結果 JSON 比較")
+    parser.add_argument("--fail-over", type=float, help="有情境總時間變慢超過此百分比時以 1 結束")
+    parser.add_argument("--list", action="store_true", help="列出情境")
+    parser.add_argument("--in-process", action="store_true",
+                        help="所有情境在同一個行程執行 (peak_rss_kb 為累計高水位)")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for s in SCENARIOS:
+            print(f"{s['name']:<28}{s['input']}")
+        return 0
+
+    if not args.rag:
+        chatcall.RAG_AVAILABLE = False
+    selected = [s for s in SCENARIOS if not args.scenario or s["name"] in args.scenario]
+    if not selected:
+        print(f"[-] 找不到情境: {args.scenario}", file=sys.stderr)
+        return 1
+
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"repeat": args.repeat, "warmup": args.warmup, "first_token_ms": args.first_token_ms,
+                       "tps": args.tps, "prefill_tps": args.prefill_tps, "router": not args.no_router,
+                       "rag": chatcall.RAG_AVAILABLE},
+        },
+        "scenarios": {},
+    }
+    for scenario in selected:
+        print(f"[bench] {scenario['name']} ...", file=sys.stderr, flush=True)
+        result["scenarios"][scenario["name"]] = run_isolated(scenario, args)
+    result["peak_rss_kb"] = max([peak_rss_kb()] + [r["peak_rss_kb"] for r in result["scenarios"].values()])
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(result, baseline, args.fail_over):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+固定的基準情境。
+
+每個情境：
+    name       名稱 (輸出 JSON 的鍵)
+    input      使用者輸入
+    architect  architect 依序回覆的原始文字 (可故意毀損，用來量 repair_json 與關鍵字救援)
+    fixtures   開始前寫入工作目錄的檔案 {相對路徑: 內容}
+"""
+
+import json
+
+SAMPLE_PY = '''import os
+
+
+def walk(root):
+    for base, dirs, files in os.walk(root):
+        for name in files:
+            yield os.path.join(base, name)
+
+
+def count_lines(path):
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        return sum(1 for _ in f)
+
+
+def main():
+    total = 0
+    for path in walk("."):
+        total += count_lines(path)
+    print(total)
+'''
+
+# 約 25KB 的程式檔，量大 context 對各階段的影響
+LARGE_PY = "\n\n".join(
+    f"def handler_{i}(request):\n    value = request.get('v{i}', {i})\n    return value * {i % 7 + 1}\n"
+    for i in range(300)
+)
+
+FIXTURES = {
+    "sample.py": SAMPLE_PY,
+    "pkg/__init__.py": "",
+    "pkg/util.py": "def helper(x):\n    return x + 1\n",
+    "notes.txt": "待辦：整理 walk() 與 count_lines()。\n",
+}
+
+
+def plan(theme, tasks, tags=None, remaining_plan=None):
+    data = {"theme": theme, "tags": tags or [], "tasks": tasks}
+    if remaining_plan:
+        data["remaining_plan"] = remaining_plan
+    return json.dumps(data, ensure_ascii=False)
+
+
+SCENARIOS = [
+    {
+        "name": "greeting_router",
+        "input": "你好",
+        "architect": [],
+    },
+    {
+        "name": "chat_via_architect",
+        "input": "聊聊你對小模型的看法吧",
+        "architect": ['{"content": "小模型適合在邊緣裝置上做快速、低成本的推論。"}'],
+    },
+    {
+        "name": "read_single_file",
+        "input": "讀取 sample.py",
+        "architect": [],
+    },
+    {
+        "name": "plan_read_analyze",
+        "input": "幫我分析 sample.py 的邏輯",
+        "architect": [plan("程式分析", [
+            {"tool": "text_reader", "params": {"file_path": "sample.py"}},
+            {"tool": "code_analyzer", "params": {}},
+        ], ["reader", "code"])],
+    },
+    {
+        "name": "plan_parallel_readonly",
+        "input": "幫我看 pkg 目錄結構並搜尋 sample.py 裡的 def",
+        "architect": [plan("專案瀏覽", [
+            {"tool": "project_reader", "params": {"path": "pkg"}, "id": "a"},
+            {"tool": "code_searcher", "params": {"file": "sample.py", "keyword": "def"}, "id": "b"},
+            {"tool": "project_reader", "params": {"path": "notes.txt"}, "id": "c"},
+        ], ["project", "search"])],
+    },
+    {
+        "name": "write_code",
+        "input": "寫一個計算平方和的 python 程式",
+        "architect": [plan("生成程式", [
+            {"tool": "write_code", "params": {"task_description": "計算 0..9 的平方和", "filename": "squares.py"}},
+        ], ["code", "writer"])],
+    },
+    {
+        "name": "large_context_analyze",
+        "input": "幫我分析 large.py",
+        "architect": [plan("大檔分析", [
+            {"tool": "text_reader", "params": {"file_path": "large.py"}},
+            {"tool": "code_analyzer", "params": {}},
+        ], ["reader", "code"])],
+        "fixtures": {"large.py": LARGE_PY},
+    },
+    {
+        "name": "malformed_markdown_fence",
+        "input": "幫我看 pkg 目錄",
+        "architect": ["```json\n" + plan("專案瀏覽", [
+            {"tool": "project_reader", "params": {"path": "pkg"}},
+        ]) + "\n```"],
+    },
+    {
+        "name": "malformed_truncated",
+        "input": "列出目前目錄並分析",
+        "architect": ['{"theme": "專案瀏覽", "tags": ["project"], "tasks": [{"tool": "project_reader", "params": {"path": "pkg"'],
+    },
+    {
+        "name": "malformed_keyword_only",
+        "input": "搜尋 sample.py 的 walk 並說明",
+        "architect": ["我建議使用 code_searcher 來處理這個需求，然後再整理結果。"],
+    },
+    {
+        "name": "continuation",
+        "input": "先讀 sample.py，之後再分析",
+        "architect": [
+            plan("分段任務", [{"tool": "text_reader", "params": {"file_path": "sample.py"}}],
+                 ["reader"], remaining_plan="使用 code_analyzer 分析已載入的 sample.py 程式碼"),
+            plan("分段任務", [{"tool": "code_analyzer", "params": {}}], ["code"]),
+        ],
+    },
+]
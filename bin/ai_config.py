@@ -8,8 +8,138 @@ MODELS = {
     "chatter": "./models/qwen2.5-0.5b-instruct-q8_0.gguf",
     "coder": "./models/qwen2.5-coder-1.5b-instruct-q8_0.gguf" 
 }
-STATE_FILE = "pi_ai_state.json"
+STATE_FILE = "pi_ai_state.json"  # 舊格式的對話紀錄，僅在第一次開啟 HISTORY_DB 時匯入
+# 對話紀錄 (SQLite WAL，只附加)；啟動時載入最後 HISTORY_WINDOW 筆，超過 HISTORY_KEEP 的兩倍時背景壓縮
+HISTORY_DB = "pi_ai_history.db"
+HISTORY_WINDOW = 200
+HISTORY_KEEP = 5000
 
+# 常駐推論 daemon：模型只載入一次，所有子聊天室共用同一個 socket
+LLM_DAEMON_SOCKET = "/tmp/localllm-daemon.sock"
+LLM_DAEMON_PRELOAD = ["architect", "chatter", "coder"]
+LLM_DAEMON_LOG = "/tmp/localllm-daemon.log"
+# daemon 的排程：各聊天室一條佇列、使用者之間公平輪替、互動請求優先於 --batch
+# SLOTS 為同時執行的請求數 (同一模型一次一個，>1 時不同模型可同時推論)；
+# 需要載入新模型且已有請求在跑時，系統可用記憶體至少要有 MIN_FREE_MB
+LLM_DAEMON_SLOTS = 1
+LLM_DAEMON_MIN_FREE_MB = 200
+
+# 推論後端: auto / daemon / llama_cpp / subprocess / server
+# auto = daemon 有在跑就用 daemon，否則使用 LLM_LOCAL_BACKEND
+LLM_BACKEND = "auto"
+LLM_LOCAL_BACKEND = "subprocess"
+# subprocess 後端：所有行程共用的檔案鎖，同一時間只跑一個 llama-completion (不再 pkill 別人的生成)
+LLAMA_COMPLETION_LOCK = "/tmp/localllm-completion.lock"
+
+# llama-server 後端：每個模型一個伺服器，-np 個 slot 做 continuous batching
+LLAMA_SERVER_BIN = "./llama.bin/llama-server"
+LLAMA_SERVER_URLS = {
+    "architect": "http://127.0.0.1:8081",
+    "chatter": "http://127.0.0.1:8082",
+    "coder": "http://127.0.0.1:8083"
+}
+LLAMA_SERVER_SLOTS = 2
+LLAMA_SERVER_POOL_SIZE = 4
+
+# 系統提示前綴 KV 快照的記憶體上限 (MB)，0 表示停用
+PREFIX_CACHE_MB = 128
+
+# llama_cpp 模型管理：超過記憶體預算時卸載最久未使用的閒置模型
+# 預算只計 KV cache 與計算緩衝區 (use_mmap 的權重由核心的 page cache 管理，不計入)；
+# 依 MODEL_SETTINGS 三個模型約需 architect 380MB (含 chatter 猜測)、coder 185MB、chatter 115MB (合計約 670MB)，
+# 900MB 可讓 MODELS 全部常駐。關閉 use_mmap 或開啟 use_mlock 時權重 (GGUF 檔大小) 也會計入，需一併調高
+MODEL_RAM_BUDGET_MB = 900
+MODEL_DEFAULTS = {
+    "n_ctx": 4096,
+    "n_batch": 256,
+    "n_threads": 4,
+    "use_mmap": True,
+    "use_mlock": False
+}
+# 每個模型的 context 設定；kv_bytes_per_token 為 f16 KV 的每 token 大小 (n_layer*2*n_kv_head*head_dim*2)
+# type_k / type_v 可設 f16 / q8_0 / q4_0 等，ram_mb 可直接指定預估用量
+# speculative：llama_cpp 後端的推測解碼，拿掉即停用
+#   {"type": "prompt_lookup", "num_pred_tokens": 10, "max_ngram_size": 3} 從 prompt 找相同 n-gram 當猜測 (改程式碼時大多照抄原檔)
+#   {"type": "model", "draft": "chatter", "num_pred_tokens": 4} 以同 tokenizer 的小模型猜測 (小模型的記憶體一併計入預算)
+MODEL_SETTINGS = {
+    "architect": {"n_ctx": 8192, "n_batch": 256, "type_k": "q8_0", "type_v": "q8_0", "kv_bytes_per_token": 36864,
+                  "speculative": {"type": "model", "draft": "chatter", "num_pred_tokens": 4}},
+    "chatter": {"n_ctx": 4096, "n_batch": 256, "kv_bytes_per_token": 12288},
+    "coder": {"n_ctx": 8192, "n_batch": 256, "type_k": "q8_0", "type_v": "q8_0", "kv_bytes_per_token": 28672,
+              "speculative": {"type": "prompt_lookup", "num_pred_tokens": 10, "max_ngram_size": 3}}
+}
+
+# 規劃任務並行執行的工作執行緒上限 (1 = 依序執行)
+TASK_WORKERS = 4
+# 架構師還在生成時，規劃開頭只讀檔的任務 (early_dispatch 工具) 一完整就先執行
+PLAN_PIPELINE_ENABLED = True
+
+# 本地快取目錄 (回應快取等)
+CACHE_DIR = ".pi_ai_cache"
+# 低溫度呼叫的磁碟回應快取：temp <= RESPONSE_CACHE_MAX_TEMP 的呼叫才快取
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_DIR = os.path.join(CACHE_DIR, "responses")
+RESPONSE_CACHE_MAX_MB = 64
+RESPONSE_CACHE_MAX_TEMP = 0.3
+
+# RAG 快取：輸入文字向量的 LRU 筆數 (0 = 關閉)，rag_query_* 結果保留秒數 (0 = 關閉，寫入知識/失敗經驗時作廢)
+RAG_EMBED_CACHE_SIZE = 256
+RAG_RESULT_CACHE_SECONDS = 120
+# 回答後的互動評分與 RAG 寫入在背景執行：工作先寫入 spool 目錄，行程結束時只等進行中的一批
+# RAG_WRITE_EXIT_WAIT 秒，沒做完的下次啟動時補做
+RAG_WRITE_SPOOL_DIR = os.path.join(CACHE_DIR, "rag_writes")
+RAG_WRITE_BATCH_SIZE = 16
+RAG_WRITE_EXIT_WAIT = 2.0
+# 互動評分 (rag_calculate_engagement) 帶入的最近訊息數；背景寫入的工作只存這一段對話
+RAG_ENGAGEMENT_HISTORY = 20
+
+# 架構師前的快速意圖路由：寒暄直接交給 chatter、單純讀檔直接執行 project_reader
+INTENT_ROUTER_ENABLED = True
+# 超過此長度的輸入不走寒暄捷徑
+INTENT_ROUTER_CHAT_MAX_CHARS = 40
+
+# 工具清單快取：工具模組未變動時由 manifest 註冊，第一次 execute_tool 才 import 模組
+# (設定環境變數 PI_AI_EAGER_TOOLS=1 可強制啟動時全部 import)
+TOOL_MANIFEST_ENABLED = True
+TOOL_MANIFEST_FILE = os.path.join(CACHE_DIR, "tool_manifest.json")
+
+# 每輪各階段的追蹤：TRACE_DIR/trace-YYYYMMDD.jsonl (span) 與 metrics.prom (Prometheus 文字格式)
+TRACE_ENABLED = True
+TRACE_DIR = os.path.join(CACHE_DIR, "traces")
+
+# self.context 的 token 預算 = 模型 n_ctx * CONTEXT_BUDGET_RATIO (其餘留給系統提示、指令與生成)
+CONTEXT_BUDGET_RATIO = 0.5
+# 超過預算時的保留順序 (前面的優先放入)；工具讀取 sys_inst.context 時以 CONTEXT_DEFAULT_MODEL 的預算組裝
+CONTEXT_SEGMENT_PRIORITY = ["todo", "file", "failures", "rag"]
+CONTEXT_DEFAULT_MODEL = "coder"
+
+# code_analyzer 的大檔案分段分析：超過 CHUNK_TRIGGER_TOKENS 時依函式/類別邊界切成 CHUNK_MAX_TOKENS 的段落，
+# 各段分析 (每段最多生成 CHUNK_MAP_N_TOKENS) 後再整合 (CHUNK_REDUCE_N_TOKENS)
+CHUNK_TRIGGER_TOKENS = 3072
+CHUNK_MAX_TOKENS = 1536
+CHUNK_MAP_N_TOKENS = 512
+CHUNK_REDUCE_N_TOKENS = 1024
+
+# project_reader 的目錄樹：除了各層 .gitignore 之外固定忽略的項目 (gitignore 語法)、深度與項目上限，
+# 各目錄列表依目錄 mtime 快取在 PROJECT_TREE_CACHE
+PROJECT_TREE_IGNORE = [".git/", "__pycache__/", ".pi_ai_cache/", "node_modules/", ".venv/", "venv/",
+                       "models/", "llama.bin/", "rag_data/", "*.gguf"]
+PROJECT_TREE_MAX_DEPTH = 4
+PROJECT_TREE_MAX_ENTRIES = 400
+PROJECT_TREE_CACHE = os.path.join(CACHE_DIR, "project_tree.json")
+
+# code_searcher 的專案索引 (SQLite FTS5 trigram + 函式/類別符號表)，每個專案根目錄一個資料庫，依檔案 mtime 增量更新
+CODE_INDEX_DIR = os.path.join(CACHE_DIR, "code_index")
+CODE_INDEX_CHUNK_LINES = 40
+CODE_INDEX_MAX_FILE_KB = 512
+CODE_SEARCH_LIMIT = 8
+
+# code_modifier：edit = 模型只輸出 SEARCH/REPLACE 區塊 (或 diff)，模糊定位後檢查並原子寫入；rewrite = 重新輸出整個檔案
+CODE_MODIFIER_MODE = "edit"
+CODE_EDIT_N_TOKENS = 1024
+# 區塊無法套用時，附上錯誤原因請模型重試的次數
+CODE_EDIT_RETRIES = 1
+CODE_EDIT_FUZZY_THRESHOLD = 0.9
 
 # 確保模型路徑存在，若不存在則提示（不中斷程式以利除錯）
 def check_config():
@@ -18,6 +148,8 @@ def check_config():
     for key, path in MODELS.items():
         if not os.path.exists(path):
             print(f"[-] Warning: 模型檔案不存在: {path}")
+    if not os.path.exists(LLM_DAEMON_SOCKET):
+        print(f"[*] 推論 daemon 未啟動，將改用每次呼叫載入模型 ({LLM_DAEMON_SOCKET})")
 
 if __name__ == "__main__":
     check_config()
@@ -1,32 +1,43 @@
-import subprocess
 import json
 import sys
 import os
 import re
+import threading
 import time
-from ai_config import LLAMA_BIN, MODELS, STATE_FILE
+from contextlib import closing
+from ai_config import (
+    STATE_FILE, TASK_WORKERS,
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_MB, RESPONSE_CACHE_MAX_TEMP,
+    INTENT_ROUTER_ENABLED, INTENT_ROUTER_CHAT_MAX_CHARS,
+    TRACE_ENABLED, TRACE_DIR,
+    HISTORY_DB, HISTORY_WINDOW, HISTORY_KEEP,
+    MODEL_DEFAULTS, MODEL_SETTINGS, CONTEXT_BUDGET_RATIO, CONTEXT_SEGMENT_PRIORITY, CONTEXT_DEFAULT_MODEL,
+    PLAN_PIPELINE_ENABLED, RAG_EMBED_CACHE_SIZE, RAG_RESULT_CACHE_SECONDS,
+    RAG_WRITE_SPOOL_DIR, RAG_WRITE_BATCH_SIZE, RAG_WRITE_EXIT_WAIT, RAG_ENGAGEMENT_HISTORY
+)
 from llm_call_tools.common import (
-    TOOLS_LIST, 
+    TOOLS_TAGS,
     execute_tool, 
     get_tool_names, 
     get_weighted_tool_prompts,
-    get_tool_prompts
+    is_side_effect_free,
+    is_early_dispatch
 )
+from llm_runtime.backends import create_backend
+from llm_runtime.streaming import stream_until_json_closed, EchoedText, PlanTaskParser
+from llm_runtime.task_graph import run_task_graph, PlanPrefetcher
+from llm_runtime.response_cache import ResponseCache
+from llm_runtime.router import IntentRouter
+from llm_runtime.tracing import Tracer, record_usage, take_usage, estimate_tokens
+from llm_runtime.rag import LazyRag
+from llm_runtime.write_behind import WriteBehindQueue
+from llm_runtime.history_store import HistoryStore
+from llm_runtime.context import ContextAssembler
 
 # --- 強化學習與 RAG 整合區 ---
-try:
-    from rag_tool import (
-        rag_query_knowledge, 
-        rag_store_knowledge,
-        rag_calculate_engagement,
-        rag_record_engagement_feedback,
-        rag_query_failures,
-        rag_store_failure_feedback,
-        rag_record_user_feedback
-    )
-    RAG_AVAILABLE = True
-except ImportError:
-    RAG_AVAILABLE = False
+# rag_tool 會載入 Chroma 向量庫：啟動時只確認它存在，真正的 import 在需要時於背景進行
+rag = LazyRag("rag_tool", embed_cache_size=RAG_EMBED_CACHE_SIZE, result_ttl=RAG_RESULT_CACHE_SECONDS)
+RAG_AVAILABLE = rag.installed()
 
 RAG_FORCE_KEYWORDS = ["100分", "幫我加入rag", "幫我記下來", "好極了, 這必須記下來"]
 RAG_FAILURE_KEYWORDS = ["失敗", "錯誤", "不滿", "爛", "不行", "不對", "不滿意"]
@@ -49,14 +60,41 @@ def adjust_tool_selection_and_tags(rag_result, tags):
 # --- 主系統類別 ---
 
 class PiAiRelaySystem:
-    def __init__(self):
-        self.context = ""
+    def __init__(self, backend=None, history_db=HISTORY_DB, rag_writes=True):
+        """
+        :param history_db: 對話紀錄資料庫 (批次模式用獨立的檔案，不寫入使用者的對話)
+        :param rag_writes: 是否在回答後做互動評分與 RAG 寫入
+        """
+        # 推論後端由 ai_config.LLM_BACKEND 決定
+        self.backend = backend or create_backend()
+        # 低溫度呼叫的磁碟回應快取；設定 PI_AI_NO_CACHE=1 可整個略過
+        self.response_cache = None
+        if RESPONSE_CACHE_ENABLED and not os.environ.get("PI_AI_NO_CACHE"):
+            self.response_cache = ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_MB)
+        # 每輪各階段的耗時與 token 用量 (TRACE_DIR 下的 JSONL 與 metrics.prom)
+        self.tracer = Tracer(TRACE_DIR, enabled=TRACE_ENABLED)
+        self._llm_local = threading.local()
+        # context 由具名區段組成 (RAG、失敗經驗、檔案內容、待辦)，讀取時依模型的 token 預算組裝
+        self.context_assembler = ContextAssembler(self.backend.count_tokens, self.context_budget,
+                                                  priority=CONTEXT_SEGMENT_PRIORITY)
+        # 對話紀錄只附加不重寫；第一次使用時匯入舊的 STATE_FILE
+        self.history_store = HistoryStore(history_db, keep=HISTORY_KEEP,
+                                          legacy_file=STATE_FILE if history_db == HISTORY_DB else None)
         self.history = self.load_history()
-        self.todo_list = ""
+        self._history_saved = len(self.history)
+        self._todo_list = ""
         self.current_theme = ""
+        # 回答後的互動評分與 RAG 寫入交給背景執行緒；上次結束前沒做完的先在背景補做
+        self.rag_writes = None
+        if RAG_AVAILABLE and rag_writes:
+            self.rag_writes = WriteBehindQueue(RAG_WRITE_SPOOL_DIR, self.apply_rag_writes,
+                                               batch_size=RAG_WRITE_BATCH_SIZE, exit_wait=RAG_WRITE_EXIT_WAIT)
+            self.rag_writes.replay()
         
         # 動態獲取工具名清單
         self.available_tools = get_tool_names()
+        # 寒暄與單純讀檔不必經過 3B 架構師
+        self.router = IntentRouter(TOOLS_TAGS, INTENT_ROUTER_CHAT_MAX_CHARS) if INTENT_ROUTER_ENABLED else None
         
         # 定義架構師 Schema
         self.architect_schema = {
@@ -70,7 +108,9 @@ class PiAiRelaySystem:
                         "type": "object",
                         "properties": {
                             "tool": {"type": "string", "enum": self.available_tools},
-                            "params": {"type": "object", "additionalProperties": True}
+                            "params": {"type": "object", "additionalProperties": True},
+                            "id": {"type": "string", "description": "任務代號"},
+                            "depends_on": {"type": "array", "items": {"type": "string"}, "description": "前置任務的 id"}
                         },
                         "required": ["tool", "params"]
                     }
@@ -80,17 +120,49 @@ class PiAiRelaySystem:
             "required": ["theme", "tasks"]
         }
 
+    @staticmethod
+    def context_budget(model_key):
+        n_ctx = MODEL_SETTINGS.get(model_key, {}).get("n_ctx", MODEL_DEFAULTS["n_ctx"])
+        return int(n_ctx * CONTEXT_BUDGET_RATIO)
+
+    @property
+    def context(self):
+        """工具看到的 context (以 CONTEXT_DEFAULT_MODEL 的預算組裝)"""
+        return self.context_assembler.render(CONTEXT_DEFAULT_MODEL)
+
+    @context.setter
+    def context(self, text):
+        # 工具 (如 text_reader) 指定 context 時視為檔案內容區段，RAG 與待辦區段仍保留
+        self.context_assembler.set("file", text or "")
+
+    def count_tokens(self, model_key, text):
+        """以模型的 tokenizer 計數 (無法計算時估算)，結果有快取"""
+        return self.context_assembler.count(model_key, text)
+
+    def context_for(self, model_key):
+        return self.context_assembler.render(model_key)
+
+    @property
+    def todo_list(self):
+        return self._todo_list
+
+    @todo_list.setter
+    def todo_list(self, text):
+        self._todo_list = text or ""
+        self.context_assembler.set("todo", self._todo_list, header="[待辦]")
+
     def load_history(self):
-        if os.path.exists(STATE_FILE):
-            try:
-                with open(STATE_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except: pass
-        return []
+        # 只讀最後 HISTORY_WINDOW 筆，與總筆數無關
+        return self.history_store.tail(HISTORY_WINDOW)
 
     def save_history(self):
-        with open(STATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.history[-15:], f, ensure_ascii=False, indent=2)
+        """只附加上次儲存之後新增的訊息"""
+        with self.tracer.span("save_history") as span:
+            self._history_saved = min(self._history_saved, len(self.history))
+            new_entries = self.history[self._history_saved:]
+            self.history_store.append(new_entries)
+            self._history_saved = len(self.history)
+            span["appended"] = len(new_entries)
 
     def repair_json(self, raw_text):
         """嘗試修復截斷的 JSON"""
@@ -114,6 +186,21 @@ class PiAiRelaySystem:
                 except: return None
         return None
 
+    def rag_json(self, future, span):
+        """等背景的 RAG 查詢完成並解析 JSON；失敗時只警告，回傳空結果"""
+        try:
+            value, query_ms = future.result()
+            span["query_ms"] = round(query_ms, 3)
+            if getattr(future, "cached", False):
+                span["cached"] = True
+            if rag.import_seconds is not None:
+                span["import_ms"] = round(rag.import_seconds * 1000, 3)
+            return json.loads(value)
+        except Exception as e:
+            print(f"[-] RAG 查詢失敗: {e}", file=sys.stderr, flush=True)
+            span["failed"] = True
+            return {"results": []}
+
     def strip_noise(self, text):
         #print(f'原始文字:\n{text}')
         noise_markers = ["<|im_start|>", "<|im_end|>", "[end of text]"]
@@ -128,50 +215,189 @@ class PiAiRelaySystem:
 
         return result
 
-    def call_llm(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
-        model_path = MODELS.get(model_key)
-        if not model_path or not os.path.exists(model_path):
-            return f"Error: 找不到模型檔案 {model_path}"
-        subprocess.run(["pkill", "-9", "llama-completion"], stderr=subprocess.DEVNULL)
-        cmd = [
-            LLAMA_BIN, "-m", model_path, "-st", "--no-display-prompt", "--simple-io",
-            "--temp", str(temp), "-n", str(n_tokens), "-p", prompt
-#            ,"--ctx-size",str(32768)
-        ]
-        if system_prompt: cmd.extend(["-sys", system_prompt])
-        if schema: cmd.extend(["-j", json.dumps(schema)])
+    def stream_llm(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None, stop_on_json=False):
+        """逐段產生模型原始輸出；stop_on_json 時第一個 JSON 物件一閉合就停止生成"""
+        chunks = self.backend.stream(model_key, prompt, system_prompt, n_tokens, temp, schema)
+        if stop_on_json:
+            chunks = stream_until_json_closed(chunks)
+        return chunks
+
+    def call_llm(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None,
+                 stop_on_json=False, stream_to=None, use_cache=True, on_text=None):
+        """
+        :param stop_on_json: 以串流生成，JSON 物件完整後立即停止 (省下模型在結尾後的囉嗦)
+        :param stream_to: 邊生成邊寫到此檔案物件 (如 sys.stdout)，回傳值標記為已輸出
+        :param use_cache: 低溫度呼叫先查磁碟回應快取，False 則強制重新生成
+        :param on_text: 每產生一段原始文字就呼叫一次 (命中快取或非串流時一次給完整文字)
+        """
+        with self.tracer.span("llm", model=model_key) as span:
+            take_usage()  # 清掉本執行緒之前殘留的用量
+            t0 = time.perf_counter()
+            text = self._generate(model_key, prompt, system_prompt, n_tokens, temp, schema,
+                                  stop_on_json, stream_to, use_cache, on_text)
+            elapsed = time.perf_counter() - t0
+            usage = take_usage()
+            if usage.get("cached"):
+                span["cached"] = True
+            else:
+                # 後端沒有回報 token 數時 (subprocess) 以字元數估算
+                span["prompt_tokens"] = usage.get("prompt_tokens") or estimate_tokens((system_prompt or "") + prompt)
+                span["completion_tokens"] = usage.get("completion_tokens") or estimate_tokens(text)
+                span["estimated"] = "completion_tokens" not in usage
+                gen_seconds = max(elapsed - usage.get("load_seconds", 0.0), 1e-6)
+                span["tokens_per_second"] = round(usage.get("tokens_per_second") or span["completion_tokens"] / gen_seconds, 3)
+                span["load_seconds"] = round(usage.get("load_seconds", 0.0), 3)
+                if usage.get("draft_tokens"):
+                    span["draft_tokens"] = usage["draft_tokens"]
+                    span["draft_accepted"] = usage.get("draft_accepted", 0)
+                    span["draft_acceptance"] = round(span["draft_accepted"] / span["draft_tokens"], 3)
+            if text.startswith("Error:"):
+                span["failed"] = True
+            self._llm_local.stats = dict(span)
+            return text
+
+    def last_llm_stats(self):
+        """本執行緒最近一次 call_llm 的用量 (token 數、速度、是否命中快取)"""
+        return dict(getattr(self._llm_local, "stats", None) or {})
+
+    def _generate(self, model_key, prompt, system_prompt, n_tokens, temp, schema, stop_on_json, stream_to, use_cache,
+                  on_text=None):
+        cache_key = None
+        if use_cache and self.response_cache is not None and temp <= RESPONSE_CACHE_MAX_TEMP:
+            cache_key = self.response_cache.make_key(model_key, prompt, system_prompt, temp, n_tokens, schema,
+                                                     stop_on_json=stop_on_json)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                record_usage(cached=True)
+                if on_text is not None:
+                    on_text(cached)
+                if stream_to is not None:
+                    stream_to.write(cached + "\n")
+                    stream_to.flush()
+                    return EchoedText(cached)
+                return cached
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='ignore', timeout=180)
-            return self.strip_noise(result.stdout)
+            if not stop_on_json and stream_to is None:
+                text = self.strip_noise(self.backend.complete(model_key, prompt, system_prompt, n_tokens, temp, schema))
+                if on_text is not None:
+                    on_text(text)
+            else:
+                parts = []
+                with closing(self.stream_llm(model_key, prompt, system_prompt, n_tokens, temp, schema, stop_on_json)) as chunks:
+                    for piece in chunks:
+                        parts.append(piece)
+                        if on_text is not None:
+                            on_text(piece)
+                        if stream_to is not None:
+                            stream_to.write(piece)
+                            stream_to.flush()
+                if stream_to is not None:
+                    stream_to.write("\n")
+                text = self.strip_noise("".join(parts))
         except Exception as e:
             return f"Error: {str(e)}"
+        if cache_key and text:
+            self.response_cache.put(cache_key, text)
+        return EchoedText(text) if stream_to is not None else text
+
+    def apply_rag_writes(self, jobs):
+        """
+        背景執行緒：計算這一批的互動參與度，再依序寫入知識與失敗經驗 (rag_tool 沒有批次寫入，逐筆呼叫)。
+        每寫完一筆就記在該工作的 spool 檔 (job["done"])，中斷後重做時不會重複寫入已完成的部分。
+        """
+        try:
+            rag.module()
+        except ImportError:
+            return  # rag_tool 無法載入：與原本同步執行時一樣略過
+        writes = []
+        for job in jobs:
+            done = job.setdefault("done", [])
+            wants_knowledge = job.get("store_knowledge") and "knowledge" not in done
+            engagement_data = {}
+            if wants_knowledge and job.get("result") is not None:
+                engagement_json = rag.rag_calculate_engagement(job["history_index"], job["history"], job["result"])
+                engagement_data = json.loads(engagement_json).get('engagement_analysis', {}) if engagement_json else {}
+            engagement_score = engagement_data.get('engagement_score', 0)
+
+            if wants_knowledge and (engagement_score >= RAG_ENGAGEMENT_THRESHOLD or job.get("force")):
+                writes.append((job, "knowledge", rag.rag_store_knowledge, dict(
+                    task_description=job["task_description"],
+                    solution=job.get("result") or "",
+                    task_type=job.get("task_type", ""),
+                    tools_used=job.get("tools_used", []),
+                    success_metrics={
+                        "engagement_score": engagement_score,
+                        "follow_up_count": engagement_data.get('follow_up_count', 0),
+                        "context_tokens_added": engagement_data.get('context_tokens_added', 0),
+                        "question_depth": engagement_data.get('question_depth', 0)
+                    }
+                )))
+            if job.get("failure") and "failure" not in done:
+                writes.append((job, "failure", rag.rag_store_failure_feedback, dict(
+                    task_description=job["task_description"],
+                    failed_approach=job.get("result") or "",
+                    error_message="user negative feedback",
+                    correct_solution="(待補充)"
+                )))
+        writes.sort(key=lambda w: w[1] != "knowledge")
+        for job, kind, store, kwargs in writes:
+            store(**kwargs)
+            job["done"].append(kind)
+            self.rag_writes.checkpoint(job)
+
+    def plan_step(self, index, task):
+        """規劃中的一個任務轉成步驟 {"step", "tool", "params", ...}；工具不存在時回傳 None"""
+        if not isinstance(task, dict):
+            return None
+        name = task.get("tool","")
+        if name == "" and "function" in task:
+            name = task.get("function","")
+        params = task.get("params", {})
+        if len(params) == 0 and "parameters" in task:
+            params = task.get("parameters", {}) 
+        if len(params) == 0 and "arguments" in task:
+            params = task.get("arguments", {}) 
+        if name not in self.available_tools:
+            return None
+        return {"step": index + 1, "tool": name, "params": params,
+                "id": task.get("id"), "depends_on": task.get("depends_on")}
 
     def run_relay(self, user_input, is_continuation=False):
+        """處理一個輸入，回傳寫入對話紀錄的最後回答"""
+        with self.tracer.turn(user_input):
+            return self._run_relay(user_input, is_continuation)
+
+    def _run_relay(self, user_input, is_continuation=False):
         # 1. 預選標籤 (保底用)
         possible_tags = ["c", "python", "file", "code", "reader", "writer", "analyze"]
         suggested = [t for t in possible_tags if t in user_input.lower()]
 
         next_input = user_input
         continuation = is_continuation
-        while True:
-            # 1. RAG查詢，將相關知識納入 context
-            rag_context = ""
-            rag_result = {"results": []}
-            if RAG_AVAILABLE:
-                rag_result = json.loads(rag_query_knowledge(next_input, n_results=3))
-                rag_context = "\n".join([r['content'] for r in rag_result.get('results', [])]) if rag_result.get('results') else ""
-            if rag_context:
-                self.context = f"[RAG知識]\n{rag_context}\n" + self.context
 
-            # 2. 查詢失敗經驗，納入 context
-            fail_context = ""
+        # 0. 快速路由：有把握的輸入直接交給 chatter 或單一工具，跳過架構師
+        if self.router is not None:
+            with self.tracer.span("router") as span:
+                decision = self.router.route(user_input, is_continuation)
+                span.update(route=decision["route"], tool=decision["tool"], reason=decision["reason"])
+            print(f"[*] 路由: {decision['route']} ({decision['reason']}, {decision['ms']:.1f}ms)", flush=True)
+            if decision["route"] != "architect":
+                with self.tracer.span("tool", tool=decision["tool"]):
+                    res = execute_tool(decision["tool"], decision["params"], self)
+                if not getattr(res, "echoed", False):
+                    print(f" >> {res}")
+                self.history.append({"role": "user", "content": user_input})
+                self.history.append({"role": "assistant", "content": res})
+                self.save_history()
+                return res
+
+        while True:
+            # 1. RAG 知識與失敗經驗查詢在背景並行 (第一次會順便在背景載入 rag_tool)
             if RAG_AVAILABLE:
-                rag_fail = json.loads(rag_query_failures(next_input, n_results=2))
-                fail_context = "\n".join([f"失敗經驗: {r['failed_approach']}\n修正: {r['solution']}" for r in rag_fail.get('results', [])]) if rag_fail.get('results') else ""
-            if fail_context:
-                self.context += f"\n[失敗經驗]\n{fail_context}"
+                knowledge_future = rag.submit("rag_query_knowledge", next_input, n_results=3)
+                failures_future = rag.submit("rag_query_failures", next_input, n_results=2)
 
-            # 3. 獲取工具描述
+            # 2. 獲取工具描述
             tools_description = get_weighted_tool_prompts(suggested)
 
             architect_sys = f"""你是一個任務架構師。
@@ -183,25 +409,59 @@ class PiAiRelaySystem:
 **要求：**
 1. 必須輸出 JSON。
 2. 'tags' 必須包含對應工具的標籤。
-3. 如果只是打招呼，請文字回答。"""
+3. 輸出受 Schema 文法限制，如果只是打招呼，請使用 chatter 工具回應。
+4. 任務可用 'id' 命名並以 'depends_on' 列出前置任務的 id，互不相依的唯讀任務會同時執行。"""
+
+            # 規劃開頭只讀檔的任務 (text_reader、project_reader...) 一生成完整就先執行，與架構師後續的生成重疊
+            prefetcher = None
+            on_text = None
+            if PLAN_PIPELINE_ENABLED:
+                def prefetch_step(step):
+                    print(f"\n[步驟 {step['step']}] 預先執行: {step['tool']} (規劃生成中)\n", end="", flush=True)
+                    with self.tracer.span("tool", tool=step["tool"], step=step["step"], prefetched=True):
+                        return execute_tool(step["tool"], step["params"], self)
+
+                prefetcher = PlanPrefetcher(prefetch_step, lambda step: is_early_dispatch(step["tool"]),
+                                            snapshot=lambda: self.context_assembler.snapshot(["file"]),
+                                            restore=self.context_assembler.restore)
+                parser = PlanTaskParser(lambda i, task: prefetcher.submit(i, self.plan_step(i, task) if task else None))
+                on_text = parser.feed
 
             print(f"[*] {'[接力中]' if continuation else '[規劃中]'} 分析任務...", flush=True)
-            raw_res = self.call_llm("architect", next_input, system_prompt=architect_sys, schema=self.architect_schema)
+            with self.tracer.span("architect", continuation=continuation):
+                raw_res = self.call_llm("architect", next_input, system_prompt=architect_sys, schema=self.architect_schema,
+                                        stop_on_json=True, on_text=on_text)
+
+            # 3. 收集 RAG 結果 (架構師提示不含 RAG，查詢可與架構師推論/模型載入重疊)，將相關知識與失敗經驗納入 context
+            rag_result = {"results": []}
+            rag_fail = {"results": []}
+            if RAG_AVAILABLE:
+                with self.tracer.span("rag_knowledge") as span:
+                    rag_result = self.rag_json(knowledge_future, span)
+                with self.tracer.span("rag_failures") as span:
+                    rag_fail = self.rag_json(failures_future, span)
+            # 每一輪取代 (不累加) 對應的區段，重複的結果由 ContextAssembler 去除
+            self.context_assembler.set("rag", [r['content'] for r in rag_result.get('results', [])], header="[RAG知識]")
+            self.context_assembler.set("failures", [f"失敗經驗: {r['failed_approach']}\n修正: {r['solution']}" for r in rag_fail.get('results', [])], header="[失敗經驗]")
 
             # 4. 解析與修復
-            plan_data = self.repair_json(raw_res)
+            with self.tracer.span("repair_json", chars=len(raw_res)) as span:
+                plan_data = self.repair_json(raw_res)
+                span["parsed"] = plan_data is not None
             is_tool_call = False
 
-            if plan_data and isinstance(plan_data, dict) and ("tasks" in plan_data or "actions" in plan_data) or "function_call" in plan_data:
+            if plan_data and isinstance(plan_data, dict) and ("tasks" in plan_data or "actions" in plan_data or "function_call" in plan_data):
                 is_tool_call = True
             elif plan_data and isinstance(plan_data, dict) and set(plan_data.keys()) == {"content"}:
                 # 僅有 content 欄位，視為對話型回應，直接進入對話模式
+                if prefetcher is not None:
+                    prefetcher.discard()
                 print("[*] 進入對話模式（僅 content 欄位）。")
                 self.history.append({"role": "user", "content": next_input})
                 self.history.append({"role": "assistant", "content": plan_data["content"]})
                 self.save_history()
                 print(f"\n>> {plan_data['content']}")
-                return True
+                return plan_data["content"]
             else:
                 # --- 強制執行路徑：使用動態工具名比對 ---
                 for tool_name in self.available_tools:
@@ -216,12 +476,14 @@ class PiAiRelaySystem:
                         break
 
             if not is_tool_call:
+                if prefetcher is not None:
+                    prefetcher.discard()
                 print("[*] 進入對話模式。")
                 self.history.append({"role": "user", "content": next_input})
                 self.history.append({"role": "assistant", "content": raw_res})
                 self.save_history()
                 print(f"\n>> {raw_res}")
-                return True
+                return raw_res
 
             # 5. 提取資訊並執行
             self.current_theme = plan_data.get("theme", "任務處理")
@@ -237,61 +499,47 @@ class PiAiRelaySystem:
 
             print(f"[*] 主題: {self.current_theme} | 標籤: {tags}")
 
+            steps = [step for step in (self.plan_step(i, task) for i, task in enumerate(tasks)) if step is not None]
+            # 預先執行的結果只沿用與最終規劃一致的開頭；其餘捨棄並還原 context
+            prefetched = prefetcher.reconcile(steps) if prefetcher is not None else {}
+            if prefetcher is not None and len(prefetched) < len(prefetcher.entries):
+                print(f"[*] 最終規劃與預先執行的步驟不同，捨棄 {len(prefetcher.entries) - len(prefetched)} 個結果", flush=True)
+
+            def run_step(_, step):
+                future = prefetched.get(step["step"] - 1)
+                if future is not None:
+                    print(f"\n[步驟 {step['step']}] {step['tool']}: 沿用預先執行的結果\n", end="", flush=True)
+                    return future.result()
+                # 並行時多個執行緒同時輸出，整行一次寫入避免交錯
+                print(f"\n[步驟 {step['step']}] 執行: {step['tool']}\n", end="", flush=True)
+                with self.tracer.span("tool", tool=step["tool"], step=step["step"]):
+                    return execute_tool(step["tool"], step["params"], self)
+
+            # 互不相依的無副作用任務並行執行，結果依計畫順序收集
             results = []
-            for i, task in enumerate(tasks):
-                name = task.get("tool","")
-                if name == "" and "function" in task:
-                    name = task.get("function","")
-                params = task.get("params", {})
-                if len(params) == 0 and "parameters" in task:
-                    params = task.get("parameters", {}) 
-                if len(params) == 0 and "arguments" in task:
-                    params = task.get("arguments", {}) 
-                if name not in self.available_tools: continue
-
-                print(f"\n[步驟 {i+1}] 執行: {name}")
-                res = execute_tool(name, params, self)
+            for _, res in run_task_graph(steps, run_step, lambda step: is_side_effect_free(step["tool"]), TASK_WORKERS):
                 results.append(res)
-                print(f" >> {res}")
-
-            # 7. 互動參與度計算
-            engagement_score = 0
-            follow_up_count = 0
-            context_tokens_added = 0
-            question_depth = 0
-            if RAG_AVAILABLE and results:
-                engagement_json = rag_calculate_engagement(len(self.history)-1, self.history, results[-1])
-                engagement_data = json.loads(engagement_json).get('engagement_analysis', {}) if engagement_json else {}
-                engagement_score = engagement_data.get('engagement_score', 0)
-                follow_up_count = engagement_data.get('follow_up_count', 0)
-                context_tokens_added = engagement_data.get('context_tokens_added', 0)
-                question_depth = engagement_data.get('question_depth', 0)
+                if not getattr(res, "echoed", False):
+                    print(f" >> {res}")
 
+            # 7. 互動參與度計算與 RAG 寫入 (不影響這一輪的回答，交給背景執行緒)
             task_success = True
             force_rag = any(kw in next_input for kw in RAG_FORCE_KEYWORDS)
             failure_rag = any(kw in next_input for kw in RAG_FAILURE_KEYWORDS)
-
-            if RAG_AVAILABLE and task_success and (engagement_score >= RAG_ENGAGEMENT_THRESHOLD or force_rag):
-                rag_store_knowledge(
-                    task_description=next_input,
-                    solution=results[-1] if results else "",
-                    task_type=self.current_theme,
-                    tools_used=[t.get('tool') for t in tasks],
-                    success_metrics={
-                        "engagement_score": engagement_score,
-                        "follow_up_count": follow_up_count,
-                        "context_tokens_added": context_tokens_added,
-                        "question_depth": question_depth
-                    }
-                )
-
-            if RAG_AVAILABLE and failure_rag:
-                rag_store_failure_feedback(
-                    task_description=next_input,
-                    failed_approach=results[-1] if results else "",
-                    error_message="user negative feedback",
-                    correct_solution="(待補充)"
-                )
+            if self.rag_writes is not None and (results or force_rag or failure_rag):
+                # 互動評分只看最近幾輪，spool 不必存整個對話視窗
+                recent = self.history[-RAG_ENGAGEMENT_HISTORY:]
+                self.rag_writes.submit({
+                    "history_index": len(recent) - 1,
+                    "history": recent,
+                    "result": str(results[-1]) if results else None,
+                    "task_description": next_input,
+                    "task_type": self.current_theme,
+                    "tools_used": [t.get('tool') for t in tasks if isinstance(t, dict)],
+                    "store_knowledge": task_success,
+                    "force": force_rag,
+                    "failure": failure_rag
+                })
 
             # 8. 判斷接力
             next_step = plan_data.get("remaining_plan", "")
@@ -302,12 +550,16 @@ class PiAiRelaySystem:
                 continue
             else:
                 self.history.append({"role": "user", "content": next_input})
-                self.history.append({"role": "assistant", "content": f"【{self.current_theme}】執行完畢。"})
+                answer = f"【{self.current_theme}】執行完畢。"
+                self.history.append({"role": "assistant", "content": answer})
                 self.save_history()
-                break
-        return True
+                return answer
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--batch"]:
+        # python3 chatcall.py --batch requests.jsonl [--out results.jsonl]
+        from llm_runtime.batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:], PiAiRelaySystem))
     relay = PiAiRelaySystem()
     query = " ".join(sys.argv[1:]) if len(sys.argv) > 1 else input("需求 > ")
     if query: relay.run_relay(query)
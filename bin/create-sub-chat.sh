@@ -18,6 +18,7 @@ function create_subchat {
    local orig_rag_data=`realpath rag_data`
    local orig_models=`realpath models`
    local orig_llm_call_tool=`realpath llm_call_tools`
+   local orig_llm_runtime=`realpath llm_runtime`
    local orig_addons=`realpath addons`
    local orig_chatcall_py=`realpath chatcall.py`
    local orig_ai_config_common_py=`realpath ai_config_common.py`
@@ -38,6 +39,9 @@ function create_subchat {
    if [ ! -e "llm_call_tools" ]; then
       ln -s "${orig_llm_call_tool}" llm_call_tools
    fi
+   if [ ! -e "llm_runtime" ]; then
+      ln -s "${orig_llm_runtime}" llm_runtime
+   fi
    if [ ! -e "addons" ]; then
       ln -s "${orig_addons}" addons
    fi
@@ -80,8 +84,20 @@ function chat {
       fi
       CURRENT_AI_CHATID=`cat .info/chatid | tr -d "\n"`
    fi
+   # 模型常駐在共用 daemon，chatcall.py 不必每則訊息重新載入
+   start_llm_daemon
    python3 chatcall.py $@
 }
+function start_llm_daemon {
+   python3 -m llm_runtime.daemon start >/dev/null 2>&1
+}
+function stop_llm_daemon {
+   python3 -m llm_runtime.daemon stop
+}
+function llm_daemon_status {
+   # 已載入的模型與排程狀態 (各聊天室的佇列、使用者累計使用秒數)
+   python3 -m llm_runtime.daemon status
+}
 
 function _start_new_chat_complete {
    local cur=${COMP_WORDS[COMP_CWORD]}
@@ -102,6 +118,12 @@ function print_usage {
       start a created chat
    * after started a new chat:
       ${this_script} chat <messages>
+   ${this_script} start_llm_daemon
+      keep models loaded in a shared background daemon
+   ${this_script} stop_llm_daemon
+      stop the shared daemon
+   ${this_script} llm_daemon_status
+      show loaded models and per-chat request queues
 
 EOL
 `
@@ -112,7 +134,7 @@ EOL
 
 function _main_complete {
    local cur=${COMP_WORDS[COMP_CWORD]}
-   COMPREPLY=( $(compgen -W "create_subchat start_new_chat chat" -- $cur) )
+   COMPREPLY=( $(compgen -W "create_subchat start_new_chat chat start_llm_daemon stop_llm_daemon llm_daemon_status" -- $cur) )
    return 0
 }
 
@@ -127,6 +149,15 @@ function main {
    "chat")
       chat "$2"
       ;;
+   "start_llm_daemon")
+      start_llm_daemon
+      ;;
+   "stop_llm_daemon")
+      stop_llm_daemon
+      ;;
+   "llm_daemon_status")
+      llm_daemon_status
+      ;;
 
    *)
       print_usage
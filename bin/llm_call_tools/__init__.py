@@ -3,11 +3,13 @@ LLM Call Tools - Modular tool system for LLM function calling.
 
 This package automatically imports all tool modules except the 'sample' directory.
 It also automatically initializes submodules if ai_config is available.
+
+When a tool manifest (see manifest.py) is valid, tools are registered from it and
+each submodule is only imported/initialized on the first call of one of its tools.
 """
 
 import os
 import importlib
-import pkgutil
 import sys
 
 # Import common utilities first
@@ -15,6 +17,14 @@ from .common import (
     register_ai_tool,
     get_tool_names
 )
+from .manifest import (
+    ModuleLoader,
+    source_stamp,
+    load_manifest,
+    save_manifest,
+    tools_from_registry,
+    register_from_manifest
+)
 
 # Try to import configuration
 _config = None
@@ -34,25 +44,61 @@ except ImportError as e:
 
 # Auto-import all submodules except 'sample' and initialize them
 _current_dir = os.path.dirname(__file__)
-_ignore_modules = {'sample', 'common', "git_tool"}
-
-for finder, name, ispkg in pkgutil.iter_modules([_current_dir]):
-    if name not in _ignore_modules:
-        try:
-            # Import the module
-            module = importlib.import_module(f'.{name}', package=__name__)
-            
-            # Try to initialize the module if config is available
-            if _config:
-                # Check for module-specific initialization function
-                if hasattr(module, 'initialize'):
-                   try:
-                       module.initialize(_config)
-                   except Exception as e:
-                       print(f"Warning: {name} initialization failed: {e}", flush=True, file=sys.stderr)
-        except Exception as e:
-            # Print warning but don't fail if a module can't be imported
-            print(f"Warning: Failed to import llm_call_tools.{name}: {e}", flush=True, file=sys.stderr)
+_ignore_modules = {'sample', 'common', 'manifest', "git_tool"}
+
+
+def _import_tool_module(name):
+    """Import a tool submodule (registers its tools) and run its initialize(_config); returns False on import failure."""
+    try:
+        # Import the module
+        module = importlib.import_module(f'.{name}', package=__name__)
+
+        # Try to initialize the module if config is available
+        if _config:
+            # Check for module-specific initialization function
+            if hasattr(module, 'initialize'):
+               try:
+                   module.initialize(_config)
+               except Exception as e:
+                   print(f"Warning: {name} initialization failed: {e}", flush=True, file=sys.stderr)
+    except Exception as e:
+        # Print warning but don't fail if a module can't be imported
+        print(f"Warning: Failed to import llm_call_tools.{name}: {e}", flush=True, file=sys.stderr)
+        return False
+    return True
+
+
+def _list_tool_modules():
+    """Same result as pkgutil.iter_modules for this directory, without importing pkgutil (cold start)."""
+    names = []
+    for entry in sorted(os.scandir(_current_dir), key=lambda e: e.name):
+        if entry.is_dir():
+            if entry.name.isidentifier() and os.path.exists(os.path.join(entry.path, "__init__.py")):
+                names.append(entry.name)
+        elif entry.name.endswith(".py") and entry.name != "__init__.py" and entry.name[:-3].isidentifier():
+            names.append(entry.name[:-3])
+    return [name for name in names if name not in _ignore_modules]
+
+
+_tool_modules = _list_tool_modules()
+_load_module = ModuleLoader(_import_tool_module)
+
+# manifest 有效時只註冊佔位工具，模組在第一次 execute_tool 才 import
+_manifest_enabled = getattr(_config, "TOOL_MANIFEST_ENABLED", True) and not os.environ.get("PI_AI_EAGER_TOOLS")
+_manifest_file = getattr(_config, "TOOL_MANIFEST_FILE", os.path.join(".pi_ai_cache", "tool_manifest.json"))
+_manifest_tools = None
+if _manifest_enabled:
+    _stamp = source_stamp(_current_dir, _tool_modules)
+    _manifest_tools = load_manifest(_manifest_file, _stamp)
+
+if _manifest_tools is not None:
+    register_from_manifest(_manifest_tools, _load_module)
+else:
+    for name in _tool_modules:
+        _load_module(name)
+    # 有模組 import 失敗時不寫 manifest，下次啟動再完整重試
+    if _manifest_enabled and not _load_module.failed:
+        save_manifest(_manifest_file, _stamp, tools_from_registry(__name__))
 
 __all__ = [
     'get_tool_names',
@@ -1,24 +1,41 @@
 import json
-from typing import Dict, Any, Callable, List, Optional
+from typing import Dict, Any, Callable, List, Optional, Set
 
 # 擴展工具字典，包含描述與標籤
 TOOLS_LIST: Dict[str, Callable] = {}
 TOOLS_PROMPT: Dict[str, str] = {}
 TOOLS_TAGS: Dict[str, List[str]] = {} # 新增：存放工具的標籤
+TOOLS_SIDE_EFFECT_FREE: Set[str] = set() # 不寫檔、不改 sys_inst 的工具，可與其他任務並行
+TOOLS_EARLY_DISPATCH: Set[str] = set() # 只讀檔、不呼叫模型的工具，架構師還在生成時就可先執行
 
-def register_ai_tool(name: str, prompt: Optional[str] = None, tags: Optional[List[str]] = None):
+def register_ai_tool(name: str, prompt: Optional[str] = None, tags: Optional[List[str]] = None,
+                     side_effect_free: bool = False, early_dispatch: bool = False):
     """
     擴展版裝飾器：註冊 AI 工具
     :param tags: 該工具擅長的領域，如 ["file", "analysis", "rag"]
+    :param side_effect_free: 工具不寫檔、不修改 sys_inst (如 context)，規劃中的任務可並行執行
+    :param early_dispatch: 工具只做讀檔等 I/O、不呼叫模型，最多只設定 sys_inst.context；
+                           規劃開頭的這類任務在架構師還在生成時就先執行 (規劃作廢時 context 會還原)
     """
     def decorator(func: Callable):
         TOOLS_LIST[name] = func
         if prompt:
             TOOLS_PROMPT[name] = prompt
         TOOLS_TAGS[name] = tags if tags else []
+        for flag, names in ((side_effect_free, TOOLS_SIDE_EFFECT_FREE), (early_dispatch, TOOLS_EARLY_DISPATCH)):
+            if flag:
+                names.add(name)
+            else:
+                names.discard(name)
         return func
     return decorator
 
+def is_side_effect_free(name: str) -> bool:
+    return name in TOOLS_SIDE_EFFECT_FREE
+
+def is_early_dispatch(name: str) -> bool:
+    return name in TOOLS_EARLY_DISPATCH
+
 def get_weighted_tool_prompts(query_tags: List[str] = None) -> str:
     """
     根據查詢標籤動態生成加權後的工具說明
@@ -2,7 +2,32 @@ import os
 import sys
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from ..common import register_ai_tool
+
+# 大檔案分段分析 (map-reduce) 的設定，initialize() 時由 ai_config 覆蓋
+CHUNK_TRIGGER_TOKENS = 3072
+CHUNK_MAX_TOKENS = 1536
+CHUNK_MAP_N_TOKENS = 512
+CHUNK_REDUCE_N_TOKENS = 1024
+
+def initialize(config):
+    global CHUNK_TRIGGER_TOKENS, CHUNK_MAX_TOKENS, CHUNK_MAP_N_TOKENS, CHUNK_REDUCE_N_TOKENS
+    CHUNK_TRIGGER_TOKENS = getattr(config, "CHUNK_TRIGGER_TOKENS", CHUNK_TRIGGER_TOKENS)
+    CHUNK_MAX_TOKENS = getattr(config, "CHUNK_MAX_TOKENS", CHUNK_MAX_TOKENS)
+    CHUNK_MAP_N_TOKENS = getattr(config, "CHUNK_MAP_N_TOKENS", CHUNK_MAP_N_TOKENS)
+    CHUNK_REDUCE_N_TOKENS = getattr(config, "CHUNK_REDUCE_N_TOKENS", CHUNK_REDUCE_N_TOKENS)
+
+def count_tokens(sys_inst, text, model_key="coder"):
+    if hasattr(sys_inst, "count_tokens"):
+        return sys_inst.count_tokens(model_key, text)
+    return max(1, len(text) // 3)
+
+def trace_span(sys_inst, name, **attrs):
+    tracer = getattr(sys_inst, "tracer", None)
+    return tracer.span(name, **attrs) if tracer is not None else nullcontext(attrs)
+
 def get_possible_request(p,sys_inst,possibleKeys={}):
     content=""
     if sys_inst.context:
@@ -44,13 +69,15 @@ def repair_and_parse_json(raw_text):
 @register_ai_tool(
    "text_reader",
    "單純讀取檔案作為系統Context，如果有工具的目標是讀取文字，但分析的內容還沒載入，應優先執行text_reader",
-   ['reader','text']
+   ['reader','text'],
+   early_dispatch=True
 )
 def handle_text_reader(p: dict, sys_inst):
     """讀取檔案內容並存入系統 Context"""
     print(f'dump={json.dumps(p)}')
     possibleKeys={"file_path", "filename", "target", "file"}
-    fname = get_possible_request(p,sys_inst,possibleKeys)
+    # context 可能已有 RAG/待辦區段，參數有給檔名時優先使用
+    fname = next((p[k] for k in possibleKeys if p.get(k)), "") or get_possible_request(p,sys_inst,possibleKeys)
     if not fname:
         return "[-] 錯誤: text_reader 缺少檔案路徑。"
 
@@ -59,6 +86,10 @@ def handle_text_reader(p: dict, sys_inst):
             with open(fname, 'r', encoding='utf-8') as f:
                 content = f.read()
                 sys_inst.context = content
+            tokens = count_tokens(sys_inst, content)
+            if tokens > CHUNK_TRIGGER_TOKENS:
+                return (f"【讀取成功】檔案: {fname} (共 {len(content)} 字元，約 {tokens} tokens)，內容已載入背景 Context；"
+                        f"超過 {CHUNK_TRIGGER_TOKENS} tokens，code_analyzer 會分段分析。")
             return f"【讀取成功】檔案: {fname} (共 {len(content)} 字元)，內容已載入背景 Context。"
         except Exception as e:
             return f"【讀取失敗】讀取過程發生錯誤: {str(e)}"
@@ -67,7 +98,8 @@ def handle_text_reader(p: dict, sys_inst):
 @register_ai_tool(
     "code_analyzer",
     "分析程式邏輯，code_analyzer的輸入只能是程式內容，如果是檔案請優先跑過text_reader",
-    ["analyzer","source","code"]
+    ["analyzer","source","code"],
+    side_effect_free=True
 )
 def handle_code_analyzer(p: dict, sys_inst):
     """分析 Context 中的代碼邏輯"""
@@ -77,12 +109,69 @@ def handle_code_analyzer(p: dict, sys_inst):
     if not content:
         return "[-] 錯誤: 無可供分析的代碼內容。"
 
-    prompt = f"請專業地分析以下代碼邏輯，並指出潛在問題或關鍵點：\n\n{content}"
     sys_msg = "你是一個資深工程師，請用繁體中文提供簡潔且具備技術深度的分析。"
+    # context 組裝時可能已截斷檔案，分段分析要用完整的檔案內容
+    assembler = getattr(sys_inst, "context_assembler", None)
+    source = (assembler.get("file") if assembler is not None else "") or content
+    if count_tokens(sys_inst, source) > CHUNK_TRIGGER_TOKENS:
+        return f"【代碼分析結果】\n{analyze_in_chunks(source, sys_inst, sys_msg)}"
+
+    prompt = f"請專業地分析以下代碼邏輯，並指出潛在問題或關鍵點：\n\n{content}"
     analysis = sys_inst.call_llm("coder", prompt, system_prompt=sys_msg)
     return f"【代碼分析結果】\n{analysis}"
 
 
+def analyze_in_chunks(source, sys_inst, sys_msg):
+    """
+    依函式/類別邊界切段各自分析 (map)，再整合成一份 (reduce)。
+    map 的提示只含該段程式碼 (不含檔名、行號)，低溫度呼叫會進回應快取，
+    檔案修改後重新分析時，內容沒變的段落直接命中快取。
+    """
+    from llm_runtime.chunking import split_code
+    chunks = split_code(source, CHUNK_MAX_TOKENS, lambda text: count_tokens(sys_inst, text))
+    # 可同時處理多個請求的後端 (llama-server 的 slot) 才並行
+    workers = max(1, min(len(chunks), getattr(getattr(sys_inst, "backend", None), "max_concurrency", 1)))
+    print(f"[*] 檔案約 {count_tokens(sys_inst, source)} tokens，分成 {len(chunks)} 段分析 (並行 {workers})", flush=True)
+
+    def analyze(chunk):
+        prompt = f"以下是一個較大程式檔中的一段。請分析這段代碼的邏輯，條列潛在問題與關鍵點，保持精簡：\n\n{chunk['text']}"
+        res = sys_inst.call_llm("coder", prompt, system_prompt=sys_msg, n_tokens=CHUNK_MAP_N_TOKENS)
+        # 並行時整行一次寫入避免交錯
+        print(f"[*] 第 {chunk['start_line']}-{chunk['end_line']} 行分析完成\n", end="", flush=True)
+        return f"[第 {chunk['start_line']}-{chunk['end_line']} 行]\n{res.strip()}"
+
+    with trace_span(sys_inst, "chunk_map", chunks=len(chunks), workers=workers):
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk") as pool:
+                partials = list(pool.map(analyze, chunks))
+        else:
+            partials = [analyze(c) for c in chunks]
+    if len(partials) == 1:
+        return partials[0]
+
+    with trace_span(sys_inst, "chunk_reduce", partials=len(partials)):
+        # 部分結果太多時分組逐層整合，每次整合的輸入不超過 CHUNK_MAX_TOKENS
+        while len(partials) > 1:
+            groups, current = [], []
+            for part in partials:
+                if current and count_tokens(sys_inst, "\n\n".join(current + [part])) > CHUNK_MAX_TOKENS:
+                    groups.append(current)
+                    current = []
+                current.append(part)
+            groups.append(current)
+            if len(groups) == len(partials):
+                groups = [partials]  # 每段都大到無法分組，直接一次整合
+            partials = [reduce_analyses(group, sys_inst, sys_msg) if len(group) > 1 else group[0] for group in groups]
+    return partials[0]
+
+
+def reduce_analyses(parts, sys_inst, sys_msg):
+    joined = "\n\n".join(parts)
+    prompt = ("以下是同一個程式檔各段的分析結果。請整合成一份完整的分析：先概述整體結構與邏輯，"
+              f"再列出最重要的潛在問題 (註明行號範圍)，去除重複：\n\n{joined}")
+    return sys_inst.call_llm("coder", prompt, system_prompt=sys_msg, n_tokens=CHUNK_REDUCE_N_TOKENS)
+
+
 def repair_and_parse_json(raw_text):
     """
     針對小模型生成的截斷 JSON 進行修復。
@@ -184,6 +273,13 @@ def handle_chatter(p: dict, sys_inst):
 
     prompt = f"{content}"
     sys_msg = "你是一個資深工程師，請用繁體中文提供對話內容。你絕對不會回應口水，不會無限的重複"
-    res = sys_inst.call_llm("chatter", prompt, system_prompt=sys_msg)
-    return f"{res}"
+    # 邊生成邊輸出到終端，第一個 token 出來就看得到
+    print(" >> ", end="", flush=True)
+    res = sys_inst.call_llm("chatter", prompt, system_prompt=sys_msg, stream_to=sys.stdout)
+    if not getattr(res, "echoed", False):
+        # 失敗時 call_llm 回傳一般的 "Error: ..." 字串：接在已印出的 >> 後面，呼叫端不再加前綴
+        from llm_runtime.streaming import EchoedText
+        print(res, flush=True)
+        res = EchoedText(res)
+    return res
 
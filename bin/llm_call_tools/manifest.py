@@ -0,0 +1,128 @@
+"""
+工具清單快取 (manifest)。
+
+每則訊息都是一個新的 python 行程 (create-sub-chat.sh)，原本啟動時要 import 所有工具子模組
+並執行 initialize()；在 SD 卡的 Pi 上這是冷啟動的一大段時間。
+
+第一次啟動照舊 import 全部模組，並把每個工具的名稱、說明、標籤、side_effect_free、early_dispatch 與所屬模組
+寫成 manifest；之後只要子模組的檔案 mtime/大小沒變，就直接由 manifest 註冊 LazyTool，
+真正的模組等到第一次 execute_tool 才 import (並執行 initialize)。
+"""
+
+import json
+import os
+import threading
+
+from .common import TOOLS_LIST, TOOLS_PROMPT, TOOLS_TAGS, TOOLS_SIDE_EFFECT_FREE, TOOLS_EARLY_DISPATCH
+
+MANIFEST_VERSION = 2
+
+
+def source_stamp(package_dir, module_names):
+    """common.py 與各子模組所有 .py 檔的 [mtime_ns, 大小]，任一改變 manifest 即失效"""
+    files = [os.path.join(package_dir, "__init__.py"), os.path.join(package_dir, "common.py")]
+    for name in module_names:
+        path = os.path.join(package_dir, name)
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+                files.extend(os.path.join(root, f) for f in sorted(names) if f.endswith(".py"))
+        else:
+            files.append(path + ".py")
+    stamp = {}
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        stamp[os.path.relpath(f, package_dir)] = [st.st_mtime_ns, st.st_size]
+    return stamp
+
+
+def load_manifest(path, stamp):
+    """回傳 {tool: {...}}；檔案不存在、版本不同或來源檔有變動時回傳 None"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != MANIFEST_VERSION or data.get("stamp") != stamp:
+        return None
+    return data.get("tools")
+
+
+def save_manifest(path, stamp, tools):
+    directory = os.path.dirname(path) or "."
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # 不用 tempfile：這個模組在每次冷啟動都會 import，能少載入一個模組就少一個
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "stamp": stamp, "tools": tools}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+    except OSError:
+        pass  # 寫不進去 (例如唯讀目錄) 就每次完整 import
+
+
+def tools_from_registry(package_name):
+    """由目前已註冊的工具產生 manifest 內容"""
+    tools = {}
+    for name, func in TOOLS_LIST.items():
+        module = getattr(func, "__module__", "") or ""
+        if not module.startswith(package_name + "."):
+            continue
+        tools[name] = {
+            "module": module[len(package_name) + 1:].split(".")[0],
+            "prompt": TOOLS_PROMPT.get(name),
+            "tags": TOOLS_TAGS.get(name, []),
+            "side_effect_free": name in TOOLS_SIDE_EFFECT_FREE,
+            "early_dispatch": name in TOOLS_EARLY_DISPATCH
+        }
+    return tools
+
+
+class LazyTool:
+    """manifest 註冊的佔位工具；第一次呼叫時才 import 所屬模組，模組會以真正的函式覆蓋 TOOLS_LIST"""
+
+    def __init__(self, name, module, importer):
+        self.name = name
+        self.module = module
+        self._importer = importer
+
+    def __call__(self, params, sys_inst):
+        self._importer(self.module)
+        func = TOOLS_LIST.get(self.name)
+        if func is None or isinstance(func, LazyTool):
+            return f"[-] 錯誤: 工具 '{self.name}' 在模組 {self.module} 中找不到。"
+        return func(params, sys_inst)
+
+
+def register_from_manifest(tools, importer):
+    for name, info in tools.items():
+        TOOLS_LIST[name] = LazyTool(name, info["module"], importer)
+        if info.get("prompt"):
+            TOOLS_PROMPT[name] = info["prompt"]
+        TOOLS_TAGS[name] = info.get("tags") or []
+        for key, names in (("side_effect_free", TOOLS_SIDE_EFFECT_FREE), ("early_dispatch", TOOLS_EARLY_DISPATCH)):
+            if info.get(key):
+                names.add(name)
+            else:
+                names.discard(name)
+
+
+class ModuleLoader:
+    """確保每個子模組只 import/initialize 一次 (並行的 DAG 任務可能同時觸發)"""
+
+    def __init__(self, import_module):
+        self._import_module = import_module
+        self._loaded = set()
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        with self._lock:
+            if name in self._loaded:
+                return
+            if self._import_module(name) is False:
+                self.failed.add(name)
+            self._loaded.add(name)
@@ -2,24 +2,57 @@ import os
 import re
 from ..common import register_ai_tool
 
+# 目錄樹的上限與忽略清單，initialize() 時由 ai_config 覆蓋
+PROJECT_TREE_MAX_DEPTH = 4
+PROJECT_TREE_MAX_ENTRIES = 400
+PROJECT_TREE_IGNORE = [".git/", "__pycache__/", ".pi_ai_cache/", "node_modules/", ".venv/", "venv/",
+                       "models/", "llama.bin/", "rag_data/", "*.gguf"]
+PROJECT_TREE_CACHE = None
+# code_searcher 的專案索引
+CODE_INDEX_DIR = os.path.join(".pi_ai_cache", "code_index")
+CODE_INDEX_CHUNK_LINES = 40
+CODE_INDEX_MAX_FILE_KB = 512
+CODE_SEARCH_LIMIT = 8
+# code_modifier：edit = 只輸出 SEARCH/REPLACE 區塊，rewrite = 重新輸出整個檔案
+CODE_MODIFIER_MODE = "edit"
+CODE_EDIT_N_TOKENS = 1024
+CODE_EDIT_RETRIES = 1
+CODE_EDIT_FUZZY_THRESHOLD = 0.9
+
+def initialize(config):
+    global PROJECT_TREE_MAX_DEPTH, PROJECT_TREE_MAX_ENTRIES, PROJECT_TREE_IGNORE, PROJECT_TREE_CACHE
+    global CODE_INDEX_DIR, CODE_INDEX_CHUNK_LINES, CODE_INDEX_MAX_FILE_KB, CODE_SEARCH_LIMIT
+    global CODE_MODIFIER_MODE, CODE_EDIT_N_TOKENS, CODE_EDIT_RETRIES, CODE_EDIT_FUZZY_THRESHOLD
+    PROJECT_TREE_MAX_DEPTH = getattr(config, "PROJECT_TREE_MAX_DEPTH", PROJECT_TREE_MAX_DEPTH)
+    PROJECT_TREE_MAX_ENTRIES = getattr(config, "PROJECT_TREE_MAX_ENTRIES", PROJECT_TREE_MAX_ENTRIES)
+    PROJECT_TREE_IGNORE = getattr(config, "PROJECT_TREE_IGNORE", PROJECT_TREE_IGNORE)
+    PROJECT_TREE_CACHE = getattr(config, "PROJECT_TREE_CACHE", PROJECT_TREE_CACHE)
+    CODE_INDEX_DIR = getattr(config, "CODE_INDEX_DIR", CODE_INDEX_DIR)
+    CODE_INDEX_CHUNK_LINES = getattr(config, "CODE_INDEX_CHUNK_LINES", CODE_INDEX_CHUNK_LINES)
+    CODE_INDEX_MAX_FILE_KB = getattr(config, "CODE_INDEX_MAX_FILE_KB", CODE_INDEX_MAX_FILE_KB)
+    CODE_SEARCH_LIMIT = getattr(config, "CODE_SEARCH_LIMIT", CODE_SEARCH_LIMIT)
+    CODE_MODIFIER_MODE = getattr(config, "CODE_MODIFIER_MODE", CODE_MODIFIER_MODE)
+    CODE_EDIT_N_TOKENS = getattr(config, "CODE_EDIT_N_TOKENS", CODE_EDIT_N_TOKENS)
+    CODE_EDIT_RETRIES = getattr(config, "CODE_EDIT_RETRIES", CODE_EDIT_RETRIES)
+    CODE_EDIT_FUZZY_THRESHOLD = getattr(config, "CODE_EDIT_FUZZY_THRESHOLD", CODE_EDIT_FUZZY_THRESHOLD)
+
 @register_ai_tool(
     "project_reader",
-    "讀取專案目錄結構或檔案內容，支援 path 參數指定目錄或檔案。",
-    ["project", "reader", "file"]
+    "讀取專案目錄結構或檔案內容，支援 path 參數指定目錄或檔案，max_depth 指定目錄深度。",
+    ["project", "reader", "file"],
+    side_effect_free=True,
+    early_dispatch=True
 )
 def handle_project_reader(params, sys_inst):
     path = params.get("path", ".")
     max_lines = int(params.get("max_lines", 50))
     if os.path.isdir(path):
-        tree = []
-        for root, dirs, files in os.walk(path):
-            level = root.replace(path, '').count(os.sep)
-            indent = '    ' * level
-            tree.append(f"{indent}{os.path.basename(root)}/")
-            subindent = '    ' * (level + 1)
-            for f in files:
-                tree.append(f"{subindent}{f}")
-        return "\n".join(tree)
+        # 遵守 .gitignore 與忽略清單，有深度/項目上限，目錄列表依 mtime 快取
+        from llm_runtime.project_tree import ProjectTree
+        max_depth = int(params.get("max_depth", PROJECT_TREE_MAX_DEPTH))
+        max_entries = int(params.get("max_entries", PROJECT_TREE_MAX_ENTRIES))
+        tree = ProjectTree(path, PROJECT_TREE_IGNORE, PROJECT_TREE_CACHE)
+        return tree.render(max_depth, max_entries)
     elif os.path.isfile(path):
         with open(path, 'r', encoding='utf-8', errors='ignore') as f:
             lines = f.readlines()
@@ -30,16 +63,70 @@ def handle_project_reader(params, sys_inst):
 
 @register_ai_tool(
     "code_searcher",
-    "根據關鍵字搜尋程式片段，支援 file 與 keyword 參數。",
-    ["search", "code", "project"]
+    "在整個專案中搜尋程式片段：keyword 為關鍵字 (空白分隔，全部符合)，symbol 為函式/類別名稱，可用 file 限定檔案、path 指定專案根目錄。",
+    ["search", "code", "project"],
+    side_effect_free=True,
+    early_dispatch=True
 )
 def handle_code_searcher(params, sys_inst):
     file = params.get("file")
-    keyword = params.get("keyword")
-    if not file or not keyword:
-        return "[-] code_searcher: 缺少 file 或 keyword 參數。"
-    if not os.path.isfile(file):
+    # LLM 產生的參數可能是空白或非字串
+    keyword = str(params.get("keyword") or params.get("query") or "").strip()
+    symbol = str(params.get("symbol") or "").strip()
+    if not keyword and not symbol:
+        return "[-] code_searcher: 缺少 keyword 或 symbol 參數。"
+    if file and not os.path.isfile(file):
         return f"[-] code_searcher: 找不到檔案 {file}"
+    root = params.get("path") or "."
+    rel = None
+    if file:
+        rel = os.path.relpath(os.path.realpath(file), os.path.realpath(root))
+        if rel.startswith(".."):
+            root, rel = os.path.dirname(os.path.realpath(file)), os.path.basename(file)
+    try:
+        limit = int(params.get("limit", CODE_SEARCH_LIMIT))
+    except (TypeError, ValueError):
+        limit = CODE_SEARCH_LIMIT
+
+    index = open_code_index(root)
+    try:
+        return search_index(index, file, rel, keyword, symbol, limit)
+    finally:
+        index.close()
+
+def search_index(index, file, rel, keyword, symbol, limit):
+    stats = index.update()
+    header = f"(索引 {stats['files']} 個檔案，更新 {stats['updated']} 個，{stats['ms']:.0f} ms)"
+    out = []
+    definitions = index.find_symbol(symbol or keyword.split()[0], limit=limit)
+    if not symbol:
+        # 關鍵字搜尋時只列出名稱完全相同的定義
+        definitions = [d for d in definitions if d["name"].lower() == keyword.split()[0].lower()]
+    if rel is not None:
+        definitions = [d for d in definitions if d["path"] == rel]
+    for d in definitions:
+        out.append(f"[定義] {d['path']}:{d['line']} {d['kind']} {d['name']}")
+    snippets = index.search(keyword, limit=limit, path=rel) if keyword else []
+    for r in snippets:
+        body = "\n".join(f"{n:>5}: {line}" for n, line in r["lines"])
+        out.append(f"{r['path']}:{r['start_line']}-{r['end_line']}\n{body}")
+    if out:
+        return f"【搜尋結果】共 {len(definitions)} 個定義、{len(snippets)} 段 {header}\n" + "\n---\n".join(out)
+    if file and keyword and index.find_file(rel) is None:
+        # 被 .gitignore 排除或太大而沒有索引的檔案，直接掃描
+        return search_file(file, keyword)
+    return f"[-] code_searcher: 未找到 {keyword or symbol} {header}"
+
+def open_code_index(root):
+    """每個專案根目錄一個索引資料庫，放在 CODE_INDEX_DIR"""
+    import hashlib
+    from llm_runtime.code_index import CodeIndex
+    real = os.path.realpath(root)
+    db_path = os.path.join(CODE_INDEX_DIR, hashlib.sha1(real.encode("utf-8")).hexdigest()[:16] + ".db")
+    return CodeIndex(real, db_path, ignore=PROJECT_TREE_IGNORE, tree_cache=PROJECT_TREE_CACHE,
+                     chunk_lines=CODE_INDEX_CHUNK_LINES, max_file_bytes=CODE_INDEX_MAX_FILE_KB * 1024)
+
+def search_file(file, keyword):
     with open(file, 'r', encoding='utf-8', errors='ignore') as f:
         content = f.read()
     # 搜尋所有包含 keyword 的程式片段（以函式/類別為單位）
@@ -55,7 +142,7 @@ def handle_code_searcher(params, sys_inst):
 
 @register_ai_tool(
     "code_modifier",
-    "根據需求自動修改程式碼，支援 file 與 instruction 參數。",
+    "根據需求自動修改程式碼，支援 file 與 instruction 參數；預設只讓模型輸出要修改的區塊 (mode=rewrite 則重寫整個檔案)。",
     ["modify", "code", "project"]
 )
 def handle_code_modifier(params, sys_inst):
@@ -67,6 +154,57 @@ def handle_code_modifier(params, sys_inst):
         return f"[-] code_modifier: 找不到檔案 {file}"
     with open(file, 'r', encoding='utf-8', errors='ignore') as f:
         original_code = f.read()
+    if params.get("mode", CODE_MODIFIER_MODE) == "rewrite":
+        return rewrite_file(file, instruction, original_code, sys_inst)
+    return edit_file(file, instruction, original_code, sys_inst)
+
+EDIT_SYS_MSG = """你是一個專業工程師。只輸出要修改的地方，每一處用以下格式：
+<<<<<<< SEARCH
+(從原始程式碼照抄要被取代的連續幾行，包含足夠上下文使其唯一)
+=======
+(取代後的內容)
+>>>>>>> REPLACE
+可以有多個區塊。不要輸出整個檔案，不要解釋。"""
+
+def edit_file(file, instruction, original_code, sys_inst):
+    """模型只輸出 SEARCH/REPLACE 區塊 (或 unified diff)，套用、檢查後原子寫入"""
+    from llm_runtime.edits import parse_edits, apply_edits, validate, atomic_write, EditError
+    prompt = f"請根據以下需求修改程式碼：\n需求：{instruction}\n檔案：{file}\n原始程式碼：\n{original_code}"
+    error = None
+    for attempt in range(1 + CODE_EDIT_RETRIES):
+        if error:
+            # 把失敗原因告訴模型再試一次
+            prompt_now = f"{prompt}\n\n上一次的修改無法套用：{error}\n請重新輸出正確的 SEARCH/REPLACE 區塊。"
+        else:
+            prompt_now = prompt
+        reply = sys_inst.call_llm("coder", prompt_now, system_prompt=EDIT_SYS_MSG, n_tokens=CODE_EDIT_N_TOKENS, temp=0.2)
+        try:
+            new_code, methods = apply_edits(original_code, parse_edits(reply), CODE_EDIT_FUZZY_THRESHOLD)
+        except EditError as e:
+            error = str(e)
+            continue
+        if new_code == original_code:
+            error = "修改後內容與原檔相同。"
+            continue
+        error = validate(file, new_code)
+        if error:
+            continue
+        atomic_write(file, new_code)
+        fuzzy = sum(1 for m in methods if m != "exact")
+        note = f"，其中 {fuzzy} 處以模糊比對定位" if fuzzy else ""
+        return f"【程式碼修改成功】已套用 {len(methods)} 處修改至 {file}{note}。\n" + unified_preview(file, original_code, new_code)
+    return f"[-] code_modifier: 修改未套用 ({error})，檔案未變更。"
+
+def unified_preview(file, old, new, max_lines=40):
+    import difflib
+    diff = list(difflib.unified_diff(old.splitlines(), new.splitlines(), f"a/{file}", f"b/{file}", n=1, lineterm=""))
+    if len(diff) > max_lines:
+        diff = diff[:max_lines] + [f"... (還有 {len(diff) - max_lines} 行)"]
+    return "\n".join(diff)
+
+def rewrite_file(file, instruction, original_code, sys_inst):
+    """舊模式：模型輸出整個修改後的檔案"""
+    from llm_runtime.edits import validate, atomic_write
     prompt = f"請根據以下需求修改程式碼：\n需求：{instruction}\n原始程式碼：\n{original_code}\n請直接輸出修改後完整程式碼，不要解釋。"
     sys_msg = "你是一個專業工程師，請直接輸出修改後完整程式碼。"
     new_code = sys_inst.call_llm("coder", prompt, system_prompt=sys_msg, n_tokens=4096, temp=0.2)
@@ -77,7 +215,9 @@ def handle_code_modifier(params, sys_inst):
         code = match.group(1).strip()
     if len(code) < 10:
         return f"[-] code_modifier: LLM 未產生有效程式碼。原始回應：\n{new_code}"
-    with open(file, 'w', encoding='utf-8') as f:
-        f.write(code)
+    error = validate(file, code)
+    if error:
+        return f"[-] code_modifier: 產生的程式碼未通過檢查 ({error})，檔案未變更。"
+    atomic_write(file, code)
     preview = code[:100].replace('\n', ' ')
     return f"【程式碼修改成功】已寫入至 {file}。預覽：{preview}..."
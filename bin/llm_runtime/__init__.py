@@ -0,0 +1,7 @@
+"""
+LLM Runtime - 推論執行期支援模組。
+
+llm_call_tools 負責「工具」，llm_runtime 則負責「模型」：
+常駐推論 daemon、聊天模板等與模型載入/推論相關的共用程式都放在這裡，
+讓 chatcall.py 與 chatcall2.py 不必各自維護一份。
+"""
@@ -0,0 +1,599 @@
+"""
+推論後端抽象層。
+
+所有後端都實作 LLMBackend.complete()，回傳模型原始生成文字 (未去除雜訊)，
+失敗時拋出例外，由呼叫端 (PiAiRelaySystem.call_llm) 統一轉成 "Error: ..." 字串。
+
+    llama_cpp   本行程內以 llama_cpp_python 推論，模型載入後常駐於本行程
+    subprocess  每次呼叫執行 LLAMA_BIN (llama-completion)
+    server      以 HTTP 連到 llama-server，保持連線池並使用伺服器端 slot
+    daemon      送到 llm_runtime.daemon 常駐 daemon
+    auto        daemon 有在跑就用 daemon，否則退回 LLM_LOCAL_BACKEND
+
+使用哪一個由 ai_config.LLM_BACKEND 決定。
+"""
+
+import codecs
+import http.client
+import json
+import os
+import queue
+import selectors
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台，不做跨行程鎖
+    fcntl = None
+
+from ai_config import (
+    LLAMA_BIN, LLAMA_COMPLETION_LOCK, MODELS,
+    LLM_BACKEND, LLM_LOCAL_BACKEND,
+    LLAMA_SERVER_BIN, LLAMA_SERVER_URLS, LLAMA_SERVER_SLOTS, LLAMA_SERVER_POOL_SIZE,
+    PREFIX_CACHE_MB
+)
+from .common import build_chat_prefix, build_chat_prompt, QWEN_STOP
+from .daemon import daemon_complete, daemon_stream, daemon_count_tokens, DaemonUnavailable
+from .grammar import schema_to_gbnf
+from .model_manager import ModelManager
+from .prefix_cache import PrefixCache, prefix_key
+from .tokenizer import count_tokens
+from .tracing import record_usage
+
+
+def resolve_model_path(model_key):
+    model_path = MODELS.get(model_key)
+    if not model_path or not os.path.exists(model_path):
+        raise FileNotFoundError(f"找不到模型檔案 {model_path}")
+    return model_path
+
+
+class LLMBackend:
+    name = "base"
+    # 後端可同時處理的請求數 (llama-server 的 slot 數)，批次呼叫時參考
+    max_concurrency = 1
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        raise NotImplementedError
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        """逐段產生生成文字；關閉 generator 即停止生成。預設退化成一次回傳全部"""
+        yield self.complete(model_key, prompt, system_prompt, n_tokens, temp, schema)
+
+    def count_tokens(self, model_key, text):
+        """以模型的詞表計算 token 數，無法計算時回傳 None。預設在本行程載入 vocab_only 的模型"""
+        model_path = MODELS.get(model_key)
+        return count_tokens(model_path, text) if model_path else None
+
+    def close(self):
+        pass
+
+
+def _take_draft_stats(llama):
+    """推測解碼的 (猜測 token 數, 被接受數)；沒有啟用時為 (None, None)，不回報"""
+    take = getattr(llama, "take_draft_stats", None)
+    if take is None or getattr(llama, "draft_model", None) is None:
+        return None, None
+    return take()
+
+
+class LlamaCppBackend(LLMBackend):
+    """
+    本行程內的 llama_cpp_python，模型由 ModelManager 依記憶體預算載入/卸載 (daemon 也共用這個類別)。
+    有系統提示時先從 PrefixCache 還原前綴的 KV 狀態，只 prefill 使用者訊息。
+    """
+    name = "llama_cpp"
+
+    def __init__(self, prefix_cache_mb=PREFIX_CACHE_MB, models=None):
+        self._guard = threading.Lock()
+        self._grammars = {}
+        # 模型載入、卸載與 per-model context 設定交給 ModelManager
+        self.models = models or ModelManager()
+        self.prefix_cache = PrefixCache(prefix_cache_mb * 1024 * 1024) if prefix_cache_mb else None
+        if self.prefix_cache is not None:
+            self.models.on_evict.append(self.prefix_cache.drop)
+
+    def load_path(self, model_path):
+        return self.models.load(model_path)
+
+    def grammar_for(self, schema):
+        """Schema 編譯成 LlamaGrammar 後快取 (解析 GBNF 也要時間，daemon 內更是每輪都會用到)"""
+        if not schema:
+            return None
+        gbnf = schema_to_gbnf(schema)
+        with self._guard:
+            if gbnf not in self._grammars:
+                import llama_cpp
+                self._grammars[gbnf] = llama_cpp.LlamaGrammar.from_string(gbnf, verbose=False)
+            return self._grammars[gbnf]
+
+    def get_model(self, model_key):
+        if model_key not in MODELS:
+            raise ValueError(f"Unknown model_key: {model_key}")
+        return self.load_path(resolve_model_path(model_key))
+
+    def _restore_prefix(self, model_path, llama, full_prompt, system_prompt):
+        """還原 (或建立) 系統提示前綴的 KV 快照；之後 llama() 會沿用相同前綴的 token"""
+        if self.prefix_cache is None or not system_prompt:
+            return
+        key = prefix_key(model_path, system_prompt)
+        state = self.prefix_cache.get(key)
+        if state is not None:
+            llama.load_state(state)
+            return
+        # 前綴與完整 prompt 分別 tokenize 後取共同部分，避免邊界 token 合併造成錯位
+        full_tokens = llama.tokenize(full_prompt.encode("utf-8"), special=True)
+        prefix_tokens = llama.tokenize(build_chat_prefix(system_prompt).encode("utf-8"), special=True)
+        n = 0
+        for a, b in zip(prefix_tokens, full_tokens[:-1]):
+            if a != b:
+                break
+            n += 1
+        if n == 0:
+            return
+        llama.reset()
+        llama.eval(full_tokens[:n])
+        self.prefix_cache.put(key, llama.save_state(), model_id=model_path)
+
+    def complete_path(self, model_path, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        model_path = os.path.realpath(model_path)
+        full_prompt = build_chat_prompt(prompt, system_prompt)
+        with self.models.use(model_path) as llama:
+            self._restore_prefix(model_path, llama, full_prompt, system_prompt)
+            _take_draft_stats(llama)  # 清掉上次呼叫中斷時殘留的統計
+            output = llama(
+                full_prompt,
+                max_tokens=n_tokens,
+                temperature=temp,
+                stop=QWEN_STOP,
+                grammar=self.grammar_for(schema),
+                stream=False
+            )
+            draft_tokens, draft_accepted = _take_draft_stats(llama)
+        usage = output.get("usage") or {}
+        record_usage(prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"),
+                     draft_tokens=draft_tokens, draft_accepted=draft_accepted)
+        return output["choices"][0]["text"]
+
+    def stream_path(self, model_path, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        model_path = os.path.realpath(model_path)
+        full_prompt = build_chat_prompt(prompt, system_prompt)
+        with self.models.use(model_path) as llama:
+            self._restore_prefix(model_path, llama, full_prompt, system_prompt)
+            _take_draft_stats(llama)  # 清掉上次呼叫中斷時殘留的統計
+            chunks = llama(
+                full_prompt,
+                max_tokens=n_tokens,
+                temperature=temp,
+                stop=QWEN_STOP,
+                grammar=self.grammar_for(schema),
+                stream=True
+            )
+            generated = 0
+            try:
+                for chunk in chunks:
+                    generated += 1  # 串流模式每個 chunk 是一個 token
+                    text = chunk["choices"][0]["text"]
+                    if text:
+                        yield text
+            finally:
+                chunks.close()
+                draft_tokens, draft_accepted = _take_draft_stats(llama)
+                record_usage(prompt_tokens=len(llama.tokenize(full_prompt.encode("utf-8"), special=True)),
+                             completion_tokens=generated, draft_tokens=draft_tokens, draft_accepted=draft_accepted)
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        if model_key not in MODELS:
+            raise ValueError(f"Unknown model_key: {model_key}")
+        return self.complete_path(resolve_model_path(model_key), prompt, system_prompt, n_tokens, temp, schema)
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        if model_key not in MODELS:
+            raise ValueError(f"Unknown model_key: {model_key}")
+        return self.stream_path(resolve_model_path(model_key), prompt, system_prompt, n_tokens, temp, schema)
+
+    def count_tokens_path(self, model_path, text):
+        return count_tokens(model_path, text)
+
+    def loaded(self):
+        return self.models.loaded()
+
+    def close(self):
+        self.models.close()
+
+
+@contextmanager
+def _exclusive(lock_path):
+    """跨行程 (跨使用者) 的互斥鎖；拿不到鎖檔時不互斥"""
+    if fcntl is None or not lock_path:
+        yield
+        return
+    try:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+    except OSError:
+        yield
+        return
+    try:
+        try:
+            os.fchmod(fd, 0o666)  # 其他使用者的子聊天室也要能開啟
+        except OSError:
+            pass
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # 關閉即釋放 flock
+
+
+class SubprocessBackend(LLMBackend):
+    """
+    每次呼叫啟動一次 llama-completion (模型每次重新載入)。
+    所有行程以 LLAMA_COMPLETION_LOCK 排隊，同一時間只有一個 llama-completion 佔用記憶體，
+    不再以 pkill 砍掉其他聊天室 (或其他使用者) 正在進行的生成；逾時或提早結束時只結束自己的子行程。
+    """
+    name = "subprocess"
+
+    def __init__(self, llama_bin=LLAMA_BIN, timeout=180, lock_path=LLAMA_COMPLETION_LOCK):
+        self.llama_bin = llama_bin
+        self.timeout = timeout
+        self.lock_path = lock_path
+
+    def _command(self, model_key, prompt, system_prompt, n_tokens, temp, schema):
+        model_path = resolve_model_path(model_key)
+        cmd = [
+            self.llama_bin, "-m", model_path, "-st", "--no-display-prompt", "--simple-io",
+            "--temp", str(temp), "-n", str(n_tokens), "-p", prompt
+        ]
+        if system_prompt: cmd.extend(["-sys", system_prompt])
+        if schema: cmd.extend(["--grammar", schema_to_gbnf(schema)])
+        return cmd
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        cmd = self._command(model_key, prompt, system_prompt, n_tokens, temp, schema)
+        with _exclusive(self.lock_path):
+            result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='ignore', timeout=self.timeout)
+        return result.stdout
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        cmd = self._command(model_key, prompt, system_prompt, n_tokens, temp, schema)
+        with _exclusive(self.lock_path):
+            yield from self._stream_process(cmd)
+
+    def _stream_process(self, cmd):
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        deadline = time.time() + self.timeout
+        # 等待輸出時也要檢查逾時：卡住不輸出的 llama-completion 不能無限期佔著 LLAMA_COMPLETION_LOCK
+        fd = proc.stdout.fileno()
+        sel = selectors.DefaultSelector()
+        sel.register(fd, selectors.EVENT_READ)
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not sel.select(remaining):
+                    raise subprocess.TimeoutExpired(cmd, self.timeout)
+                data = os.read(fd, 4096)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+        finally:
+            # 提早關閉 (例如 JSON 已完整) 時直接結束 llama-completion
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            sel.close()
+            proc.stdout.close()
+
+
+class ConnectionPool:
+    """單一 host 的 HTTP keep-alive 連線池"""
+
+    def __init__(self, url, size=LLAMA_SERVER_POOL_SIZE, timeout=180):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request_json(self, method, path, payload=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        # 閒置連線可能已被伺服器關閉，重試一次新連線
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if resp.status >= 400:
+                raise RuntimeError(f"llama-server HTTP {resp.status}: {data[:200].decode('utf-8', 'ignore')}")
+            return json.loads(data.decode("utf-8")) if data else {}
+
+    def stream_events(self, method, path, payload):
+        """送出串流請求，逐一產生 SSE 的 data 物件；提早關閉時該連線不放回連線池"""
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        conn = self._acquire()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+        except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                BrokenPipeError, ConnectionResetError):
+            # 閒置連線失效，換新連線重送一次
+            conn.close()
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+        finished = False
+        try:
+            if resp.status >= 400:
+                raise RuntimeError(f"llama-server HTTP {resp.status}: {resp.read()[:200].decode('utf-8', 'ignore')}")
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data.decode("utf-8"))
+            resp.read()
+            finished = True
+        finally:
+            if finished and not resp.will_close:
+                self._release(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class LlamaServerBackend(LLMBackend):
+    """
+    連到 llama-server (每個 model_key 一個伺服器，見 LLAMA_SERVER_URLS)。
+    每個請求佔用一個伺服器端 slot，多個請求可同時送出，由伺服器做 continuous batching。
+    """
+    name = "server"
+
+    def __init__(self, urls=None, slots=LLAMA_SERVER_SLOTS):
+        self.urls = dict(urls or LLAMA_SERVER_URLS)
+        self.slots = slots
+        self.max_concurrency = slots
+        self._pools = {}
+        self._busy = {}
+        self._affinity = {}
+        self._cond = threading.Condition()
+
+    def _pool(self, model_key):
+        if model_key not in self.urls:
+            raise ValueError(f"LLAMA_SERVER_URLS 沒有設定 {model_key}")
+        with self._cond:
+            if model_key not in self._pools:
+                self._pools[model_key] = ConnectionPool(self.urls[model_key], size=max(LLAMA_SERVER_POOL_SIZE, self.slots))
+                self._busy[model_key] = set()
+            return self._pools[model_key]
+
+    def _take_slot(self, model_key, affinity=None):
+        """優先選上次處理相同系統提示的 slot，伺服器端 (cache_prompt) 的前綴 KV 還在那裡"""
+        with self._cond:
+            while True:
+                busy = self._busy[model_key]
+                preferred = self._affinity.get((model_key, affinity))
+                if preferred is not None and preferred not in busy:
+                    slot = preferred
+                else:
+                    free = [s for s in range(self.slots) if s not in busy]
+                    if not free:
+                        self._cond.wait()
+                        continue
+                    # 優先挑沒有綁定前綴的 slot，減少覆蓋其他前綴的 KV
+                    owned = {v for (k, _), v in self._affinity.items() if k == model_key}
+                    slot = next((s for s in free if s not in owned), free[0])
+                busy.add(slot)
+                if affinity is not None:
+                    for k in [k for k, v in self._affinity.items() if k[0] == model_key and v == slot]:
+                        del self._affinity[k]
+                    self._affinity[(model_key, affinity)] = slot
+                return slot
+
+    def _give_slot(self, model_key, slot):
+        with self._cond:
+            self._busy[model_key].discard(slot)
+            self._cond.notify()
+
+    def _payload(self, prompt, system_prompt, n_tokens, temp, schema):
+        payload = {
+            "prompt": build_chat_prompt(prompt, system_prompt),
+            "n_predict": n_tokens,
+            "temperature": temp,
+            "stop": QWEN_STOP,
+            "cache_prompt": True
+        }
+        if schema: payload["grammar"] = schema_to_gbnf(schema)
+        return payload
+
+    @staticmethod
+    def _record(data):
+        timings = data.get("timings") or {}
+        record_usage(prompt_tokens=data.get("tokens_evaluated"), completion_tokens=data.get("tokens_predicted"),
+                     tokens_per_second=timings.get("predicted_per_second"))
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        pool = self._pool(model_key)
+        payload = self._payload(prompt, system_prompt, n_tokens, temp, schema)
+        slot = self._take_slot(model_key, prefix_key(model_key, system_prompt) if system_prompt else None)
+        try:
+            payload["id_slot"] = slot
+            data = pool.request_json("POST", "/completion", payload)
+        finally:
+            self._give_slot(model_key, slot)
+        self._record(data)
+        return data.get("content", "")
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        pool = self._pool(model_key)
+        payload = self._payload(prompt, system_prompt, n_tokens, temp, schema)
+        payload["stream"] = True
+        slot = self._take_slot(model_key, prefix_key(model_key, system_prompt) if system_prompt else None)
+        events = None
+        try:
+            payload["id_slot"] = slot
+            events = pool.stream_events("POST", "/completion", payload)
+            for event in events:
+                text = event.get("content", "")
+                if text:
+                    yield text
+                if event.get("stop"):
+                    # 最後一個事件帶有 token 數與 timings
+                    self._record(event)
+                    break
+        finally:
+            if events is not None:
+                events.close()
+            self._give_slot(model_key, slot)
+
+    def count_tokens(self, model_key, text):
+        # 伺服器已載入模型，/tokenize 不佔用 slot
+        if not text:
+            return 0
+        try:
+            data = self._pool(model_key).request_json("POST", "/tokenize", {"content": text})
+        except (OSError, ValueError, RuntimeError):
+            return super().count_tokens(model_key, text)
+        return len(data.get("tokens", []))
+
+    def health(self, model_key):
+        return self._pool(model_key).request_json("GET", "/health")
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+
+
+class DaemonBackend(LLMBackend):
+    name = "daemon"
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        return daemon_complete(resolve_model_path(model_key), prompt, system_prompt, n_tokens, temp, schema)
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        return daemon_stream(resolve_model_path(model_key), prompt, system_prompt, n_tokens, temp, schema)
+
+    def count_tokens(self, model_key, text):
+        return daemon_count_tokens(resolve_model_path(model_key), text)
+
+
+class AutoBackend(LLMBackend):
+    """daemon 有在跑就交給 daemon，否則使用本地後端"""
+    name = "auto"
+
+    def __init__(self, local):
+        self.daemon = DaemonBackend()
+        self.local = local
+
+    def complete(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        try:
+            return self.daemon.complete(model_key, prompt, system_prompt, n_tokens, temp, schema)
+        except DaemonUnavailable:
+            return self.local.complete(model_key, prompt, system_prompt, n_tokens, temp, schema)
+
+    def stream(self, model_key, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None):
+        # daemon_stream 在建立時就連線，daemon 不在會立即拋出 DaemonUnavailable
+        try:
+            return self.daemon.stream(model_key, prompt, system_prompt, n_tokens, temp, schema)
+        except DaemonUnavailable:
+            return self.local.stream(model_key, prompt, system_prompt, n_tokens, temp, schema)
+
+    def count_tokens(self, model_key, text):
+        # daemon 的詞表常駐，本行程就不必再載入一次
+        try:
+            return self.daemon.count_tokens(model_key, text)
+        except (DaemonUnavailable, FileNotFoundError):
+            return self.local.count_tokens(model_key, text)
+
+    def close(self):
+        self.local.close()
+
+
+BACKENDS = {
+    "llama_cpp": LlamaCppBackend,
+    "subprocess": SubprocessBackend,
+    "server": LlamaServerBackend,
+    "daemon": DaemonBackend
+}
+
+
+def create_backend(name=None, local=None):
+    """依 ai_config.LLM_BACKEND 建立後端；local 指定 auto 模式下 daemon 不在時的後端"""
+    name = name or LLM_BACKEND
+    if name == "auto":
+        return AutoBackend(create_backend(local or LLM_LOCAL_BACKEND))
+    if name not in BACKENDS:
+        raise ValueError(f"未知的 LLM_BACKEND: {name} (可用: auto, {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
+
+
+# --- llama-server 啟動 ---
+
+def launch_llama_servers(model_keys=None):
+    """依 LLAMA_SERVER_URLS 為每個模型啟動一個 llama-server (背景執行)"""
+    procs = []
+    for key in model_keys or LLAMA_SERVER_URLS:
+        port = urlparse(LLAMA_SERVER_URLS[key]).port
+        cmd = [
+            LLAMA_SERVER_BIN, "-m", resolve_model_path(key),
+            "--host", "127.0.0.1", "--port", str(port),
+            "-np", str(LLAMA_SERVER_SLOTS), "-cb"
+        ]
+        print(f"[*] 啟動 llama-server ({key}): {' '.join(cmd)}")
+        procs.append(subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL, start_new_session=True))
+    return procs
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["launch"]:
+        launch_llama_servers(sys.argv[2:] or None)
+    else:
+        print("用法: python3 -m llm_runtime.backends launch [model_key ...]")
@@ -0,0 +1,207 @@
+"""
+chatcall 的批次模式：從 JSONL 讀取大量請求，共用同一個 PiAiRelaySystem (與已載入的模型) 處理，
+結果逐行寫成 JSONL。原本每個問題都要啟動一次 chatcall.py，模型載入後只用一次就丟掉。
+
+    python3 chatcall.py --batch requests.jsonl --out results.jsonl
+    cat requests.jsonl | python3 chatcall.py --batch - > results.jsonl
+
+每行一個請求 (id 省略時以行號代替)：
+    {"id": "q1", "input": "讀取 chatcall.py 並說明 run_relay"}              完整的 relay (路由 / 架構師 / 工具)
+    {"id": "q2", "model": "coder", "prompt": "...", "system": "...",
+     "n_tokens": 512, "temp": 0.1, "schema": {...}}                        直接呼叫單一模型
+
+排程：
+- 請求依目標模型分組，一組做完才換下一組，模型不會來回卸載/載入
+  (relay 以快速路由預判：寒暄歸 chatter、單純讀檔不需模型、其餘歸 architect)
+- 直接呼叫模型的請求在組內以 backend.max_concurrency 個執行緒並行送出；llama-server 後端
+  每個 slot 一條序列，由伺服器做 continuous batching (多序列同時解碼)，其他後端為 1 (依序)
+- relay 共用對話狀態，一律依序執行；每個請求開始前清掉 context 區段與待辦，互不影響
+- 對話紀錄寫到獨立的資料庫 (預設為暫存檔，--history 可保留)，不混進使用者的 HISTORY_DB；
+  回答後的互動評分與 RAG 知識寫入預設關閉 (--rag-writes 開啟)，評測題目不會寫進向量庫
+- 送到 daemon 的請求標記為 batch 優先序 (PI_AI_PRIORITY)，不會擋住其他聊天室的互動請求
+
+每行結果：{"id", "index", "ok", "mode", "model", "output", "answer", "error",
+           "timings": {"queue_seconds", "seconds", "stages"}, "usage": {...}}
+relay 的 output 是該請求印出的內容，answer 是 run_relay 回傳的最後回答；結果依完成順序輸出，index 為原始行號。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_NO_MODEL = ""  # 不需要模型的請求 (路由直接執行讀檔工具)
+
+
+def read_requests(stream):
+    """[(行號, 請求)]；格式錯誤的行回傳 (行號, {"_error": ...})"""
+    requests = []
+    for lineno, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            req = json.loads(line)
+            if not isinstance(req, dict):
+                raise ValueError("請求必須是 JSON 物件")
+        except ValueError as e:
+            req = {"_error": f"第 {lineno} 行無法解析: {e}"}
+        req.setdefault("id", str(lineno))
+        requests.append((lineno, req))
+    return requests
+
+
+def target_model(relay, req):
+    """請求主要會用到的模型 (分組用)"""
+    if req.get("model"):
+        return req["model"]
+    router = getattr(relay, "router", None)
+    if router is None:
+        return "architect"
+    route = router.peek(req.get("input", ""))
+    if route == "chat":
+        return "chatter"
+    if route == "tool":
+        return _NO_MODEL
+    return "architect"
+
+
+def group_requests(relay, requests):
+    """依目標模型分組，組的順序以第一次出現為準，組內保持原順序"""
+    groups = {}
+    for index, req in requests:
+        key = "_error" if "_error" in req else target_model(relay, req)
+        groups.setdefault(key, []).append((index, req))
+    # 沒有模型的請求 (讀檔、格式錯誤) 放最前面，不佔用模型切換
+    order = sorted(groups, key=lambda k: 0 if k in ("_error", _NO_MODEL) else 1)
+    return [(key, groups[key]) for key in order]
+
+
+def run_complete(relay, req):
+    text = relay.call_llm(req["model"], req.get("prompt", req.get("input", "")),
+                          system_prompt=req.get("system"), n_tokens=int(req.get("n_tokens", 8192)),
+                          temp=float(req.get("temp", 0.1)), schema=req.get("schema"),
+                          use_cache=req.get("cache", True))
+    return {"output": text, "usage": relay.last_llm_stats()}
+
+
+def run_relay(relay, req):
+    # 每個請求從乾淨的 context 開始 (模型、快取、對話紀錄照常共用)
+    relay.context_assembler.clear()
+    relay.todo_list = ""
+    relay.tracer.last_turn = None
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        answer = relay.run_relay(req.get("input", ""), is_continuation=bool(req.get("continuation")))
+    result = {"output": buffer.getvalue(), "answer": "" if answer is None else str(answer)}
+    summary = relay.tracer.last_turn
+    if summary:
+        result["stages"] = summary.get("stages", {})
+    return result
+
+
+class BatchRunner:
+    def __init__(self, relay, out, workers=None, log=sys.stderr):
+        self.relay = relay
+        self.out = out
+        self.log = log
+        self.workers = workers or max(1, getattr(relay.backend, "max_concurrency", 1))
+        self._lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+        self.total = 0
+
+    def _emit(self, record):
+        with self._lock:
+            self.out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self.out.flush()
+            self.done += 1
+            self.failed += 0 if record["ok"] else 1
+            print(f"[batch] {self.done}/{self.total} {record['id']} {'ok' if record['ok'] else 'error'} "
+                  f"{record['timings']['seconds']:.2f}s", file=self.log, flush=True)
+
+    def _run_one(self, index, req, model, started):
+        t0 = time.perf_counter()
+        record = {"id": req["id"], "index": index, "mode": "complete" if req.get("model") else "relay",
+                  "model": model if model and model != "_error" else None}
+        try:
+            if "_error" in req:
+                raise ValueError(req["_error"])
+            if req.get("model"):
+                result = run_complete(self.relay, req)
+            else:
+                result = run_relay(self.relay, req)
+            record["ok"] = True
+        except Exception as e:
+            result = {}
+            record["ok"] = False
+            record["error"] = f"{type(e).__name__}: {e}"
+        stages = result.pop("stages", None)
+        record.update(result)
+        record["timings"] = {"queue_seconds": round(t0 - started, 3), "seconds": round(time.perf_counter() - t0, 3)}
+        if stages:
+            record["timings"]["stages"] = stages
+        self._emit(record)
+
+    def run(self, requests):
+        started = time.perf_counter()
+        self.total = len(requests)
+        groups = group_requests(self.relay, requests)
+        print(f"[batch] {self.total} 筆請求，{len(groups)} 組: " +
+              ", ".join(f"{k or '(不需模型)'}={len(v)}" for k, v in groups), file=self.log, flush=True)
+        for model, items in groups:
+            direct = [(i, r) for i, r in items if r.get("model")]
+            relays = [(i, r) for i, r in items if not r.get("model")]
+            if direct and self.workers > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    list(pool.map(lambda item: self._run_one(item[0], item[1], model, started), direct))
+            else:
+                for index, req in direct:
+                    self._run_one(index, req, model, started)
+            for index, req in relays:
+                self._run_one(index, req, model, started)
+        return self.failed
+
+
+def main(argv, relay_factory):
+    parser = argparse.ArgumentParser(prog="chatcall.py --batch", description="以 JSONL 批次處理請求")
+    parser.add_argument("input", nargs="?", default="-", help="請求檔 (JSONL)，- 為 stdin")
+    parser.add_argument("--out", default="-", help="結果檔 (JSONL)，- 為 stdout")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="直接呼叫模型時的並行數 (預設為後端的 max_concurrency)")
+    parser.add_argument("--history", default=None,
+                        help="relay 的對話紀錄資料庫 (預設為結束後刪除的暫存檔，不寫入 HISTORY_DB)")
+    parser.add_argument("--rag-writes", action="store_true",
+                        help="回答後照常做互動評分並寫入 RAG 知識/失敗經驗 (預設關閉)")
+    args = parser.parse_args(argv)
+    # daemon 排程時讓互動中的聊天室優先
+    os.environ.setdefault("PI_AI_PRIORITY", "batch")
+
+    with (contextlib.nullcontext(sys.stdin) if args.input == "-" else open(args.input, "r", encoding="utf-8")) as f:
+        requests = read_requests(f)
+    # relay 的輸出會被擷取到結果裡，結果檔固定寫到開始時的 stdout
+    out = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8")
+    tmp_dir = None
+    history_db = args.history
+    if history_db is None:
+        tmp_dir = tempfile.mkdtemp(prefix="pi-ai-batch-")
+        history_db = os.path.join(tmp_dir, "history.db")
+    try:
+        relay = relay_factory(history_db=history_db, rag_writes=args.rag_writes)
+        failed = BatchRunner(relay, out, workers=args.workers).run(requests)
+        # 批次沒有等著回應的使用者：結束前把背景的 RAG 寫入做完
+        if getattr(relay, "rag_writes", None) is not None:
+            relay.rag_writes.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 1 if failed else 0
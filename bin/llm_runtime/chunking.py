@@ -0,0 +1,130 @@
+"""
+把大檔案依函式/類別邊界切成 token 大小的視窗，供分段 (map-reduce) 分析。
+
+邊界：不縮排的 def/class/function/struct... 行，或前一行是空白的不縮排行；
+緊接在前的裝飾器 (@...) 與註解行跟著同一個區塊。區塊依序裝進不超過 max_tokens 的視窗，
+單一區塊本身就超過時，先在下一層縮排 (如類別內的方法) 找邊界，仍太大才以行切開。
+
+    chunks = split_code(text, 1536, count)   # count(text) -> token 數
+    for c in chunks: c["text"], c["start_line"], c["end_line"], c["tokens"]
+"""
+
+import re
+
+from .tracing import estimate_tokens
+
+_BLOCK_START = re.compile(
+    r"^(async\s+def|def|class|function|func|fn|pub\s|impl|struct|enum|interface|type|export|"
+    r"public|private|protected|static|void|int|char|bool|template|namespace|module|sub|local\s+function)\b"
+)
+_ATTACHED = re.compile(r"^(@|#|//|/\*|\*|--|;)")
+_CLOSERS = ("}", ")", "]", "end", "fi", "done", "esac")
+
+
+def _boundaries(lines):
+    """回傳每個區塊開頭的行號 (0 起算)"""
+    starts = [0]
+    attached = None  # 目前這串裝飾器/註解的第一行
+    for i, line in enumerate(lines):
+        if i == 0:
+            continue
+        stripped = line.rstrip("\n")
+        if not stripped.strip():
+            attached = None
+            continue
+        if stripped[0] in " \t" or stripped.startswith(_CLOSERS):
+            attached = None
+            continue
+        prev_blank = not lines[i - 1].strip()
+        is_start = prev_blank or _BLOCK_START.match(stripped)
+        if _ATTACHED.match(stripped):
+            # 裝飾器/註解只在前一行空白時開新區塊，之後的 def 跟著它
+            if prev_blank and attached is None:
+                attached = i
+                if starts[-1] != i:
+                    starts.append(i)
+            continue
+        if attached is not None:
+            attached = None
+            continue
+        if is_start and starts[-1] != i:
+            starts.append(i)
+    return starts
+
+
+def _split_lines(lines, first_line, max_tokens, count):
+    """單一區塊超過 max_tokens 時以行切開"""
+    pieces, current, current_start = [], [], first_line
+    for offset, line in enumerate(lines):
+        if current and count("".join(current) + line) > max_tokens:
+            pieces.append((current_start, current))
+            current, current_start = [], first_line + offset
+        current.append(line)
+    if current:
+        pieces.append((current_start, current))
+    return pieces
+
+
+def _indent(line):
+    return len(line) - len(line.lstrip(" \t"))
+
+
+def _blocks(lines, first_line, max_tokens, count, depth=0):
+    """[(起始行, 行, token 數)]；過大的區塊往內一層縮排再切"""
+    starts = _boundaries(lines) + [len(lines)]
+    blocks = []
+    for a, b in zip(starts, starts[1:]):
+        block = lines[a:b]
+        tokens = count("".join(block))
+        if tokens <= max_tokens:
+            blocks.append((first_line + a, block, tokens))
+            continue
+        body = [line for line in block[1:] if line.strip()]
+        inner = min((_indent(line) for line in body), default=0)
+        if depth < 3 and inner > 0 and len(block) > 2:
+            # 去掉內層縮排後以相同規則找邊界 (類別的方法、巢狀函式)
+            dedented = [block[0]] + [line[inner:] if _indent(line) >= inner else line for line in block[1:]]
+            sub = _blocks(dedented, first_line + a, max_tokens, count, depth + 1)
+            if len(sub) > 1:
+                offset = first_line + a
+                for start, piece, _ in sub:
+                    # 子區塊是以去掉縮排的文字估算大小，加回縮排後可能超過上限
+                    original = block[start - offset:start - offset + len(piece)]
+                    tokens = count("".join(original))
+                    if tokens <= max_tokens:
+                        blocks.append((start, original, tokens))
+                        continue
+                    for piece_start, lines_piece in _split_lines(original, start, max_tokens, count):
+                        blocks.append((piece_start, lines_piece, count("".join(lines_piece))))
+                continue
+        for start, piece in _split_lines(block, first_line + a, max_tokens, count):
+            blocks.append((start, piece, count("".join(piece))))
+    return blocks
+
+
+def split_code(text, max_tokens, count=None):
+    """依區塊邊界切成不超過 max_tokens 的視窗 (行號 1 起算，含頭尾)"""
+    count = count or estimate_tokens
+    lines = text.splitlines(keepends=True)
+    if not lines:
+        return []
+    blocks = _blocks(lines, 0, max_tokens, count)
+
+    chunks = []
+    current, current_start = [], 0
+    for start, block, _ in blocks:
+        # 各區塊 token 數相加不一定等於合併後的 token 數，以合併後的文字判斷
+        if current and count("".join(current + block)) > max_tokens:
+            chunks.append(_chunk(current, current_start, count))
+            current = []
+        if not current:
+            current_start = start
+        current.extend(block)
+    if current:
+        chunks.append(_chunk(current, current_start, count))
+    return chunks
+
+
+def _chunk(lines, start, count):
+    text = "".join(lines)
+    return {"text": text, "start_line": start + 1, "end_line": start + len(lines), "tokens": count(text)}
@@ -0,0 +1,296 @@
+"""
+專案層級的程式碼索引 (code_searcher 使用)。
+
+原本 code_searcher 只能指定單一檔案，每次以多行 regex 掃整個檔案，模型必須先猜對檔名。
+
+CodeIndex 把專案根目錄下 (遵守 .gitignore，見 ProjectTree) 的文字檔存進 SQLite：
+- chunks：每個檔案切成固定行數的片段，以 FTS5 trigram 建全文索引 (子字串搜尋、bm25 排序)；
+  SQLite 不支援 trigram 時退回一般資料表 + LIKE
+- symbols：以 regex 擷取的函式/類別定義 (名稱、種類、行號)
+- files：路徑、mtime、大小；update() 只重建 mtime/大小有變的檔案，並移除已刪除的檔案
+
+code_searcher 每次呼叫都開一個新的 CodeIndex，規劃中並行的任務與預先執行的執行緒可能同時搜尋。
+update() 以行程內每個索引檔一把的鎖序列化 (不在 SQLite 的 busy_timeout 上互等)，
+等鎖期間若有另一個更新在我們要求之後才開始並已完成，直接沿用它的結果。
+
+    index = CodeIndex(".", ".pi_ai_cache/code_index/xxx.db", ignore=[...])
+    index.update()
+    index.search("build_chat_prompt", limit=5)   # [{"path", "start_line", "end_line", "score", "lines": [(行號, 文字)]}]
+    index.find_symbol("PiAiRelaySystem")        # [{"path", "line", "kind", "name"}]
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from .project_tree import ProjectTree
+
+_update_locks = {}                  # 索引檔 realpath -> threading.Lock
+_update_locks_guard = threading.Lock()
+_last_updates = {}                  # 索引檔 realpath -> (開始時間, update() 結果)
+
+
+def _update_lock_for(key):
+    with _update_locks_guard:
+        return _update_locks.setdefault(key, threading.Lock())
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        path TEXT UNIQUE NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS symbols (
+        file_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        line INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS symbols_file ON symbols (file_id)",
+    """CREATE TABLE IF NOT EXISTS chunk_files (
+        chunk_id INTEGER PRIMARY KEY,
+        file_id INTEGER NOT NULL,
+        start_line INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS chunk_files_file ON chunk_files (file_id)",
+]
+
+_PY = [
+    ("class", re.compile(r"^\s*class\s+([A-Za-z_]\w*)")),
+    ("function", re.compile(r"^\s*(?:async\s+)?def\s+([A-Za-z_]\w*)")),
+]
+_JS = [
+    ("class", re.compile(r"^\s*(?:export\s+)?(?:default\s+)?class\s+([A-Za-z_$][\w$]*)")),
+    ("function", re.compile(r"^\s*(?:export\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)")),
+    ("function", re.compile(r"^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s*)?(?:\([^)]*\)|[A-Za-z_$][\w$]*)\s*=>")),
+]
+_RUST = [
+    ("function", re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:unsafe\s+)?fn\s+([A-Za-z_]\w*)")),
+    ("struct", re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait)\s+([A-Za-z_]\w*)")),
+]
+_GO = [
+    ("function", re.compile(r"^func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)")),
+    ("struct", re.compile(r"^type\s+([A-Za-z_]\w*)\s+(?:struct|interface)")),
+]
+_C = [
+    ("struct", re.compile(r"^\s*(?:typedef\s+)?(?:struct|enum|union|class)\s+([A-Za-z_]\w*)\s*\{?\s*$")),
+    # 不縮排、以「型別 名稱(」開頭且不是宣告 (;) 的行
+    ("function", re.compile(r"^[A-Za-z_][\w\s\*&:<>,]*?[\s\*&]([A-Za-z_][\w:]*)\s*\([^;]*$")),
+]
+_SH = [("function", re.compile(r"^\s*(?:function\s+)?([A-Za-z_][\w-]*)\s*\(\)\s*\{?"))]
+_LUA = [("function", re.compile(r"^\s*(?:local\s+)?function\s+([A-Za-z_][\w.:]*)"))]
+_SYMBOL_PATTERNS = {
+    ".py": _PY, ".js": _JS, ".mjs": _JS, ".jsx": _JS, ".ts": _JS, ".tsx": _JS,
+    ".rs": _RUST, ".go": _GO, ".sh": _SH, ".bash": _SH, ".lua": _LUA,
+    ".c": _C, ".h": _C, ".cc": _C, ".cpp": _C, ".cxx": _C, ".hpp": _C,
+}
+_KEYWORDS = {"if", "for", "while", "switch", "return", "else", "sizeof", "elif"}
+
+
+def extract_symbols(text, ext):
+    """[(名稱, 種類, 行號)]；不認得的副檔名 (文件、設定檔) 不擷取"""
+    patterns = _SYMBOL_PATTERNS.get(ext.lower())
+    if not patterns:
+        return []
+    symbols = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        if not line or line.lstrip().startswith(("#", "//", "/*", "*")):
+            continue
+        for kind, pattern in patterns:
+            m = pattern.match(line)
+            if m and m.group(1) not in _KEYWORDS:
+                symbols.append((m.group(1), kind, lineno))
+                break
+    return symbols
+
+
+def _is_text(data):
+    return b"\0" not in data[:8192]
+
+
+class CodeIndex:
+    def __init__(self, root, db_path, ignore=None, tree_cache=None, chunk_lines=40, max_file_bytes=512 * 1024,
+                 busy_timeout=10.0):
+        self.root = os.path.realpath(root)
+        self.db_path = db_path
+        self.ignore = ignore
+        self.tree_cache = tree_cache
+        self.chunk_lines = chunk_lines
+        self.max_file_bytes = max_file_bytes
+        self.busy_timeout = busy_timeout
+        self.last_update = {}
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(text, tokenize='trigram')")
+            except sqlite3.OperationalError:
+                # 舊版 SQLite (無 FTS5 或 trigram)：一般資料表 + LIKE
+                conn.execute("CREATE TABLE IF NOT EXISTS chunks (rowid INTEGER PRIMARY KEY, text TEXT)")
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'chunks'").fetchone()[0]
+            self.fts = "fts5" in sql.lower()
+
+    def _conn(self):
+        # sqlite3 連線不可跨執行緒共用，每個執行緒各自一條 (同 HistoryStore)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- 增量更新 ---
+
+    def update(self):
+        """依 mtime/大小重建有變動的檔案；回傳 {"files", "updated", "removed", "ms"}"""
+        requested = time.monotonic()
+        key = os.path.realpath(self.db_path)
+        with _update_lock_for(key):
+            last = _last_updates.get(key)
+            if last is not None and last[0] >= requested:
+                # 別的執行緒在我們要求之後才開始的更新已經看過同樣新的檔案狀態
+                self.last_update = dict(last[1], updated=0, removed=0, ms=0.0)
+                return self.last_update
+            started = time.monotonic()
+            t0 = time.perf_counter()
+            tree = ProjectTree(self.root, self.ignore, self.tree_cache)
+            current = {}
+            for rel in tree.files():
+                try:
+                    st = os.stat(os.path.join(self.root, rel))
+                except OSError:
+                    continue
+                if st.st_size <= self.max_file_bytes:
+                    current[rel] = (st.st_mtime_ns, st.st_size)
+            conn = self._conn()
+            known = {path: (fid, mtime, size) for fid, path, mtime, size in
+                     conn.execute("SELECT id, path, mtime_ns, size FROM files")}
+            changed = [rel for rel, stamp in current.items() if known.get(rel, (None,))[1:] != stamp]
+            removed = [known[rel][0] for rel in known if rel not in current]
+            if changed or removed:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for fid in removed:
+                        self._drop(conn, fid)
+                    for rel in changed:
+                        self._index_file(conn, rel, current[rel], known.get(rel, (None,))[0])
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            self.last_update = {"files": len(current), "updated": len(changed), "removed": len(removed),
+                                "ms": round((time.perf_counter() - t0) * 1000, 3)}
+            _last_updates[key] = (started, self.last_update)
+            return self.last_update
+
+    def _drop(self, conn, fid):
+        chunk_ids = [row[0] for row in conn.execute("SELECT chunk_id FROM chunk_files WHERE file_id = ?", (fid,))]
+        conn.executemany("DELETE FROM chunks WHERE rowid = ?", [(c,) for c in chunk_ids])
+        conn.execute("DELETE FROM chunk_files WHERE file_id = ?", (fid,))
+        conn.execute("DELETE FROM symbols WHERE file_id = ?", (fid,))
+        conn.execute("DELETE FROM files WHERE id = ?", (fid,))
+
+    def _index_file(self, conn, rel, stamp, old_id):
+        if old_id is not None:
+            self._drop(conn, old_id)
+        try:
+            with open(os.path.join(self.root, rel), "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        # 二進位檔也記錄 mtime，下次不必再讀
+        fid = conn.execute("INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)", (rel, stamp[0], stamp[1])).lastrowid
+        if not _is_text(data):
+            return
+        text = data.decode("utf-8", errors="ignore")
+        lines = text.splitlines()
+        for start in range(0, len(lines), self.chunk_lines):
+            body = "\n".join(lines[start:start + self.chunk_lines])
+            chunk_id = conn.execute("INSERT INTO chunks (text) VALUES (?)", (body,)).lastrowid
+            conn.execute("INSERT INTO chunk_files (chunk_id, file_id, start_line) VALUES (?, ?, ?)",
+                         (chunk_id, fid, start + 1))
+        conn.executemany("INSERT INTO symbols (file_id, name, kind, line) VALUES (?, ?, ?, ?)",
+                         [(fid, name, kind, line) for name, kind, line in extract_symbols(text, os.path.splitext(rel)[1])])
+
+    # --- 查詢 ---
+
+    def search(self, query, limit=10, path=None):
+        """關鍵字 (以空白分隔，全部都要出現) 的片段，依 bm25 排序；定義了該關鍵字的片段優先"""
+        terms = [t for t in query.split() if t]
+        if not terms:
+            return []
+        conn = self._conn()
+        where, args = [], []
+        long_terms = [t for t in terms if len(t) >= 3]
+        if self.fts and long_terms:
+            where.append("chunks MATCH ?")
+            args.append(" ".join('"' + t.replace('"', '""') + '"' for t in long_terms))
+            short_terms = [t for t in terms if len(t) < 3]
+        else:
+            short_terms = terms
+        for t in short_terms:
+            where.append("chunks.text LIKE ? ESCAPE '\\'")
+            args.append("%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if path:
+            where.append("files.path = ?")
+            args.append(path)
+        score = "bm25(chunks)" if self.fts and long_terms else "0"
+        rows = conn.execute(
+            f"SELECT files.id, files.path, chunk_files.start_line, chunks.text, {score} AS score "
+            "FROM chunks JOIN chunk_files ON chunk_files.chunk_id = chunks.rowid "
+            "JOIN files ON files.id = chunk_files.file_id "
+            f"WHERE {' AND '.join(where)} ORDER BY score LIMIT ?", args + [limit * 3]
+        ).fetchall()
+
+        lowered = [t.lower() for t in terms]
+        results = []
+        for fid, rel, start, text, bm25 in rows:
+            lines = text.split("\n")
+            end = start + len(lines) - 1
+            defined = conn.execute(
+                "SELECT COUNT(*) FROM symbols WHERE file_id = ? AND line BETWEEN ? AND ? AND name COLLATE NOCASE IN "
+                f"({','.join('?' * len(terms))})", [fid, start, end] + terms
+            ).fetchone()[0]
+            results.append({"path": rel, "start_line": start, "end_line": end,
+                            "score": round(-bm25 + (10.0 if defined else 0.0), 6),
+                            "lines": _snippet(lines, start, lowered)})
+        results.sort(key=lambda r: r["score"], reverse=True)
+        return results[:limit]
+
+    def find_file(self, rel):
+        row = self._conn().execute("SELECT id FROM files WHERE path = ?", (rel,)).fetchone()
+        return row[0] if row else None
+
+    def find_symbol(self, name, limit=20):
+        """完全相同 > 開頭相同 > 包含 (不分大小寫)"""
+        pattern = "%" + name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = self._conn().execute(
+            "SELECT files.path, symbols.line, symbols.kind, symbols.name FROM symbols "
+            "JOIN files ON files.id = symbols.file_id "
+            "WHERE symbols.name LIKE ? ESCAPE '\\' "
+            "ORDER BY (symbols.name = ? COLLATE NOCASE) DESC, (symbols.name LIKE ? ESCAPE '\\') DESC, "
+            "length(symbols.name), files.path LIMIT ?",
+            (pattern, name, pattern[1:], limit)
+        ).fetchall()
+        return [{"path": p, "line": line, "kind": kind, "name": n} for p, line, kind, n in rows]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def _snippet(lines, start, terms, context=1, max_lines=8):
+    """片段中含關鍵字的行與前後 context 行 [(行號, 文字)]"""
+    hits = [i for i, line in enumerate(lines) if any(t in line.lower() for t in terms)]
+    keep = sorted({j for i in hits for j in range(i - context, i + context + 1) if 0 <= j < len(lines)})
+    return [(start + j, lines[j]) for j in keep[:max_lines]]
@@ -0,0 +1,17 @@
+from typing import Optional
+
+# Qwen2.5 系列共用的停止字串
+QWEN_STOP = ["<|im_end|>", "<|im_start|>"]
+
+def build_chat_prefix(system_prompt: Optional[str] = None) -> str:
+    """chat template 中與使用者訊息無關的前綴 (系統提示 + user 標頭)，可跨呼叫共用 KV"""
+    if system_prompt:
+        return "<|im_start|>system\n" + system_prompt.strip() + "<|im_end|>\n<|im_start|>user\n"
+    return "<|im_start|>user\n"
+
+def build_chat_prompt(prompt: str, system_prompt: Optional[str] = None) -> str:
+    """組出 Qwen2.5 chat template 格式的完整 prompt"""
+    return (
+        build_chat_prefix(system_prompt) + prompt.strip() + "<|im_end|>\n"
+        "<|im_start|>assistant\n"
+    )
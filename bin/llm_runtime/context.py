@@ -0,0 +1,204 @@
+"""
+依 token 預算組裝 self.context。
+
+原本 run_relay 每一輪 (含接力) 都把 [RAG知識] 接在 context 前面、[失敗經驗] 接在後面，
+text_reader 又整個換成檔案內容，沒有人計算長度，長檔案或多次接力很容易超過模型的 n_ctx。
+
+ContextAssembler 把 context 拆成具名的區段 (rag / failures / file / todo ...)：
+- set() 整段取代 (接力時不會越疊越長)；區段內重複的項目、以及已出現在較高優先區段的項目會被去除
+- render(model_key) 以該模型的 tokenizer 計數，依優先順序放入預算：
+  放不下的多項目區段從尾端丟項目 (RAG 結果已依相關度排序)，單一文字區段保留開頭並標示截斷，
+  更低優先的區段整段略過
+- 輸出時依固定的顯示順序排列，結果在區段沒有變動前快取
+
+    ctx = ContextAssembler(backend.count_tokens, budget_for)
+    ctx.set("rag", ["...", "..."], header="[RAG知識]")
+    ctx.set("file", content)
+    text = ctx.render("coder")
+"""
+
+import hashlib
+import threading
+
+from .tracing import estimate_tokens
+
+# 預設的保留優先順序 (前面的先放入預算) 與顯示順序
+DEFAULT_PRIORITY = ["todo", "file", "failures", "rag"]
+DEFAULT_ORDER = ["rag", "file", "failures", "todo"]
+
+TRUNCATED_MARK = "\n...(以下已截斷 {chars} 字元)"
+
+
+def _digest(text):
+    return hashlib.sha1(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+class ContextAssembler:
+    def __init__(self, count_tokens=None, budget_for=None, priority=None, order=None, max_cached=512):
+        """
+        :param count_tokens: (model_key, text) -> token 數或 None (None 時以字元數估算)
+        :param budget_for: model_key -> context 可用的 token 數
+        """
+        self._count = count_tokens
+        self.budget_for = budget_for or (lambda model_key: 2048)
+        self.priority = list(priority or DEFAULT_PRIORITY)
+        self.order = list(order or DEFAULT_ORDER)
+        self.max_cached = max_cached
+        self._segments = {}
+        self._rendered = {}
+        self._token_cache = {}
+        self._lock = threading.RLock()
+        self.last_stats = {}
+
+    # --- 區段 ---
+
+    def set(self, name, content, header=None):
+        """以 content (字串或字串清單) 取代整個區段；空內容等同 clear(name)"""
+        items = [content] if isinstance(content, str) else list(content or [])
+        unique, seen = [], set()
+        for item in items:
+            item = (item or "").strip("\n")
+            if not item.strip():
+                continue
+            digest = _digest(item)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            unique.append((digest, item))
+        with self._lock:
+            if not unique:
+                self._segments.pop(name, None)
+            else:
+                self._segments[name] = {"header": header, "items": unique, "single": isinstance(content, str)}
+            self._rendered.clear()
+
+    def get(self, name):
+        segment = self._segments.get(name)
+        return "\n".join(item for _, item in segment["items"]) if segment else ""
+
+    def clear(self, name=None):
+        with self._lock:
+            if name is None:
+                self._segments.clear()
+            else:
+                self._segments.pop(name, None)
+            self._rendered.clear()
+
+    def names(self):
+        return list(self._segments.keys())
+
+    def snapshot(self, names):
+        """指定區段目前的內容，之後可用 restore() 還原 (區段是整段取代，不必深拷貝)"""
+        with self._lock:
+            return {name: self._segments.get(name) for name in names}
+
+    def restore(self, snapshot):
+        with self._lock:
+            for name, segment in snapshot.items():
+                if segment is None:
+                    self._segments.pop(name, None)
+                else:
+                    self._segments[name] = segment
+            self._rendered.clear()
+
+    # --- token 計數 ---
+
+    def count(self, model_key, text):
+        if not text:
+            return 0
+        key = (model_key, hashlib.sha1(text.encode("utf-8")).digest())
+        cached = self._token_cache.get(key)
+        if cached is not None:
+            return cached
+        tokens = None
+        if self._count is not None:
+            try:
+                tokens = self._count(model_key, text)
+            except Exception:
+                tokens = None  # 後端無法計數 (daemon 不在、模型檔不存在...) 就估算
+        if tokens is None:
+            tokens = estimate_tokens(text)
+        if len(self._token_cache) >= self.max_cached:
+            self._token_cache.clear()
+        self._token_cache[key] = tokens
+        return tokens
+
+    def _fits(self, model_key, text, remaining):
+        """byte-level BPE 的 token 數不會超過 UTF-8 位元組數，夠短的文字不必真的切詞"""
+        size = len(text.encode("utf-8"))
+        if size <= remaining:
+            return True, size
+        tokens = self.count(model_key, text)
+        return tokens <= remaining, tokens
+
+    def _truncate(self, model_key, text, remaining):
+        """保留開頭、放得進 remaining 的最長前綴 (以比例估計長度後驗證，最多修正數次)"""
+        if remaining <= 0:
+            return "", 0
+        tokens = self.count(model_key, text)
+        keep = int(len(text) * remaining / max(tokens, 1))
+        for _ in range(6):
+            if keep <= 0:
+                return "", 0
+            candidate = text[:keep] + TRUNCATED_MARK.format(chars=len(text) - keep)
+            ok, used = self._fits(model_key, candidate, remaining)
+            if ok:
+                return candidate, used
+            keep = int(keep * remaining / max(used, 1) * 0.95)
+        return "", 0
+
+    # --- 組裝 ---
+
+    def render(self, model_key):
+        with self._lock:
+            cached = self._rendered.get(model_key)
+            if cached is not None:
+                self.last_stats = cached[1]
+                return cached[0]
+            budget = max(0, int(self.budget_for(model_key)))
+            remaining = budget
+            kept, seen = {}, set()
+            stats = {"model": model_key, "budget": budget, "segments": {}}
+            names = [n for n in self.priority if n in self._segments]
+            names += [n for n in self._segments if n not in names]
+            for name in names:
+                segment = self._segments[name]
+                items = [(d, item) for d, item in segment["items"] if d not in seen]
+                info = {"items": len(segment["items"]), "kept": 0, "tokens": 0, "truncated": False}
+                stats["segments"][name] = info
+                if not items:
+                    continue
+                header = segment["header"]
+                overhead = self.count(model_key, header + "\n") if header else 0
+                out = []
+                used_total = overhead
+                for digest, item in items:
+                    ok, used = self._fits(model_key, item + "\n", remaining - used_total)
+                    if ok:
+                        out.append(item)
+                        seen.add(digest)
+                        used_total += used
+                        continue
+                    info["truncated"] = True
+                    # 單一文字區段 (檔案內容) 截斷保留開頭；多項目區段丟掉放不下的項目
+                    if segment["single"] or not out:
+                        part, used = self._truncate(model_key, item, remaining - used_total - 1)
+                        if part:
+                            out.append(part)
+                            seen.add(digest)
+                            used_total += used
+                    if segment["single"]:
+                        break
+                if not out:
+                    continue
+                remaining -= used_total
+                info.update(kept=len(out), tokens=used_total)
+                kept[name] = (f"{header}\n" if header else "") + "\n".join(out)
+
+            parts = [kept[n] for n in self.order if n in kept]
+            parts += [kept[n] for n in kept if n not in self.order]
+            text = "\n".join(parts)
+            stats["tokens"] = budget - remaining
+            self._rendered[model_key] = (text, stats)
+            self.last_stats = stats
+            return text
@@ -0,0 +1,373 @@
+"""
+常駐推論 daemon。
+
+模型只在 daemon 內載入一次並常駐記憶體，chatcall.py / chatcall2.py 每次呼叫
+只需透過 Unix socket 送出一行 JSON 請求，省下每一輪重新載入 GGUF 的時間。
+
+    python3 -m llm_runtime.daemon start     # 背景啟動 (已在執行則直接返回)
+    python3 -m llm_runtime.daemon serve     # 前景執行
+    python3 -m llm_runtime.daemon status
+    python3 -m llm_runtime.daemon stop
+
+協定：一個連線一個請求，請求與回應都是一行 JSON。
+    {"op": "complete", "model_path": ..., "prompt": ..., "system_prompt": ...,
+     "n_tokens": ..., "temp": ..., "schema": ...}
+    -> {"ok": true, "text": ..., "usage": {...}} 或 {"ok": false, "error": ...}
+"op": "stream" 參數相同，但每產生一段文字就回一行 {"text": ...}，最後以 {"ok": true, "done": true, "usage": {...}}
+結束；用戶端中途關閉連線即停止生成。usage 是 token 數與模型載入時間，供用戶端追蹤。
+    {"op": "tokenize", "model_path": ..., "text": ...} -> {"ok": true, "tokens": 123}
+以常駐的詞表計算 token 數 (context 組裝用)，不佔用模型。
+
+socket 開放所有使用者 (子聊天室可能以不同身分執行)，所以 model_path 必須是 ai_config.MODELS 中的模型，
+shutdown 只接受與 daemon 同一使用者 (或 root) 的連線 (SO_PEERCRED)。
+
+complete / stream 另帶 "session" ("$USER/<chatid>") 與 "priority" ("interactive" / "batch")，
+由 scheduler.FairScheduler 決定執行順序；用戶端依 CURRENT_AI_CHATID (或目前目錄) 與 PI_AI_PRIORITY 填入。
+"""
+
+import getpass
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from ai_config import (
+    MODELS, LLM_DAEMON_SOCKET, LLM_DAEMON_PRELOAD, LLM_DAEMON_LOG, LLM_DAEMON_SLOTS, LLM_DAEMON_MIN_FREE_MB
+)
+from .scheduler import FairScheduler
+from .tracing import record_usage, take_usage
+
+
+class DaemonUnavailable(ConnectionError):
+    """daemon 沒有在執行 (或 socket 已失效)，呼叫端應改走本地推論"""
+
+
+# --- 伺服端 ---
+
+def peer_uid(sock):
+    """Unix socket 另一端行程的 uid；平台不支援時回傳 None"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    except OSError:
+        return None
+    return struct.unpack("3i", creds)[1]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            req = json.loads(line.decode("utf-8"))
+            if req.get("op") == "stream":
+                self.handle_stream(req)
+                return
+            resp = self.server.dispatch(req, peer_uid(self.request))
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        except Exception as e:
+            resp = {"ok": False, "error": str(e)}
+        self.send(resp)
+
+    def send(self, obj):
+        self.wfile.write((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle_stream(self, req):
+        self.server.check_model(req)
+        with self.server.scheduled(req):
+            self._stream(req)
+
+    def _stream(self, req):
+        chunks = self.server.host.stream_path(
+            req["model_path"], req.get("prompt", ""),
+            system_prompt=req.get("system_prompt"),
+            n_tokens=int(req.get("n_tokens", 8192)),
+            temp=float(req.get("temp", 0.1)),
+            schema=req.get("schema")
+        )
+        try:
+            for text in chunks:
+                self.send({"text": text})
+            self.send({"ok": True, "done": True, "usage": take_usage()})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 用戶端已提早結束 (例如 JSON 已完整)，關閉 generator 以停止生成
+        except Exception as e:
+            self.send({"ok": False, "error": str(e)})
+        finally:
+            chunks.close()
+
+
+class LLMDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, host=None):
+        from .backends import LlamaCppBackend
+        self.socket_path = socket_path
+        # 模型常駐於 LlamaCppBackend，系統提示前綴的 KV 快照也跨請求保留
+        self.host = host or LlamaCppBackend()
+        self.started_at = time.time()
+        self.allowed_models = {os.path.realpath(path) for path in MODELS.values()}
+        models = getattr(self.host, "models", None)
+        self.scheduler = FairScheduler(LLM_DAEMON_SLOTS, admit=models.admission if models is not None else None,
+                                       min_free_mb=LLM_DAEMON_MIN_FREE_MB)
+        super().__init__(socket_path, _RequestHandler)
+        # 子聊天室可能以不同使用者身分執行，socket 需開放讀寫 (同 user_profiles 的 777)
+        os.chmod(socket_path, 0o666)
+
+    def scheduled(self, req):
+        return self.scheduler.slot(req.get("session"), req.get("priority"), req.get("model_path"))
+
+    def check_model(self, req):
+        """只接受 ai_config.MODELS 中的模型，不讓用戶端指定任意檔案載入"""
+        path = req.get("model_path")
+        if not path or os.path.realpath(path) not in self.allowed_models:
+            raise PermissionError(f"不允許的模型: {path}")
+
+    def dispatch(self, req, uid=None):
+        """:param uid: 連線另一端的 uid (peer_uid)，None 表示無法得知"""
+        op = req.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "status":
+            status = {"ok": True, "pid": os.getpid(), "uptime": time.time() - self.started_at,
+                      "models": self.host.loaded()}
+            if getattr(self.host, "prefix_cache", None) is not None:
+                status["prefix_cache"] = self.host.prefix_cache.stats()
+            if getattr(self.host, "models", None) is not None:
+                status["model_manager"] = self.host.models.stats()
+            status["scheduler"] = self.scheduler.stats()
+            return status
+        if op == "complete":
+            self.check_model(req)
+            with self.scheduled(req):
+                text = self.host.complete_path(
+                    req["model_path"], req.get("prompt", ""),
+                    system_prompt=req.get("system_prompt"),
+                    n_tokens=int(req.get("n_tokens", 8192)),
+                    temp=float(req.get("temp", 0.1)),
+                    schema=req.get("schema")
+                )
+            return {"ok": True, "text": text, "usage": take_usage()}
+        if op == "tokenize":
+            self.check_model(req)
+            return {"ok": True, "tokens": self.host.count_tokens_path(req["model_path"], req.get("text", ""))}
+        if op == "shutdown":
+            if uid is None or uid not in (0, os.getuid()):
+                return {"ok": False, "error": "只有啟動 daemon 的使用者可以停止它"}
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {"ok": True}
+        return {"ok": False, "error": f"未知的 op: {op}"}
+
+
+def serve(socket_path=LLM_DAEMON_SOCKET, preload=LLM_DAEMON_PRELOAD):
+    if os.path.exists(socket_path):
+        if is_running(socket_path):
+            print(f"[-] daemon 已在執行: {socket_path}", file=sys.stderr)
+            return 1
+        os.unlink(socket_path)  # 上次異常結束留下的 socket
+
+    # 先綁定 socket 再於背景預載：預載期間進來的請求會在模型鎖上等待，而不是各自再載入一份
+    server = LLMDaemon(socket_path)
+
+    def _preload():
+        for key in preload:
+            path = MODELS.get(key)
+            if path and os.path.exists(path):
+                try:
+                    t0 = time.time()
+                    server.host.load_path(path)
+                    print(f"[daemon] 載入 {key} ({time.time() - t0:.1f}s)", flush=True)
+                except Exception as e:
+                    print(f"[-] daemon 預載 {key} 失敗: {e}", file=sys.stderr, flush=True)
+
+    threading.Thread(target=_preload, daemon=True).start()
+    print(f"[daemon] 服務中: {socket_path} (pid {os.getpid()})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    return 0
+
+
+def start_background(socket_path=LLM_DAEMON_SOCKET, log_path=LLM_DAEMON_LOG, wait=5.0):
+    """
+    以獨立 session 背景啟動 daemon，已在執行則不做事。
+    最多等 wait 秒到 socket 可以連線 (socket 在預載模型前就已綁定)，
+    緊接著執行的 chatcall.py 才不會找不到 daemon 而退回本機後端。
+    """
+    if is_running(socket_path):
+        return 0
+    with open(log_path, "a") as log:
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "llm_runtime.daemon", "serve"],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True
+        )
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline and proc.poll() is None:
+        if is_running(socket_path):
+            print(f"[*] daemon 已啟動 (pid {proc.pid})，記錄檔: {log_path}")
+            return 0
+        time.sleep(0.1)
+    if proc.poll() is not None:
+        print(f"[-] daemon 啟動失敗 (結束碼 {proc.returncode})，請看記錄檔: {log_path}", file=sys.stderr)
+        return 1
+    print(f"[*] daemon 背景啟動中，記錄檔: {log_path}")
+    return 0
+
+
+# --- 用戶端 ---
+
+def session_id():
+    """排程用的 session："使用者/聊天室"，聊天室取 CURRENT_AI_CHATID，沒有時取目前目錄名稱"""
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = str(os.getuid()) if hasattr(os, "getuid") else "unknown"
+    chat = os.environ.get("CURRENT_AI_CHATID") or os.path.basename(os.getcwd())
+    return f"{user}/{chat}"
+
+
+def request_priority():
+    return os.environ.get("PI_AI_PRIORITY", "interactive")
+
+
+def _connect(payload, socket_path, timeout):
+    if not socket_path or not os.path.exists(socket_path):
+        raise DaemonUnavailable(f"找不到 daemon socket {socket_path}")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError as e:
+        sock.close()
+        raise DaemonUnavailable(str(e))
+    sock.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+    return sock
+
+
+def request(payload, socket_path=LLM_DAEMON_SOCKET, timeout=180):
+    """送出一個請求並等待回應，daemon 不存在時拋出 DaemonUnavailable"""
+    sock = _connect(payload, socket_path, timeout)
+    try:
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise DaemonUnavailable("daemon 未回應")
+    return json.loads(line.decode("utf-8"))
+
+
+def is_running(socket_path=LLM_DAEMON_SOCKET):
+    try:
+        return request({"op": "ping"}, socket_path, timeout=2).get("ok", False)
+    except (OSError, ValueError):
+        return False
+
+
+def daemon_complete(model_path, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None,
+                    socket_path=LLM_DAEMON_SOCKET, timeout=180):
+    """透過 daemon 推論，回傳原始生成文字；daemon 端失敗時拋出 RuntimeError"""
+    resp = request({
+        "op": "complete",
+        "session": session_id(),
+        "priority": request_priority(),
+        "model_path": os.path.realpath(model_path),
+        "prompt": prompt,
+        "system_prompt": system_prompt,
+        "n_tokens": n_tokens,
+        "temp": temp,
+        "schema": schema
+    }, socket_path, timeout)
+    if not resp.get("ok"):
+        raise RuntimeError(resp.get("error", "daemon error"))
+    record_usage(**resp.get("usage", {}))
+    return resp["text"]
+
+
+def daemon_stream(model_path, prompt, system_prompt=None, n_tokens=8192, temp=0.1, schema=None,
+                  socket_path=LLM_DAEMON_SOCKET, timeout=180):
+    """
+    透過 daemon 串流推論。連線在呼叫當下建立 (daemon 不在時立即拋出 DaemonUnavailable)，
+    回傳逐段產生文字的 generator；關閉 generator 會斷線並讓 daemon 停止生成。
+    """
+    sock = _connect({
+        "op": "stream",
+        "session": session_id(),
+        "priority": request_priority(),
+        "model_path": os.path.realpath(model_path),
+        "prompt": prompt,
+        "system_prompt": system_prompt,
+        "n_tokens": n_tokens,
+        "temp": temp,
+        "schema": schema
+    }, socket_path, timeout)
+    return _iter_stream(sock)
+
+
+def daemon_count_tokens(model_path, text, socket_path=LLM_DAEMON_SOCKET, timeout=30):
+    """由 daemon 計算 token 數；daemon 端無法計算時回傳 None"""
+    if not text:
+        return 0
+    resp = request({"op": "tokenize", "model_path": os.path.realpath(model_path), "text": text},
+                   socket_path, timeout)
+    return resp.get("tokens") if resp.get("ok") else None
+
+
+def _iter_stream(sock):
+    try:
+        with sock.makefile("rb") as f:
+            for line in f:
+                msg = json.loads(line.decode("utf-8"))
+                if "text" in msg:
+                    yield msg["text"]
+                elif not msg.get("ok"):
+                    raise RuntimeError(msg.get("error", "daemon error"))
+                elif msg.get("done"):
+                    record_usage(**msg.get("usage", {}))
+                    return
+    finally:
+        sock.close()
+
+
+def main(argv):
+    cmd = argv[0] if argv else "serve"
+    if cmd == "serve":
+        return serve()
+    if cmd == "start":
+        return start_background()
+    if cmd == "status":
+        try:
+            print(json.dumps(request({"op": "status"}, timeout=5), ensure_ascii=False, indent=2))
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"[-] daemon 未執行: {e}")
+            return 1
+    if cmd == "stop":
+        try:
+            request({"op": "shutdown"}, timeout=5)
+            print("[*] daemon 已停止")
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"[-] daemon 未執行: {e}")
+            return 1
+    print("用法: python3 -m llm_runtime.daemon [start|serve|status|stop]")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
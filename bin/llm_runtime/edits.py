@@ -0,0 +1,215 @@
+"""
+以搜尋/取代區塊 (或 unified diff) 修改檔案，取代「重新輸出整個檔案」。
+
+CPU 上最慢的是生成 token：改一行卻要模型重印整個檔案，超過 n_tokens 還會被截斷後直接寫回。
+改成請模型只輸出要改的地方：
+
+    <<<<<<< SEARCH
+    原本的幾行 (照抄)
+    =======
+    改成的內容
+    >>>>>>> REPLACE
+
+模型也可能輸出 unified diff (@@ ... @@)，同樣轉成搜尋/取代。
+
+套用時依序嘗試：完全相同 -> 忽略行尾/縮排空白 (保留原檔縮排) -> difflib 相似度最高且超過門檻的區段；
+同一段文字出現多次時視為不明確而失敗，不猜。全部成功才以暫存檔 + os.replace 原子寫入，
+.py 檔寫入前先 compile 檢查語法。
+"""
+
+import difflib
+import os
+import re
+import tempfile
+
+_BLOCK = re.compile(
+    r"^<{5,9} ?SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[^\n]*$",
+    re.MULTILINE | re.DOTALL
+)
+_HUNK = re.compile(r"^@@[^@]*@@[^\n]*$", re.MULTILINE)
+
+
+class EditError(Exception):
+    pass
+
+
+def parse_search_replace(text):
+    """[(search, replace)]"""
+    return [(m.group(1), m.group(2)) for m in _BLOCK.finditer(text)]
+
+
+def parse_unified_diff(text):
+    """unified diff 的每個 hunk 轉成 (search, replace)；檔頭 (---/+++) 略過"""
+    edits = []
+    lines = text.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        if not _HUNK.match(lines[i].rstrip("\n")):
+            i += 1
+            continue
+        i += 1
+        old, new = [], []
+        while i < len(lines) and not _HUNK.match(lines[i].rstrip("\n")) and not lines[i].startswith(("--- ", "+++ ")):
+            line = lines[i]
+            if line.startswith("```"):
+                break
+            tag, body = (line[0], line[1:]) if line[:1] in ("-", "+", " ") else (" ", line)
+            if tag in (" ", "-"):
+                old.append(body)
+            if tag in (" ", "+"):
+                new.append(body)
+            i += 1
+        if old or new:
+            edits.append(("".join(old), "".join(new)))
+    return edits
+
+
+def parse_edits(text):
+    edits = parse_search_replace(text)
+    if not edits and "@@" in text:
+        edits = parse_unified_diff(text)
+    return edits
+
+
+def _lines(text):
+    return text.splitlines(keepends=True)
+
+
+def _ensure_newline(text):
+    return text if not text or text.endswith("\n") else text + "\n"
+
+
+def _reindent(replace_lines, found_lines, search_lines):
+    """依原檔與 SEARCH 第一個非空行的縮排差，調整 REPLACE 的縮排"""
+    for f, s in zip(found_lines, search_lines):
+        if f.strip() and s.strip():
+            f_indent = f[:len(f) - len(f.lstrip())]
+            s_indent = s[:len(s) - len(s.lstrip())]
+            break
+    else:
+        return replace_lines
+    if f_indent == s_indent:
+        return replace_lines
+    out = []
+    for line in replace_lines:
+        if line.strip() and line.startswith(s_indent):
+            out.append(f_indent + line[len(s_indent):])
+        elif line.strip() and not s_indent:
+            out.append(f_indent + line)
+        else:
+            out.append(line)
+    return out
+
+
+def _find_exact(lines, search_lines):
+    n = len(search_lines)
+    return [i for i in range(len(lines) - n + 1) if lines[i:i + n] == search_lines]
+
+
+def _find_loose(lines, search_lines):
+    key = [line.strip() for line in search_lines]
+    n = len(key)
+    stripped = [line.strip() for line in lines]
+    return [i for i in range(len(lines) - n + 1) if stripped[i:i + n] == key]
+
+
+def _find_fuzzy(lines, search_lines, threshold):
+    """長度 ±2 行的視窗中相似度最高者；並列最高或低於門檻時回傳 None"""
+    target = "".join(line.strip() + "\n" for line in search_lines)
+    n = len(search_lines)
+    best, best_ratio, tie = None, 0.0, False
+    for size in range(max(1, n - 2), n + 3):
+        for i in range(len(lines) - size + 1):
+            window = "".join(line.strip() + "\n" for line in lines[i:i + size])
+            matcher = difflib.SequenceMatcher(None, target, window, autojunk=False)
+            if matcher.real_quick_ratio() < threshold or matcher.quick_ratio() < threshold:
+                continue
+            ratio = matcher.ratio()
+            if ratio > best_ratio + 1e-9:
+                best, best_ratio, tie = (i, size), ratio, False
+            elif abs(ratio - best_ratio) <= 1e-9 and best and best[0] != i:
+                tie = True
+    if best is None or best_ratio < threshold or tie:
+        return None
+    return best
+
+
+def apply_edit(text, search, replace, fuzzy_threshold=0.9):
+    """套用單一搜尋/取代，回傳 (新內容, 比對方式)"""
+    lines = _lines(text)
+    search_lines = _lines(_ensure_newline(search))
+    replace_lines = _lines(_ensure_newline(replace)) if replace else []
+    if not search.strip():
+        # 空的 SEARCH：接在檔案結尾 (新檔或附加內容)
+        return _ensure_newline(text) + "".join(replace_lines), "append"
+    if text and not text.endswith("\n") and lines:
+        lines[-1] += "\n"
+
+    for method, finder in (("exact", _find_exact), ("whitespace", _find_loose)):
+        hits = finder(lines, search_lines)
+        if len(hits) > 1:
+            raise EditError(f"SEARCH 區塊在檔案中出現 {len(hits)} 次，請多包含幾行上下文使其唯一：\n{search}")
+        if hits:
+            i, size = hits[0], len(search_lines)
+            break
+    else:
+        found = _find_fuzzy(lines, search_lines, fuzzy_threshold)
+        if found is None:
+            raise EditError(f"找不到 SEARCH 區塊 (需與原檔內容相同)：\n{search}")
+        method = "fuzzy"
+        i, size = found
+    if method != "exact":
+        replace_lines = _reindent(replace_lines, lines[i:i + size], search_lines)
+    new_text = "".join(lines[:i] + replace_lines + lines[i + size:])
+    if not text.endswith("\n") and i + size >= len(lines) and new_text.endswith("\n"):
+        new_text = new_text[:-1]
+    return new_text, method
+
+
+def apply_edits(text, edits, fuzzy_threshold=0.9):
+    """依序套用；任何一個失敗就拋出 EditError，不做部分修改。回傳 (新內容, 各區塊的比對方式)"""
+    if not edits:
+        raise EditError("沒有找到任何 SEARCH/REPLACE 區塊或 diff。")
+    methods = []
+    for search, replace in edits:
+        text, method = apply_edit(text, search, replace, fuzzy_threshold)
+        methods.append(method)
+    return text, methods
+
+
+def validate(path, text):
+    """寫入前的檢查；回傳錯誤訊息或 None"""
+    if path.endswith(".py"):
+        try:
+            compile(text, path, "exec")
+        except SyntaxError as e:
+            return f"語法錯誤 (第 {e.lineno} 行): {e.msg}"
+    elif path.endswith(".json"):
+        import json
+        try:
+            json.loads(text)
+        except ValueError as e:
+            return f"JSON 格式錯誤: {e}"
+    return None
+
+
+def atomic_write(path, text, encoding="utf-8"):
+    """寫到同目錄的暫存檔、fsync 後 os.replace，保留原檔權限；中途失敗原檔不受影響"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".edit-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding=encoding, newline="") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        except OSError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,145 @@
+"""
+離線測試用的假 llama-server。
+
+只實作 LLMBackend 會用到的端點 (/health、/completion、/slots)，回覆內容固定或回聲，
+可以在沒有模型檔的機器上驗證 server 後端、連線池與 slot 分配：
+
+    python3 -m llm_runtime.fake_server --port 8081 --reply '{"theme":"t","tasks":[]}'
+    python3 -m llm_runtime.fake_server --port 8081 --delay 0.5   # 模擬生成延遲
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLlamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, reply=None, delay=0.0, slots=2):
+        super().__init__(addr, _Handler)
+        self.reply = reply
+        self.delay = delay
+        self.slots = slots
+        self.requests = 0
+        self.connections = 0
+        self.slot_hits = {}
+        self._lock = threading.Lock()
+
+    def reply_for(self, req):
+        with self._lock:
+            self.requests += 1
+            slot = req.get("id_slot", -1)
+            self.slot_hits[slot] = self.slot_hits.get(slot, 0) + 1
+        if self.reply is not None:
+            return self.reply
+        # 回聲：取最後一段 user 內容
+        prompt = req.get("prompt", "")
+        user = prompt.rsplit("<|im_start|>user\n", 1)[-1].split("<|im_end|>", 1)[0]
+        return f"echo: {user}"
+
+    def completion(self, req):
+        content = self.reply_for(req)
+        slot = req.get("id_slot", -1)
+        if self.delay:
+            time.sleep(self.delay)
+        return {
+            "content": content,
+            "id_slot": slot,
+            "stop": True,
+            "tokens_evaluated": len(req.get("prompt", "")),
+            "tokens_predicted": len(content),
+            "timings": {"prompt_ms": 0.0, "predicted_ms": self.delay * 1000}
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive，才測得出連線池是否有重用連線
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.connections += 1
+
+    def _send(self, status, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, req):
+        """以 chunked SSE 逐字送出回覆 (與 llama-server 的 stream 模式相同格式)"""
+        content = self.server.reply_for(req)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = list(content)
+        step = self.server.delay / max(len(pieces), 1)
+        try:
+            for i, piece in enumerate(pieces + [""]):
+                event = {"content": piece, "stop": i == len(pieces)}
+                if event["stop"]:
+                    event.update(tokens_evaluated=len(req.get("prompt", "")), tokens_predicted=len(pieces))
+                data = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                if step:
+                    time.sleep(step)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/slots":
+            self._send(200, [{"id": i} for i in range(self.server.slots)])
+        elif self.path == "/stats":
+            self._send(200, {"requests": self.server.requests, "connections": self.server.connections,
+                             "slot_hits": self.server.slot_hits})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            req = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+        except ValueError:
+            self._send(400, {"error": "invalid json"})
+            return
+        if self.path == "/completion" and req.get("stream"):
+            self._send_stream(req)
+        elif self.path == "/completion":
+            self._send(200, self.server.completion(req))
+        else:
+            self._send(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_server(port=0, reply=None, delay=0.0, slots=2):
+    """在背景執行緒啟動假伺服器，回傳 (server, url)；port=0 表示自動挑選"""
+    server = FakeLlamaServer(("127.0.0.1", port), reply=reply, delay=delay, slots=slots)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake llama-server for offline testing")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--reply", default=None, help="固定回覆內容 (預設回聲)")
+    parser.add_argument("--delay", type=float, default=0.0, help="每個請求的模擬延遲秒數")
+    parser.add_argument("--slots", type=int, default=2)
+    args = parser.parse_args()
+    server = FakeLlamaServer(("127.0.0.1", args.port), reply=args.reply, delay=args.delay, slots=args.slots)
+    print(f"[*] fake llama-server: http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
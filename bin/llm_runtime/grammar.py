@@ -0,0 +1,156 @@
+"""
+JSON Schema -> GBNF 文法轉換。
+
+架構師的輸出若不是合法 JSON，就要靠 repair_json 與關鍵字比對救回，等於浪費一輪。
+把 architect_schema 轉成 GBNF 後交給各後端做受限解碼，模型只能產生符合 Schema 的 JSON。
+同一份 Schema 只轉換一次 (以正規化後的 JSON 字串為鍵快取)。
+
+支援的 Schema 子集：object (properties / required / additionalProperties)、array (items)、
+string、number、integer、boolean、null、enum、const、anyOf/oneOf 與 type 陣列；
+其餘情況退化為任意 JSON 值。
+"""
+
+import functools
+import json
+import re
+
+_PRIMITIVES = {
+    "ws": r'( " " | "\n" [ \t]{0,20} )?',
+    "char": r'[^"\\\x7F\x00-\x1F] | [\\] (["\\/bfnrt] | "u" [0-9a-fA-F]{4})',
+    "string": r'"\"" char* "\"" ws',
+    "number": r'"-"? ([0-9] | [1-9] [0-9]*) ("." [0-9]+)? ([eE] [-+]? [0-9]+)? ws',
+    "integer": r'"-"? ([0-9] | [1-9] [0-9]*) ws',
+    "boolean": r'("true" | "false") ws',
+    "null": r'"null" ws',
+    "value": r'object | array | string | number | boolean | null',
+    "object": r'"{" ws ( string ":" ws value ( "," ws string ":" ws value )* )? "}" ws',
+    "array": r'"[" ws ( value ( "," ws value )* )? "]" ws',
+}
+
+# 各基本型別需要連帶輸出的規則
+_DEPENDS = {
+    "string": ["ws", "char"],
+    "number": ["ws"],
+    "integer": ["ws"],
+    "boolean": ["ws"],
+    "null": ["ws"],
+    "value": ["object", "array", "string", "number", "boolean", "null"],
+    "object": ["ws", "string", "value"],
+    "array": ["ws", "value"],
+}
+
+
+def gbnf_literal(text):
+    """把字串轉成 GBNF 的字面值"""
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+    return f'"{escaped}"'
+
+
+class _Converter:
+    def __init__(self):
+        self.rules = {}
+        self.used = set()
+
+    def _use(self, name):
+        if name in self.used:
+            return name
+        self.used.add(name)
+        for dep in _DEPENDS.get(name, []):
+            self._use(dep)
+        return name
+
+    def _add(self, hint, body):
+        base = re.sub(r"[^a-zA-Z0-9-]+", "-", hint).strip("-") or "rule"
+        name = base
+        i = 1
+        while name in self.rules or name in _PRIMITIVES:
+            name = f"{base}{i}"
+            i += 1
+        self.rules[name] = body
+        return name
+
+    def visit(self, schema, hint):
+        if not isinstance(schema, dict) or not schema:
+            return self._use("value")
+
+        if "const" in schema:
+            self._use("ws")
+            return self._add(hint, f"{gbnf_literal(json.dumps(schema['const'], ensure_ascii=False))} ws")
+
+        if "enum" in schema:
+            self._use("ws")
+            alts = " | ".join(gbnf_literal(json.dumps(v, ensure_ascii=False)) for v in schema["enum"])
+            return self._add(hint, f"({alts}) ws")
+
+        for key in ("anyOf", "oneOf"):
+            if key in schema:
+                alts = [self.visit(sub, f"{hint}-{i}") for i, sub in enumerate(schema[key])]
+                return self._add(hint, " | ".join(alts))
+
+        stype = schema.get("type")
+        if isinstance(stype, list):
+            alts = [self.visit(dict(schema, type=t), f"{hint}-{t}") for t in stype]
+            return self._add(hint, " | ".join(alts))
+
+        if stype == "object":
+            return self._object(schema, hint)
+        if stype == "array":
+            if "items" not in schema:
+                return self._use("array")
+            item = self.visit(schema["items"], f"{hint}-item")
+            self._use("ws")
+            return self._add(hint, f'"[" ws ( {item} ( "," ws {item} )* )? "]" ws')
+        if stype in ("string", "number", "integer", "boolean", "null"):
+            return self._use(stype)
+        return self._use("value")
+
+    def _object(self, schema, hint):
+        props = schema.get("properties") or {}
+        if not props:
+            return self._use("object")
+        self._use("ws")
+        self._use("string")
+        required = [k for k in props if k in schema.get("required", [])]
+        optional = [k for k in props if k not in required]
+
+        kv = {}
+        for key in required + optional:
+            value = self.visit(props[key], f"{hint}-{key}")
+            kv[key] = self._add(f"{hint}-{key}-kv", f'{gbnf_literal(json.dumps(key, ensure_ascii=False))} ws ":" ws {value}')
+
+        if required:
+            # 必填欄位依宣告順序在前，選填欄位依序可省略
+            body = ' "," ws '.join(kv[k] for k in required)
+            for key in optional:
+                body += f' ( "," ws {kv[key]} )?'
+        else:
+            # 全部選填：從第 i 個欄位開始，後面的欄位依序可省略
+            alts = []
+            for i, key in enumerate(optional):
+                alt = kv[key]
+                for rest in optional[i + 1:]:
+                    alt += f' ( "," ws {kv[rest]} )?'
+                alts.append(alt)
+            body = f"( {' | '.join(alts)} )?"
+        return self._add(hint, f'"{{" ws {body} "}}" ws')
+
+    def render(self, root):
+        lines = [f"root ::= {root}"]
+        for name, body in self.rules.items():
+            lines.append(f"{name} ::= {body}")
+        for name in _PRIMITIVES:
+            if name in self.used:
+                lines.append(f"{name} ::= {_PRIMITIVES[name]}")
+        return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=32)
+def _compile(canonical_schema):
+    conv = _Converter()
+    root = conv.visit(json.loads(canonical_schema), "schema")
+    return conv.render(root)
+
+
+def schema_to_gbnf(schema):
+    """把 JSON Schema 轉成 GBNF 文法字串 (結果快取，同一份 Schema 只轉換一次)"""
+    return _compile(json.dumps(schema, ensure_ascii=False))
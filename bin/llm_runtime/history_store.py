@@ -0,0 +1,168 @@
+"""
+只附加 (append-only) 的對話紀錄。
+
+原本每輪結束 save_history 都以 indent=2 重寫整個 pi_ai_state.json，啟動時也要解析整個檔案，
+同一個子聊天室若有兩個行程同時寫入，後寫的會蓋掉先寫的。
+
+改用 SQLite (WAL 模式)：
+- append() 在一個交易內附加新訊息，多個行程同時附加由 SQLite 的鎖序列化 (busy_timeout 等待)
+- tail(n) 只讀最後 n 筆 (主鍵遞增，反向索引掃描)，啟動成本與總筆數無關
+- 筆數超過 keep 的兩倍時在背景執行緒刪掉舊紀錄並 checkpoint WAL
+- 第一次開啟時若資料庫是空的，匯入舊的 pi_ai_state.json
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    extra TEXT,
+    created REAL NOT NULL
+)
+"""
+
+
+class HistoryStore:
+    def __init__(self, path, keep=5000, legacy_file=None, busy_timeout=10.0):
+        """
+        :param keep: 保留的最少筆數，超過兩倍時背景壓縮到這個數量
+        :param legacy_file: 舊格式的 JSON 歷史檔，資料庫為空時匯入
+        """
+        self.path = path
+        self.keep = keep
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._compacting = threading.Lock()
+        self._compact_thread = None
+        conn = self._conn()
+        with conn:
+            conn.execute(_SCHEMA)
+        if legacy_file:
+            self._import_legacy(legacy_file)
+
+    def _conn(self):
+        # sqlite3 連線不可跨執行緒共用，每個執行緒各自一條
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _import_legacy(self, legacy_file):
+        if not os.path.exists(legacy_file):
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None:
+                try:
+                    with open(legacy_file, "r", encoding="utf-8") as f:
+                        entries = json.load(f)
+                except (OSError, ValueError):
+                    entries = []
+                if isinstance(entries, list):
+                    self._insert(conn, [e for e in entries if isinstance(e, dict)])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _insert(conn, entries):
+        now = time.time()
+        rows = []
+        for e in entries:
+            extra = {k: v for k, v in e.items() if k not in ("role", "content")}
+            content = e.get("content", "")
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False)
+            rows.append((e.get("role", ""), content, json.dumps(extra, ensure_ascii=False) if extra else None, now))
+        conn.executemany("INSERT INTO messages (role, content, extra, created) VALUES (?, ?, ?, ?)", rows)
+
+    def append(self, entries):
+        """在一個交易內附加多筆 {"role", "content", ...}"""
+        if not entries:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert(conn, entries)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._maybe_compact()
+
+    def tail(self, n):
+        """最後 n 筆，依時間順序"""
+        rows = self._conn().execute(
+            "SELECT role, content, extra FROM messages ORDER BY id DESC LIMIT ?", (int(n),)
+        ).fetchall()
+        history = []
+        for role, content, extra in reversed(rows):
+            entry = {"role": role, "content": content}
+            if extra:
+                entry.update(json.loads(extra))
+            history.append(entry)
+        return history
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def compact(self):
+        """只留最後 keep 筆並把 WAL 併回主檔"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT MAX(id) FROM messages").fetchone()
+            removed = 0
+            if row[0] is not None:
+                removed = conn.execute("DELETE FROM messages WHERE id <= ?", (row[0] - self.keep,)).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def _maybe_compact(self):
+        if not self.keep:
+            return
+        # 以 id 範圍粗估筆數 (不必 COUNT 全表)
+        row = self._conn().execute("SELECT MIN(id), MAX(id) FROM messages").fetchone()
+        if row[0] is None or row[1] - row[0] + 1 <= self.keep * 2:
+            return
+        if not self._compacting.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.compact()
+            except sqlite3.Error:
+                pass  # 其他行程正在壓縮或鎖定，下次再說
+            finally:
+                self._compacting.release()
+        self._compact_thread = threading.Thread(target=run, name="history-compact", daemon=True)
+        self._compact_thread.start()
+
+    def wait_compaction(self, timeout=None):
+        thread = self._compact_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,260 @@
+"""
+依記憶體預算管理 llama_cpp 模型。
+
+一輪可能用到 architect、coder、chatter 三個模型，若每個都以 32k context 常駐，
+在 RPi 這類小記憶體裝置上很快就被 OOM killer 砍掉或陷入 swap。
+ModelManager 依 ai_config.MODEL_SETTINGS 為每個模型設定 n_ctx / n_batch / KV 型別，
+第一次使用時才載入，預估會超出 MODEL_RAM_BUDGET_MB 時先卸載最久未使用的閒置模型。
+預算只計匿名記憶體 (KV cache、計算緩衝區)：use_mmap 的權重是檔案頁面，記憶體不足時核心可以直接丟掉、
+之後再從檔案讀回，不會 OOM；關閉 mmap 或開啟 mlock 時權重才計入。
+設定了 "speculative" 的模型以 speculative.SpeculativeLlama 載入 (推測解碼，猜測用的小模型一併計入預算)。
+
+使用中的模型不會被卸載：
+
+    with manager.use(model_path) as llama:
+        llama(...)
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ai_config import MODELS, MODEL_RAM_BUDGET_MB, MODEL_DEFAULTS, MODEL_SETTINGS
+from .tracing import record_usage
+
+# KV cache 每個元素的位元組數 (相對 f16 = 2 bytes)
+_KV_TYPE_BYTES = {"f32": 4.0, "f16": 2.0, "q8_0": 1.0625, "q5_1": 0.75, "q5_0": 0.6875, "q4_1": 0.625, "q4_0": 0.5625}
+# llama.cpp 計算緩衝區等固定開銷的粗估
+_OVERHEAD_BYTES = 64 * 1024 * 1024
+
+
+def model_key_for(model_path):
+    """由模型檔路徑反查 ai_config.MODELS 的鍵 (daemon 收到的是路徑)"""
+    real = os.path.realpath(model_path)
+    for key, path in MODELS.items():
+        if os.path.realpath(path) == real:
+            return key
+    return None
+
+
+def settings_for(model_path):
+    opts = dict(MODEL_DEFAULTS)
+    opts.update(MODEL_SETTINGS.get(model_key_for(model_path), {}))
+    return opts
+
+
+def draft_settings(spec, opts):
+    """推測解碼小模型的 (路徑, 設定)；context 需與主模型一樣長才放得下整個 prompt"""
+    if not spec or spec.get("type") != "model":
+        return None, None
+    draft_path = MODELS.get(spec.get("draft", "chatter"))
+    if not draft_path or not os.path.exists(draft_path):
+        return None, None
+    draft_opts = settings_for(draft_path)
+    draft_opts["n_ctx"] = opts.get("n_ctx", draft_opts.get("n_ctx", 4096))
+    draft_opts.pop("ram_mb", None)
+    draft_opts.pop("speculative", None)
+    return draft_path, draft_opts
+
+
+def estimate_bytes(model_path, opts):
+    """KV cache + 固定開銷 (+ 非 mmap/mlock 的權重、推測解碼的小模型)；設定了 ram_mb 時以設定值為準"""
+    if opts.get("ram_mb"):
+        return int(opts["ram_mb"] * 1024 * 1024)
+    draft_path, draft_opts = draft_settings(opts.get("speculative"), opts)
+    extra = estimate_bytes(draft_path, draft_opts) if draft_path else 0
+    weights = 0
+    if (not opts.get("use_mmap", True) or opts.get("use_mlock")) and os.path.exists(model_path):
+        # 讀進匿名記憶體或鎖在記憶體中的權重無法被核心回收
+        weights = os.path.getsize(model_path)
+    # kv_bytes_per_token 以 f16 計 (n_layer * 2 * n_kv_head * head_dim * 2)，依 KV 型別縮放
+    kv_f16 = opts.get("kv_bytes_per_token", 32 * 1024)
+    k_scale = _KV_TYPE_BYTES.get(opts.get("type_k", "f16"), 2.0) / 2.0
+    v_scale = _KV_TYPE_BYTES.get(opts.get("type_v", "f16"), 2.0) / 2.0
+    kv = int(opts.get("n_ctx", 4096) * kv_f16 * (k_scale + v_scale) / 2)
+    return weights + kv + _OVERHEAD_BYTES + extra
+
+
+def llama_kwargs(model_path, opts):
+    """把 MODEL_SETTINGS 轉成 llama_cpp.Llama 的參數"""
+    import llama_cpp
+    kwargs = {
+        "model_path": model_path,
+        "n_ctx": opts.get("n_ctx", 4096),
+        "n_batch": opts.get("n_batch", 256),
+        "n_threads": opts.get("n_threads", 4),
+        "n_gpu_layers": 0,
+        "use_mmap": opts.get("use_mmap", True),
+        "use_mlock": opts.get("use_mlock", False),
+        "verbose": False
+    }
+    for name in ("type_k", "type_v"):
+        if opts.get(name):
+            kwargs[name] = getattr(llama_cpp, f"GGML_TYPE_{opts[name].upper()}")
+    # 量化的 V cache 需要 flash attention
+    if opts.get("type_v", "f16") not in ("f16", "f32") or opts.get("flash_attn"):
+        kwargs["flash_attn"] = True
+    return kwargs
+
+
+def load_llama(model_path, opts):
+    """預設的載入函式"""
+    import llama_cpp
+    spec = opts.get("speculative")
+    if spec and spec.get("type") == "model" and draft_settings(spec, opts)[0] is None:
+        print(f"[-] 找不到推測解碼用的模型 {spec.get('draft')}，{os.path.basename(model_path)} 不使用推測解碼",
+              file=sys.stderr, flush=True)
+        spec = None
+    if not spec:
+        return llama_cpp.Llama(**llama_kwargs(model_path, opts))
+    from .speculative import SpeculativeLlama, make_draft
+
+    def load_draft(model_key):
+        draft_path, draft_opts = draft_settings(spec, opts)
+        return llama_cpp.Llama(**llama_kwargs(draft_path, draft_opts))
+
+    return SpeculativeLlama(draft=make_draft(spec, load_draft), **llama_kwargs(model_path, opts))
+
+
+class _Slot:
+    def __init__(self, llama, size):
+        self.llama = llama
+        self.size = size
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class ModelManager:
+    def __init__(self, budget_mb=MODEL_RAM_BUDGET_MB, loader=None):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.used_bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        self._loader = loader or load_llama
+        self.last_load_seconds = 0.0
+        self._slots = OrderedDict()
+        self._loading = set()
+        self._cond = threading.Condition()
+        # 卸載模型時通知其他快取 (例如前綴 KV 快照) 一併清掉
+        self.on_evict = []
+
+    def _evict_for(self, need):
+        """卸載閒置模型直到放得下；回傳是否已放得下"""
+        while self.used_bytes + need > self.budget_bytes:
+            idle = [p for p, s in self._slots.items() if s.users == 0]
+            if not idle:
+                return False
+            path = idle[0]
+            slot = self._slots.pop(path)
+            self.used_bytes -= slot.size
+            self.evictions += 1
+            if hasattr(slot.llama, "close"):
+                slot.llama.close()
+            for cb in self.on_evict:
+                cb(path)
+            print(f"[*] 記憶體預算不足，卸載模型 {os.path.basename(path)}", file=sys.stderr, flush=True)
+        return True
+
+    def _reserve(self, model_path):
+        """取得 (必要時載入) 模型並把使用者計數加一"""
+        model_path = os.path.realpath(model_path)
+        with self._cond:
+            while True:
+                slot = self._slots.get(model_path)
+                if slot is not None:
+                    self._slots.move_to_end(model_path)
+                    slot.users += 1
+                    return model_path, slot
+                if model_path in self._loading:
+                    # 另一個執行緒正在載入同一個模型，等它完成
+                    self._cond.wait()
+                    continue
+                opts = settings_for(model_path)
+                need = estimate_bytes(model_path, opts)
+                if self._evict_for(need):
+                    break
+                if not self._loading and not any(s.users for s in self._slots.values()):
+                    break
+                # 其他模型正在使用，等它們用完再卸載
+                self._cond.wait()
+            if need > self.budget_bytes:
+                print(f"[-] 模型 {os.path.basename(model_path)} 預估 {need >> 20}MB 超過預算 "
+                      f"{self.budget_bytes >> 20}MB，仍嘗試載入", file=sys.stderr, flush=True)
+            # 載入期間先佔住預算，避免其他執行緒同時載入而超額
+            self.used_bytes += need
+            self._loading.add(model_path)
+        try:
+            t0 = time.time()
+            llama = self._loader(model_path, opts)
+            self.last_load_seconds = time.time() - t0
+            record_usage(load_seconds=self.last_load_seconds)
+        except Exception:
+            with self._cond:
+                self.used_bytes -= need
+                self._loading.discard(model_path)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._loading.discard(model_path)
+            slot = _Slot(llama, need)
+            slot.users += 1
+            self._slots[model_path] = slot
+            self.loads += 1
+            self._cond.notify_all()
+            return model_path, slot
+
+    def _release(self, model_path, slot):
+        with self._cond:
+            slot.users -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def use(self, model_path):
+        """獨佔使用一個模型 (llama_cpp 非 thread-safe)，期間不會被卸載"""
+        model_path, slot = self._reserve(model_path)
+        try:
+            with slot.lock:
+                yield slot.llama
+        finally:
+            self._release(model_path, slot)
+
+    def load(self, model_path):
+        """預先載入 (daemon 預載用)"""
+        model_path, slot = self._reserve(model_path)
+        self._release(model_path, slot)
+        return slot.llama
+
+    def admission(self, model_path):
+        """
+        排程用的記憶體准入："loaded" 已載入 (或載入中)；"fits" 卸載閒置模型後放得下
+        (沒有其他模型在使用時也算，同 _reserve)；None 要等使用中的模型結束
+        """
+        model_path = os.path.realpath(model_path)
+        with self._cond:
+            if model_path in self._slots or model_path in self._loading:
+                return "loaded"
+            busy = self.used_bytes - sum(s.size for s in self._slots.values() if s.users == 0)
+            if busy <= 0 or busy + estimate_bytes(model_path, settings_for(model_path)) <= self.budget_bytes:
+                return "fits"
+            return None
+
+    def loaded(self):
+        with self._cond:
+            return list(self._slots.keys())
+
+    def close(self):
+        with self._cond:
+            for slot in self._slots.values():
+                if hasattr(slot.llama, "close"):
+                    slot.llama.close()
+            self._slots.clear()
+            self.used_bytes = 0
+
+    def stats(self):
+        with self._cond:
+            return {"budget_bytes": self.budget_bytes, "used_bytes": self.used_bytes,
+                    "models": {p: {"bytes": s.size, "users": s.users} for p, s in self._slots.items()},
+                    "loads": self.loads, "evictions": self.evictions}
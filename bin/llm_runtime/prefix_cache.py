@@ -0,0 +1,74 @@
+"""
+系統提示前綴 KV cache。
+
+架構師每一輪都送出同一段數 KB 的 architect_sys，coder 工具也各自有固定的系統訊息；
+在純 CPU 的機器上每次重新 prefill 這些 token 是最大的單輪成本。
+這裡以 (模型, 系統提示 hash) 為鍵保存 prefill 完前綴後的 llama 狀態快照，
+下次遇到相同前綴時直接還原，只需要 prefill 使用者訊息的部分。
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def prefix_key(model_id, prefix_text):
+    return hashlib.sha1(f"{model_id}\0{prefix_text}".encode("utf-8")).hexdigest()
+
+
+def state_size(state):
+    """llama_cpp.LlamaState 的大小 (bytes)，其他物件以 len() 估算"""
+    size = getattr(state, "llama_state_size", None)
+    if size is None:
+        try:
+            size = len(state)
+        except TypeError:
+            size = 0
+    return int(size)
+
+
+class PrefixCache:
+    """多 slot 的前綴狀態快取，超過容量時淘汰最久未使用的快照"""
+
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, state, model_id=None):
+        size = state_size(state)
+        if size > self.capacity_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= self._entries.pop(key)[1]
+            while self._entries and self.used_bytes + size > self.capacity_bytes:
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self.used_bytes -= old_size
+            self._entries[key] = (state, size, model_id)
+            self.used_bytes += size
+        return True
+
+    def drop(self, model_id):
+        """模型被卸載時一併清掉它的快照"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e[2] == model_id]:
+                self.used_bytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "used_bytes": self.used_bytes,
+                    "capacity_bytes": self.capacity_bytes, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,272 @@
+"""
+專案目錄走訪 (project_reader 等使用)。
+
+原本 project_reader 每次都以 os.walk 走完整棵樹，不分 .git、models/、llama.bin/，
+指到真正的專案時回傳好幾 MB 的文字，架構師還得再 prefill 一次。
+
+ProjectTree：
+- 以 os.scandir 走訪，遵守各層的 .gitignore 與固定的忽略清單，被忽略的目錄不會進入
+- 有深度上限與項目上限；上限內以廣度優先選取 (先保住上層結構)，輸出時再排成樹狀
+- 各目錄的原始列表連同目錄 mtime 存在磁碟快取，mtime 沒變的目錄不必重新 scandir
+  (新增/刪除/改名項目都會改變所在目錄的 mtime；.gitignore 每次重新讀取，改了規則立即生效)
+
+    tree = ProjectTree(".", ignore=[".git", "models/"], cache_file=".pi_ai_cache/project_tree.json")
+    print(tree.render(max_depth=4, max_entries=400))
+    for rel in tree.files(): ...
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+_cache_lock = threading.Lock()
+# 快取的目錄數超過此值時只保留最近一次走訪到的目錄
+_MAX_CACHED_DIRS = 5000
+# mtime 距今不到這麼久的目錄不寫入快取 (同一個 mtime 刻度內可能還有變動，同 git 的 racy 檢查)
+_RACY_SECONDS = 2.0
+
+
+def _glob_to_regex(pattern):
+    """gitignore 的 glob 轉成 regex (不含頭尾錨點)"""
+    out, i, n = [], 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class IgnoreRules:
+    """.gitignore 規則的子集：註解、! 反向、結尾 / 只比對目錄、含 / 的規則錨定在所在目錄、* ? [] **"""
+
+    def __init__(self, patterns=None):
+        self.rules = []
+        for pattern in patterns or []:
+            self.add(pattern, "")
+
+    def add(self, line, base):
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            return
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return
+        anchored = "/" in line
+        line = line.lstrip("/")
+        prefix = re.escape(base + "/") if base else ""
+        if anchored:
+            regex = re.compile(f"^{prefix}{_glob_to_regex(line)}$")
+        else:
+            regex = re.compile(f"^{prefix}(?:.*/)?{_glob_to_regex(line)}$")
+        self.rules.append((regex, negate, dir_only))
+
+    def add_file(self, path, base):
+        try:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                for line in f:
+                    self.add(line, base)
+        except OSError:
+            pass
+
+    def extended(self, path, base):
+        """加上 path (子目錄的 .gitignore) 規則的新物件，上層規則不受影響"""
+        child = IgnoreRules()
+        child.rules = list(self.rules)
+        child.add_file(path, base)
+        return child
+
+    def ignored(self, rel, is_dir):
+        result = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel):
+                result = not negate
+        return result
+
+
+class ProjectTree:
+    def __init__(self, root, ignore=None, cache_file=None):
+        self.root = os.path.realpath(root)
+        self.ignore = list(ignore or [])
+        self.cache_file = cache_file
+        self.stats = {"dirs": 0, "scanned": 0, "cached": 0}
+        self._listings = None
+        self._visited = set()
+        self._dirty = False
+
+    # --- 目錄列表快取 ---
+
+    def _load_cache(self):
+        if self._listings is not None:
+            return
+        self._listings = {}
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                self._listings = json.load(f).get(self.root, {})
+        except (OSError, ValueError, AttributeError):
+            self._listings = {}
+
+    def _save_cache(self):
+        if not self.cache_file or not self._dirty:
+            return
+        with _cache_lock:
+            try:
+                with open(self.cache_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            if len(self._listings) > _MAX_CACHED_DIRS:
+                self._listings = {k: v for k, v in self._listings.items() if k in self._visited}
+            data[self.root] = self._listings
+            try:
+                os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+                tmp = f"{self.cache_file}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp, self.cache_file)
+            except OSError:
+                pass  # 寫不進去就下次重新 scandir
+        self._dirty = False
+
+    def _list(self, rel):
+        """[(名稱, 是否目錄)]；目錄 mtime 與快取相同時直接沿用"""
+        path = os.path.join(self.root, rel) if rel else self.root
+        self.stats["dirs"] += 1
+        self._visited.add(rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        cached = self._listings.get(rel)
+        if cached and cached[0] == mtime:
+            self.stats["cached"] += 1
+            return cached[1]
+        entries = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    entries.append([entry.name, is_dir])
+        except OSError:
+            return []
+        entries.sort(key=lambda e: e[0])
+        self.stats["scanned"] += 1
+        if time.time() - mtime / 1e9 >= _RACY_SECONDS:
+            self._listings[rel] = [mtime, entries]
+            self._dirty = True
+        else:
+            self._listings.pop(rel, None)
+        return entries
+
+    # --- 走訪 ---
+
+    def walk(self, max_depth=None, max_entries=None):
+        """
+        廣度優先走訪，回傳 (項目, 被截掉的數量)：
+        項目是 {目錄相對路徑: [(名稱, 是否目錄), ...]}，被截掉的數量是 {目錄相對路徑: 數量}
+        """
+        self._load_cache()
+        base_rules = IgnoreRules(self.ignore)
+        children, omitted = {}, {}
+        total = 0
+        queue = deque([("", 0, base_rules)])
+        while queue:
+            rel, depth, rules = queue.popleft()
+            entries = self._list(rel)
+            if any(name == ".gitignore" and not is_dir for name, is_dir in entries):
+                rules = rules.extended(os.path.join(self.root, rel, ".gitignore"), rel)
+            kept = []
+            for name, is_dir in entries:
+                child = f"{rel}/{name}" if rel else name
+                if rules.ignored(child, is_dir):
+                    continue
+                if max_entries is not None and total >= max_entries:
+                    omitted[rel] = omitted.get(rel, 0) + 1
+                    continue
+                total += 1
+                kept.append((name, is_dir))
+                if is_dir and (max_depth is None or depth + 1 < max_depth):
+                    queue.append((child, depth + 1, rules))
+            children[rel] = kept
+        self._save_cache()
+        return children, omitted
+
+    def files(self, max_depth=None):
+        """所有未被忽略的檔案相對路徑 (依目錄順序)"""
+        children, _ = self.walk(max_depth=max_depth)
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            subdirs = []
+            for name, is_dir in children.get(rel, []):
+                child = f"{rel}/{name}" if rel else name
+                if is_dir:
+                    subdirs.append(child)
+                else:
+                    yield child
+            stack.extend(reversed(subdirs))
+
+    def render(self, max_depth=None, max_entries=None):
+        """與原本 project_reader 相同的縮排格式：目錄名稱後加 /，每層縮排四格"""
+        children, omitted = self.walk(max_depth, max_entries)
+        lines = [f"{os.path.basename(self.root) or self.root}/"]
+
+        def emit(rel, level):
+            indent = "    " * level
+            entries = children.get(rel, [])
+            for name, is_dir in entries:
+                if not is_dir:
+                    lines.append(f"{indent}{name}")
+            for name, is_dir in entries:
+                if not is_dir:
+                    continue
+                child = f"{rel}/{name}" if rel else name
+                if child in children:
+                    lines.append(f"{indent}{name}/")
+                    emit(child, level + 1)
+                else:
+                    lines.append(f"{indent}{name}/ ...")  # 超過深度上限，未展開
+            if omitted.get(rel):
+                lines.append(f"{indent}... (還有 {omitted[rel]} 項未列出)")
+
+        emit("", 1)
+        return "\n".join(lines)
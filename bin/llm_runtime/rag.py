@@ -0,0 +1,263 @@
+"""
+延遲載入的 RAG (rag_tool) 存取。
+
+rag_tool 一 import 就會載入 Chroma 並開啟 rag_data/ 的向量庫，原本 chatcall.py 在模組載入時就付這筆成本，
+連只是打招呼、由快速路由直接交給 chatter 的訊息也一樣。
+
+LazyRag 只用 find_spec 確認 rag_tool 是否存在；真正的 import 由 warm() 在背景執行緒進行，
+查詢以 submit() 丟到小型執行緒池，可彼此並行，也可與組提示、載入模型同時進行。
+
+    rag = LazyRag()
+    rag.warm()                                   # 背景 import
+    fut = rag.submit("rag_query_knowledge", text, n_results=3)
+    ...
+    value, ms = fut.result()
+    rag.rag_store_knowledge(...)                 # 直接呼叫 (必要時等 import 完成)
+
+快取 (每一輪都以 next_input 查詢知識與失敗經驗，接力時的查詢幾乎相同，Pi 的 CPU 上算向量佔每輪不少時間)：
+- 向量：import 後把 rag_tool 中 Chroma collection 的 embedding function (及模組層級的 embedding function 物件)
+  換成 CachedEmbedding，以正規化 (合併空白) 後文字的雜湊為鍵做 LRU，同一段文字只算一次
+- 查詢結果：rag_query_* 的回傳值以 (函式, 正規化參數) 為鍵保留 result_ttl 秒；任何 rag_store_* 寫入後全部作廢，
+  寫入期間開始的查詢結果不會被存入
+"""
+
+import collections
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def normalize_text(text):
+    return " ".join(str(text).split())
+
+
+def text_key(text):
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CachedEmbedding:
+    """
+    包裝 Chroma 的 embedding function (以 input=[文字...] 呼叫，回傳向量串列)，只替快取中沒有的文字計算。
+    embed_query (查詢用向量，部分模型與文件向量不同) 另外分開快取；其餘屬性 (name、get_config...) 轉給原物件。
+    """
+
+    def __init__(self, inner, cache):
+        self.inner = inner
+        self.cache = cache
+
+    def _embed(self, kind, method, input):
+        texts = [input] if isinstance(input, str) else list(input)
+        keys = [(kind, text_key(t)) for t in texts]
+        vectors = [self.cache.get(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            computed = method(input=[texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+                self.cache.put(keys[i], vector)
+        return vectors
+
+    def __call__(self, input):
+        return self._embed("doc", self.inner, input)
+
+    def embed_query(self, input):
+        return self._embed("query", self.inner.embed_query, input)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+
+def install_embedding_cache(module, cache):
+    """把模組中的 embedding function 換成 CachedEmbedding，回傳替換的數量"""
+    count = 0
+    for name, value in list(vars(module).items()):
+        if name.startswith("__") or inspect.ismodule(value) or inspect.isclass(value) or inspect.isroutine(value):
+            continue
+        ef = getattr(value, "_embedding_function", None)
+        if ef is not None and not isinstance(ef, CachedEmbedding):
+            # Chroma collection：query/add 時以 self._embedding_function 計算向量
+            try:
+                setattr(value, "_embedding_function", CachedEmbedding(ef, cache))
+                count += 1
+            except (AttributeError, TypeError, ValueError):
+                pass
+        elif "embed" in name.lower() and callable(value) and not isinstance(value, CachedEmbedding):
+            # 模組層級的 embedding function 物件 (每次呼叫才 get_or_create_collection 的寫法)
+            setattr(module, name, CachedEmbedding(value, cache))
+            count += 1
+    return count
+
+
+class LazyRag:
+    def __init__(self, module_name="rag_tool", max_workers=2, embed_cache_size=256, result_ttl=120):
+        """
+        :param embed_cache_size: 向量 LRU 的筆數 (0 = 不快取)
+        :param result_ttl: rag_query_* 結果的保留秒數 (0 = 不快取)
+        """
+        self.module_name = module_name
+        self.max_workers = max_workers
+        self.import_seconds = None
+        self.embeddings = LRUCache(embed_cache_size)
+        self.result_ttl = result_ttl
+        self.result_hits = 0
+        self.result_misses = 0
+        self._results = {}      # key -> (到期時間, 回傳值)
+        self._generation = 0    # 每次寫入 +1，作廢寫入前開始的查詢
+        self._module = None
+        self._error = None
+        self._thread = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def installed(self):
+        """只找模組位置，不 import (不付 Chroma 的載入成本)"""
+        try:
+            return importlib.util.find_spec(self.module_name) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def _load(self):
+        t0 = time.perf_counter()
+        try:
+            module = importlib.import_module(self.module_name)
+            if self.embeddings.maxsize > 0:
+                install_embedding_cache(module, self.embeddings)
+            self._module = module
+        except Exception as e:
+            self._error = e
+        self.import_seconds = time.perf_counter() - t0
+
+    def warm(self):
+        """在背景執行緒 import rag_tool (已在進行或已完成則不做事)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, name="rag-warm", daemon=True)
+                self._thread.start()
+
+    def module(self):
+        """等 import 完成並回傳模組；import 失敗時拋出 ImportError"""
+        self.warm()
+        self._thread.join()
+        if self._module is None:
+            raise ImportError(f"無法載入 {self.module_name}: {self._error}")
+        return self._module
+
+    def loaded(self):
+        """背景 import 是否成功 (尚未開始時回傳 False，進行中則等它完成)"""
+        if self._thread is None:
+            return False
+        self._thread.join()
+        return self._module is not None
+
+    # --- 查詢結果快取 ---
+
+    def _result_key(self, func_name, args, kwargs):
+        if not func_name.startswith("rag_query_") or self.result_ttl <= 0:
+            return None
+        norm = [normalize_text(a) if isinstance(a, str) else a for a in args]
+        try:
+            return func_name + ":" + json.dumps([norm, kwargs], sort_keys=True, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return None
+
+    def cached_result(self, func_name, *args, **kwargs):
+        """未過期的查詢結果；沒有時回傳 None"""
+        key = self._result_key(func_name, args, kwargs)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.result_hits += 1
+                return entry[1]
+            self._results.pop(key, None)
+            self.result_misses += 1
+        return None
+
+    def invalidate(self):
+        """向量庫有寫入：作廢所有查詢結果 (向量只與文字有關，不受影響)"""
+        with self._lock:
+            self._generation += 1
+            self._results.clear()
+
+    def _call(self, func_name, args, kwargs):
+        func = getattr(self.module(), func_name)
+        key = self._result_key(func_name, args, kwargs)
+        generation = self._generation
+        try:
+            value = func(*args, **kwargs)
+        finally:
+            if func_name.startswith("rag_store_"):
+                self.invalidate()
+        if key is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._results[key] = (time.monotonic() + self.result_ttl, value)
+        return value
+
+    def cache_stats(self):
+        return {"embedding_hits": self.embeddings.hits, "embedding_misses": self.embeddings.misses,
+                "embeddings": len(self.embeddings),
+                "result_hits": self.result_hits, "result_misses": self.result_misses}
+
+    def submit(self, func_name, *args, **kwargs):
+        """在背景執行 rag_tool 的函式，Future 的結果是 (回傳值, 耗時毫秒)；命中查詢快取時 future.cached 為 True"""
+        value = self.cached_result(func_name, *args, **kwargs)
+        if value is not None:
+            future = Future()
+            future.cached = True
+            future.set_result((value, 0.0))
+            return future
+        self.warm()
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rag")
+
+        def run():
+            t0 = time.perf_counter()
+            value = self._call(func_name, args, kwargs)
+            return value, (time.perf_counter() - t0) * 1000
+        return self._pool.submit(run)
+
+    def __getattr__(self, name):
+        if name.startswith(("rag_query_", "rag_store_")):
+            getattr(self.module(), name)
+            return lambda *args, **kwargs: self._call(name, args, kwargs)
+        if name.startswith("rag_"):
+            return getattr(self.module(), name)
+        raise AttributeError(name)
@@ -0,0 +1,137 @@
+"""
+低溫度 (近乎確定性) 呼叫的磁碟回應快取。
+
+同一個檔案分析兩次、同一句問候、同一段接力續行，在 temp=0.1/0.2 下幾乎一定得到相同結果，
+卻每次都要完整生成一次。這裡以 (模型檔路徑/mtime/大小、完整 prompt、系統提示、temperature、
+n_tokens、schema) 的 hash 為鍵把結果存到磁碟，命中時直接回傳。
+
+每筆一個檔案 (<root>/<前兩碼>/<key>.json)，讀取時更新 mtime，
+總量超過上限時刪除 mtime 最舊的檔案 (LRU)。put 只累加自己寫入的大小，超過上限
+(或每 rescan_every 次，涵蓋其他行程寫入的量) 才走訪整個目錄，SD 卡上不必每次呼叫都 stat 所有檔案。
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from ai_config import MODELS
+
+
+def model_fingerprint(model_key):
+    """模型檔換掉 (mtime/大小改變) 後舊的快取自然失效；遠端模型 (llama-server) 只能用名稱"""
+    path = MODELS.get(model_key)
+    if path and os.path.exists(path):
+        st = os.stat(path)
+        return f"{os.path.realpath(path)}:{st.st_mtime_ns}:{st.st_size}"
+    return f"{model_key}:{path}"
+
+
+class ResponseCache:
+    def __init__(self, root, max_mb=64, rescan_every=200):
+        self.root = root
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.rescan_every = rescan_every
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._approx_bytes = None   # 上次走訪的總量 + 之後寫入的大小；None 表示還沒走訪過
+        self._puts_since_scan = 0
+
+    def make_key(self, model_key, prompt, system_prompt, temp, n_tokens, schema, **extra):
+        material = json.dumps({
+            "model": model_fingerprint(model_key),
+            "prompt": prompt,
+            "system_prompt": system_prompt,
+            "temp": temp,
+            "n_tokens": n_tokens,
+            "schema": schema,
+            "extra": extra
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = json.load(f)["text"]
+            os.utime(path)  # LRU：最近使用
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, key, text):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"text": text, "created": time.time()}, f, ensure_ascii=False)
+                size = f.tell()
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+        with self._lock:
+            self._puts_since_scan += 1
+            if self._approx_bytes is not None:
+                self._approx_bytes += size
+            scan = (self._approx_bytes is None or self._approx_bytes > self.max_bytes
+                    or self._puts_since_scan >= self.rescan_every)
+        if scan:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".json"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """走訪整個快取；總量超過上限時從最久未使用的開始刪除"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        if total > self.max_bytes:
+            # 刪到上限的 90%，接下來的 put 不會每次都超過上限而重新走訪
+            target = int(self.max_bytes * 0.9)
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                    removed += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self._approx_bytes = total
+            self._puts_since_scan = 0
+        return removed
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        entries = self._entries()
+        return {"hits": hits, "misses": misses, "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries), "max_bytes": self.max_bytes}
@@ -0,0 +1,114 @@
+"""
+架構師前的快速意圖路由。
+
+每個輸入 (即使只是打招呼) 原本都要先經過 3B 的 architect 做一次 prefill + decode，
+再由 architect 規劃出 chatter。這裡用關鍵字規則與工具標籤 (TOOLS_TAGS) 先做便宜的判斷：
+
+- "chat"      : 問候/寒暄且不含任何任務關鍵字 -> 直接交給 chatter
+- "tool"      : 只要讀取一個存在的檔案或目錄 -> 直接執行 project_reader
+                (去掉讀取動詞、路徑與客套/填充詞後不能剩下任何字，「讀取 x.py，裡面有什麼 bug?」要交給 architect)
+- "architect" : 其餘一律照舊交給架構師規劃
+
+規則刻意保守：沒有把握時一律回到 architect，誤判的代價只是多一次 3B 呼叫。
+"""
+
+import os
+import re
+import time
+
+# 問候、道謝、寒暄
+_CHAT_PATTERNS = [
+    ("問候", r"^(hi|hello|hey|yo)\b"),
+    ("問候", r"^(嗨|哈囉|哈嘍|你好|您好|早安|午安|晚安|安安)"),
+    ("道謝", r"(謝謝|感謝|多謝|thanks|thank you|thx)"),
+    ("道別", r"^(再見|掰掰|bye|拜拜|晚點聊)"),
+    ("附和", r"^(好的|好喔|好啊|了解|收到|ok|okay|嗯+|哈+|呵+|lol)[!！。.~～\s]*$"),
+    ("閒聊", r"(你是誰|你叫什麼|你會什麼|你好嗎|最近好嗎|在嗎|在不在)"),
+]
+
+# 出現就代表可能是任務，交給 architect
+_TASK_WORDS = [
+    "讀", "寫", "看", "改", "修", "分析", "搜尋", "找", "查", "產生", "生成", "建立", "新增", "刪",
+    "執行", "編譯", "測試", "檔案", "目錄", "程式", "代碼", "函式", "錯誤", "bug",
+    "read", "write", "open", "analy", "search", "find", "fix", "modify", "create", "run",
+    "file", "code", "function", "class", "def ",
+]
+
+# 「讀取單一路徑」的動詞，以及讀取請求中可以出現的填充詞；除此之外還有別的字 (問題、其他動作) 就不是單純讀取
+_READ_WORDS = ["讀取", "讀", "打開", "開啟", "看一下", "列出", "顯示", "read", "open", "show", "list", "cat"]
+_FILLER_WORDS = ["請幫我", "幫我", "麻煩", "請", "一下", "給我", "我想", "我要", "把", "這個", "那個", "整個",
+                 "全部", "的", "內容", "檔案", "文件", "目錄", "資料夾", "吧"]
+_FILLER_EN = {"please", "me", "the", "a", "file", "folder", "directory", "dir", "contents", "content", "of"}
+_FILLER_PUNCT = re.compile(r"[\s,，。.!！~～:：、]+")
+
+# 路徑只認 ASCII 字元，避免把相連的中文字一起吃進去 (例如「讀取chatcall.py」)
+_PATH_RE = re.compile(r"[A-Za-z0-9_.~/\-]*[A-Za-z0-9_\-]\.[A-Za-z0-9]{1,8}(?![A-Za-z0-9])|[A-Za-z0-9_.~\-]*/[A-Za-z0-9_./\-]*")
+
+
+class IntentRouter:
+    def __init__(self, tool_tags=None, chat_max_chars=40, reader_tool="project_reader", chat_tool="chatter"):
+        """
+        :param tool_tags: 工具名稱 -> 標籤 (TOOLS_TAGS)，標籤也視為任務關鍵字
+        :param chat_max_chars: 超過此長度的輸入不走對話捷徑
+        """
+        self.chat_max_chars = chat_max_chars
+        self.reader_tool = reader_tool
+        self.chat_tool = chat_tool
+        self.tools = set(tool_tags or {})
+        words = set(_TASK_WORDS)
+        for name, tags in (tool_tags or {}).items():
+            if name == chat_tool:
+                continue
+            words.update(t.lower() for t in tags if len(t) > 1)
+        self.task_words = sorted(words)
+        self.counts = {"chat": 0, "tool": 0, "architect": 0}
+
+    def _decide(self, text):
+        lowered = text.lower().strip()
+        if not lowered:
+            return "architect", None, {}, "空輸入"
+
+        paths = [p for p in _PATH_RE.findall(text) if os.path.exists(os.path.expanduser(p))]
+        has_task_word = any(w in lowered for w in self.task_words)
+
+        if len(lowered) <= self.chat_max_chars and not paths and not has_task_word and "`" not in text:
+            for label, pattern in _CHAT_PATTERNS:
+                if re.search(pattern, lowered):
+                    return "chat", self.chat_tool, {"text": text}, f"寒暄規則: {label}"
+
+        if (len(paths) == 1 and self.reader_tool in self.tools
+                and any(w in lowered for w in _READ_WORDS) and not self._leftover(lowered, paths[0])):
+            return "tool", self.reader_tool, {"path": os.path.expanduser(paths[0])}, "讀取單一路徑"
+
+        return "architect", None, {}, "需要規劃"
+
+    def _leftover(self, lowered, path):
+        """去掉路徑、讀取動詞與填充詞後剩下的文字 (空字串才是單純讀取)"""
+        rest = lowered.replace(path.lower(), " ")
+        for word in sorted(_READ_WORDS + _FILLER_WORDS, key=len, reverse=True):
+            if word.isascii():
+                rest = re.sub(rf"(?<![a-z]){re.escape(word)}(?![a-z])", " ", rest)
+            else:
+                rest = rest.replace(word, " ")
+        words = [w for w in _FILLER_PUNCT.split(rest) if w and w not in _FILLER_EN]
+        return " ".join(words)
+
+    def route(self, text, is_continuation=False):
+        """
+        回傳 {"route", "tool", "params", "reason", "ms"}；接力中的輸入一律交給 architect
+        """
+        t0 = time.perf_counter()
+        if is_continuation:
+            route, tool, params, reason = "architect", None, {}, "接力中"
+        else:
+            route, tool, params, reason = self._decide(text)
+        if tool is not None and tool not in self.tools:
+            route, tool, params, reason = "architect", None, {}, f"工具 {tool} 未註冊"
+        self.counts[route] += 1
+        return {"route": route, "tool": tool, "params": params, "reason": reason,
+                "ms": (time.perf_counter() - t0) * 1000}
+
+    def peek(self, text):
+        """只回傳路由結果、不計入統計 (批次模式預先分組用)"""
+        route, tool, _, _ = self._decide(text)
+        return "architect" if tool is not None and tool not in self.tools else route
@@ -0,0 +1,175 @@
+"""
+daemon 內的多使用者推論排程。
+
+每個子聊天室 (user_profiles/$USER/<chatid>) 都是獨立的 chatcall.py 行程，共用同一個 daemon。
+原本 daemon 每個連線一個執行緒、直接搶模型鎖：誰先搶到誰先跑，一個使用者的批次請求可以
+一直佔著模型，另一個使用者的互動請求只能等；不同模型同時載入時也可能超出記憶體。
+
+FairScheduler 在執行推論前發放「執行權」：
+
+- 每個 session (使用者/聊天室) 一條 FIFO 佇列，只有佇列最前面的請求參與排程
+- 優先序：interactive 永遠先於 batch (chatcall --batch 送出的請求)
+- 同一優先序內，累計使用秒數最少的使用者先跑 (新加入的使用者從目前最少者起算，不能預存額度)；
+  同一使用者的多個聊天室輪流
+- 記憶體准入：模型已載入、或卸載閒置模型後放得下 (ModelManager 預算) 且系統可用記憶體
+  足夠時才開始；高優先序的請求因記憶體被擋住時，低優先序的請求不能搶先載入新模型
+- 同一模型一次只執行一個請求 (llama_cpp 非 thread-safe)，slots > 1 時不同模型可同時執行
+
+    with scheduler.slot("alice/1700000000", "interactive", model_path):
+        backend.complete_path(...)
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+
+def mem_available_bytes():
+    """/proc/meminfo 的 MemAvailable；無法讀取時回傳 None"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class _Ticket:
+    __slots__ = ("user", "session", "rank", "model", "enqueued", "started", "granted")
+
+    def __init__(self, user, session, rank, model):
+        self.user = user
+        self.session = session
+        self.rank = rank
+        self.model = model
+        self.enqueued = time.time()
+        self.started = None
+        self.granted = False
+
+
+class FairScheduler:
+    def __init__(self, slots=1, admit=None, min_free_mb=0, mem_available=mem_available_bytes):
+        """
+        :param admit: admit(model) -> "loaded" / "fits" / None (放不下)；None 表示不做預算檢查
+        :param min_free_mb: 需要載入新模型時，系統可用記憶體至少要有這麼多 (0 = 不檢查)
+        """
+        self.slots = max(1, int(slots))
+        self.admit = admit
+        self.min_free_bytes = int(min_free_mb * 1024 * 1024)
+        self.mem_available = mem_available
+        self._cond = threading.Condition()
+        self._queues = {}       # session -> deque[_Ticket]
+        self._running = []
+        self._served = {}       # user -> 累計秒數
+        self._last_turn = {}    # session -> 上次取得執行權的時間 (同一使用者的聊天室輪流)
+        self.granted = 0
+        self.waited_seconds = 0.0
+
+    # --- 排程 ---
+
+    def _active_users(self):
+        users = {t.user for t in self._running}
+        for q in self._queues.values():
+            users.update(t.user for t in q)
+        return users
+
+    def _admission(self, model):
+        if any(t.model == model for t in self._running):
+            return "busy"
+        if self.admit is None:
+            return "loaded"
+        state = self.admit(model)
+        if state == "fits" and self.min_free_bytes and self._running:
+            available = self.mem_available()
+            if available is not None and available < self.min_free_bytes:
+                return None
+        return state
+
+    def _pick(self):
+        heads = [q[0] for q in self._queues.values() if q]
+        heads.sort(key=lambda t: (t.rank, self._served.get(t.user, 0.0),
+                                  self._last_turn.get(t.session, 0.0), t.enqueued))
+        blocked_rank = None
+        for ticket in heads:
+            state = self._admission(ticket.model)
+            if state == "loaded" or (state == "fits" and blocked_rank is None):
+                return ticket
+            if state is None and blocked_rank is None:
+                # 記憶體不足：之後 (較低優先序或已用較多) 的請求只能使用已載入的模型
+                blocked_rank = ticket.rank
+        return None
+
+    def _dispatch(self):
+        while len(self._running) < self.slots:
+            ticket = self._pick()
+            if ticket is None:
+                break
+            self._queues[ticket.session].popleft()
+            if not self._queues[ticket.session]:
+                del self._queues[ticket.session]
+            ticket.granted = True
+            ticket.started = time.time()
+            self._last_turn[ticket.session] = ticket.started
+            self._running.append(ticket)
+            self.granted += 1
+            self.waited_seconds += ticket.started - ticket.enqueued
+        self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, session, priority, model):
+        """等到輪到這個請求 (依 session/優先序/記憶體) 才進入區塊，離開時計入使用秒數"""
+        session = session or "anonymous"
+        user = session.split("/", 1)[0]
+        ticket = _Ticket(user, session, PRIORITIES.get(priority, 0), os.path.realpath(model) if model else None)
+        with self._cond:
+            if user not in self._active_users():
+                # 閒置後回來的使用者從目前最少的累計量起算，不能用閒置期間「存下」的額度插隊
+                floor = min((self._served.get(u, 0.0) for u in self._active_users()), default=0.0)
+                self._served[user] = max(self._served.get(user, 0.0), floor)
+            self._queues.setdefault(session, deque()).append(ticket)
+            self._dispatch()
+            try:
+                while not ticket.granted:
+                    # 有人釋放時會 notify；逾時重新檢查，涵蓋系統可用記憶體的變化
+                    self._cond.wait(timeout=1.0)
+                    if not ticket.granted:
+                        self._dispatch()
+            except BaseException:
+                # 等待中被中斷：撤回請求 (或交還剛取得的執行權)
+                if ticket.granted:
+                    self._running.remove(ticket)
+                else:
+                    queue = self._queues.get(session)
+                    if queue is not None and ticket in queue:
+                        queue.remove(ticket)
+                        if not queue:
+                            del self._queues[session]
+                self._dispatch()
+                raise
+        try:
+            yield ticket
+        finally:
+            with self._cond:
+                self._running.remove(ticket)
+                self._served[user] = self._served.get(user, 0.0) + (time.time() - ticket.started)
+                self._dispatch()
+
+    def stats(self):
+        with self._cond:
+            now = time.time()
+            return {
+                "slots": self.slots,
+                "running": [{"session": t.session, "model": os.path.basename(t.model or ""),
+                             "priority": "batch" if t.rank else "interactive",
+                             "seconds": round(now - t.started, 3)} for t in self._running],
+                "queued": {s: len(q) for s, q in self._queues.items()},
+                "served_seconds": {u: round(v, 3) for u, v in self._served.items()},
+                "granted": self.granted,
+                "avg_wait_seconds": round(self.waited_seconds / self.granted, 3) if self.granted else 0.0
+            }
@@ -0,0 +1,172 @@
+"""
+llama_cpp 後端的推測解碼 (speculative decoding)。
+
+CPU 上生成 token 是逐一前向計算，瓶頸在讀權重的記憶體頻寬；一次驗證 k 個猜測的 token
+與生成一個 token 的成本差不多，猜中越多省越多，輸出分佈不變 (每個位置仍由主模型取樣，
+與猜測不同就捨棄其後的猜測)。
+
+猜測來源 (ai_config.MODEL_SETTINGS[模型]["speculative"])：
+- {"type": "prompt_lookup", "num_pred_tokens": 10, "max_ngram_size": 3}
+  在 prompt 中找與結尾相同的 n-gram，把它後面的 token 當猜測；修改程式碼時輸出大多照抄原檔，
+  幾乎不花成本 (找不到就不猜)
+- {"type": "model", "draft": "chatter", "num_pred_tokens": 4}
+  以同一 tokenizer 的小模型 (0.5B) 貪婪生成 k 個 token 當猜測，給 architect 這類大模型用
+
+llama_cpp.Llama 內建的 draft_model 參數會強制 logits_all，配置 n_ctx x n_vocab 的 logits 陣列
+(8k context x 15 萬詞彙就是數 GB)，prefill 時也替每個 prompt token 算 logits。
+SpeculativeLlama 改成只替最後 num_pred_tokens + 1 個位置要 logits，也不複製到 scores，
+記憶體與一般載入相同。
+
+每次呼叫的猜測數與命中數以 take_stats() 取出，後端以 record_usage(draft_tokens=..., draft_accepted=...) 回報。
+"""
+
+import numpy as np
+
+import llama_cpp
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class MeasuredDraft(LlamaDraftModel):
+    """
+    包裝猜測來源並統計命中率。
+
+    Llama.generate 每次驗證完一批猜測後才再次呼叫 draft，此時傳入的 input_ids 結尾是
+    被接受的猜測 + 主模型新取樣的 token；與上一次的猜測比對共同前綴即為命中數。
+    一次生成最後一批猜測 (遇到停止條件) 不會被驗證，不計入。
+    """
+
+    def __init__(self, inner, num_pred_tokens):
+        self.inner = inner
+        self.num_pred_tokens = num_pred_tokens
+        self.drafted = 0
+        self.accepted = 0
+        self._pending = None  # (猜測時的 input 長度, 猜測的 token)
+
+    def __call__(self, input_ids, /, **kwargs):
+        n = len(input_ids)
+        if self._pending is not None:
+            base, draft = self._pending
+            if n > base:
+                actual = input_ids[base:base + len(draft)]
+                hits = 0
+                for a, b in zip(draft, actual):
+                    if a != b:
+                        break
+                    hits += 1
+                self.drafted += len(draft)
+                self.accepted += hits
+            self._pending = None
+        draft = np.asarray(self.inner(input_ids, **kwargs), dtype=np.intc)[:self.num_pred_tokens]
+        if len(draft):
+            self._pending = (n, draft.copy())
+        return draft
+
+    def take_stats(self):
+        """取走並歸零 (猜測的 token 數, 被接受的 token 數)"""
+        stats = (self.drafted, self.accepted)
+        self.drafted = self.accepted = 0
+        self._pending = None
+        return stats
+
+    def close(self):
+        if hasattr(self.inner, "close"):
+            self.inner.close()
+
+
+class ModelDraft(LlamaDraftModel):
+    """
+    以小模型貪婪生成猜測。保留自己的 KV cache，下次只 prefill 與上次不同的部分
+    (被拒絕的猜測自動丟掉)；第一次呼叫要 prefill 整個 prompt，0.5B 的成本約是主模型的一小部分。
+    """
+
+    def __init__(self, llama, num_pred_tokens=4):
+        self.llama = llama
+        self.num_pred_tokens = num_pred_tokens
+        self._eos = llama.token_eos()
+
+    def _logits(self):
+        ptr = llama_cpp.llama_get_logits_ith(self.llama._ctx.ctx, -1)
+        return np.ctypeslib.as_array(ptr, shape=(self.llama.n_vocab(),))
+
+    def __call__(self, input_ids, /, **kwargs):
+        llama = self.llama
+        n = len(input_ids)
+        limit = llama.n_ctx() - self.num_pred_tokens
+        if n >= limit:
+            return np.array([], dtype=np.intc)
+        # 與上次已 eval 的 token 的共同前綴；至少重新 eval 最後一個 token 以取得 logits
+        cached = llama.input_ids[:llama.n_tokens]
+        common = 0
+        for a, b in zip(cached, input_ids[:-1]):
+            if a != b:
+                break
+            common += 1
+        llama.n_tokens = common
+        llama.eval(input_ids[common:].tolist())
+        draft = []
+        for i in range(self.num_pred_tokens):
+            token = int(self._logits().argmax())
+            if token == self._eos:
+                break
+            draft.append(token)
+            if i + 1 < self.num_pred_tokens:
+                llama.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+    def close(self):
+        self.llama.close()
+
+
+class SpeculativeLlama(llama_cpp.Llama):
+    """只替猜測驗證需要的最後幾個位置計算 logits 的 Llama；猜測來源在 draft_model 屬性"""
+
+    def __init__(self, *args, draft=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 建構時不傳給 Llama，避免它開啟 logits_all；generate 只檢查此屬性是否為 None
+        self.draft_model = draft
+        self._logit_window = (draft.num_pred_tokens if draft is not None else 0) + 1
+
+    def eval(self, tokens):
+        if self.draft_model is None:
+            return super().eval(tokens)
+        self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+        first_output = len(tokens) - self._logit_window
+        for i in range(0, len(tokens), self.n_batch):
+            batch = tokens[i:min(len(tokens), i + self.n_batch)]
+            n_past = self.n_tokens
+            self._batch.set_batch(batch=batch, n_past=n_past, logits_all=False)
+            for j in range(len(batch)):
+                if i + j >= first_output:
+                    self._batch.batch.logits[j] = True
+            self._ctx.decode(self._batch)
+            self.input_ids[n_past:n_past + len(batch)] = batch
+            self.n_tokens += len(batch)
+            self._requires_eval = False
+
+    def take_draft_stats(self):
+        if self.draft_model is None:
+            return 0, 0
+        return self.draft_model.take_stats()
+
+    def close(self):
+        if self.draft_model is not None:
+            self.draft_model.close()
+            self.draft_model = None
+        super().close()
+
+
+def make_draft(spec, load_model=None):
+    """依設定建立 MeasuredDraft；load_model(model_key) 回傳 type=model 用的小模型 Llama"""
+    if not spec:
+        return None
+    kind = spec.get("type", "prompt_lookup")
+    k = int(spec.get("num_pred_tokens", 10 if kind == "prompt_lookup" else 4))
+    if kind == "prompt_lookup":
+        inner = LlamaPromptLookupDecoding(max_ngram_size=int(spec.get("max_ngram_size", 3)), num_pred_tokens=k)
+    elif kind == "model":
+        if load_model is None:
+            raise ValueError("draft model loader required")
+        inner = ModelDraft(load_model(spec.get("draft", "chatter")), num_pred_tokens=k)
+    else:
+        raise ValueError(f"Unknown speculative type: {kind}")
+    return MeasuredDraft(inner, k)
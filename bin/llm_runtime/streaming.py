@@ -0,0 +1,145 @@
+"""
+串流輸出輔助。
+
+小模型常在 JSON 的最後一個大括號之後繼續胡言亂語，JsonCloseDetector 追蹤串流文字的
+括號深度 (忽略字串內的括號與跳脫字元)，第一個頂層物件一閉合就能停止生成。
+PlanTaskParser 以同樣的方式追蹤架構師的規劃，tasks 中的每個任務一完整就交出去，可以邊生成邊執行。
+"""
+
+import json
+from typing import Iterable, Iterator, Optional
+
+
+class EchoedText(str):
+    """已經即時輸出到終端的模型回覆，呼叫端不必再印一次"""
+    echoed = True
+
+
+class JsonCloseDetector:
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.closed = False
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> Optional[int]:
+        """餵入一段文字；若第一個頂層 JSON 物件在這段內閉合，回傳閉合後的位置，否則回傳 None"""
+        if self.closed:
+            return 0
+        for i, ch in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                if self.started:
+                    self._in_string = True
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+                    return i + 1
+        return None
+
+
+def stream_until_json_closed(chunks: Iterable[str]) -> Iterator[str]:
+    """轉送串流片段，第一個完整 JSON 物件閉合後截斷並關閉來源 (停止生成)"""
+    detector = JsonCloseDetector()
+    try:
+        for chunk in chunks:
+            end = detector.feed(chunk)
+            if end is not None:
+                if chunk[:end]:
+                    yield chunk[:end]
+                return
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class PlanTaskParser:
+    """
+    架構師規劃的增量解析：餵入串流文字，頂層物件的 "tasks" (或 "actions") 陣列中
+    每個任務物件一閉合就呼叫 on_task(索引, 任務)，不必等整份規劃 (含 remaining_plan) 生成完。
+    任務物件本身不是合法 JSON 時以 on_task(索引, None) 通知，之後的索引照常遞增。
+    """
+
+    TASK_KEYS = ("tasks", "actions")
+
+    def __init__(self, on_task):
+        self.on_task = on_task
+        self.count = 0
+        self._buf = []
+        self._pos = 0
+        self._stack = []          # 目前所在的容器 ('{' 或 '[')
+        self._expect_key = False  # 物件中下一個字串是鍵
+        self._key = None          # 頂層物件最近的鍵
+        self._key_start = None
+        self._in_string = False
+        self._escape = False
+        self._tasks_depth = None  # tasks 陣列所在的深度
+        self._task_start = None
+
+    def feed(self, text):
+        for ch in text:
+            self._buf.append(ch)
+            self._step(ch, self._pos)
+            self._pos += 1
+
+    def _step(self, ch, i):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                if self._key_start is not None:
+                    self._key = "".join(self._buf[self._key_start + 1:i])
+                    self._key_start = None
+            return
+        if ch == '"':
+            if not self._stack:
+                return
+            self._in_string = True
+            if self._stack[-1] == "{" and self._expect_key:
+                self._expect_key = False
+                if len(self._stack) == 1:
+                    self._key_start = i
+        elif ch == "{":
+            self._stack.append("{")
+            self._expect_key = True
+            if self._tasks_depth is not None and len(self._stack) == self._tasks_depth + 1:
+                self._task_start = i
+        elif ch == "[":
+            self._stack.append("[")
+            if len(self._stack) == 2 and self._key in self.TASK_KEYS and self._tasks_depth is None:
+                self._tasks_depth = 2
+        elif ch in "}]":
+            if not self._stack:
+                return
+            self._stack.pop()
+            if ch == "}" and self._task_start is not None and len(self._stack) == self._tasks_depth:
+                self._emit("".join(self._buf[self._task_start:i + 1]))
+                self._task_start = None
+            elif ch == "]" and self._tasks_depth is not None and len(self._stack) == self._tasks_depth - 1:
+                self._tasks_depth = -1  # 只解析第一個 tasks 陣列
+        elif ch == "," and self._stack and self._stack[-1] == "{":
+            self._expect_key = True
+
+    def _emit(self, text):
+        index = self.count
+        self.count += 1
+        try:
+            task = json.loads(text)
+        except ValueError:
+            task = None
+        self.on_task(index, task if isinstance(task, dict) else None)
@@ -0,0 +1,141 @@
+"""
+規劃任務的 DAG 執行。
+
+架構師的 tasks 原本一律依序執行；但像兩個 project_reader、或 project_reader 與
+code_searcher 查不同檔案這類互不相干的唯讀步驟，其實可以重疊進行。
+
+相依關係：
+- 任務可用 "id" 命名，並以 "depends_on": [id, ...] 額外宣告前置任務。
+- 預設順序 (宣告與否都適用)：無副作用的工具 (register_ai_tool(..., side_effect_free=True)) 只依賴它之前最近的
+  一個有副作用任務；有副作用的工具依賴它之前的所有任務 (等同原本的依序執行)。
+- 有副作用的任務之間永遠保持計畫順序。
+
+就緒的任務交給有上限的執行緒池，結果依計畫順序產出。
+PlanPrefetcher 則在架構師還在生成時，先執行規劃開頭只讀檔的任務。
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+
+
+def task_dependencies(tasks: List[Dict[str, Any]], is_side_effect_free: Callable[[Dict[str, Any]], bool]) -> List[Set[int]]:
+    """回傳每個任務的前置任務索引集合"""
+    ids = {}
+    for i, task in enumerate(tasks):
+        if task.get("id") not in (None, ""):
+            ids[str(task["id"])] = i
+
+    deps = []
+    last_effect = None
+    for i, task in enumerate(tasks):
+        pure = is_side_effect_free(task)
+        explicit = task.get("depends_on")
+        if isinstance(explicit, (str, int)):
+            explicit = [explicit]
+        # 預設順序是下限：明確宣告的前置任務只能再加上去，不能取代
+        if pure:
+            need = {last_effect} if last_effect is not None else set()
+        else:
+            need = set(range(i))
+        if isinstance(explicit, list):
+            need |= {ids[str(d)] for d in explicit if str(d) in ids and ids[str(d)] < i}
+        deps.append(need)
+        if not pure:
+            last_effect = i
+    return deps
+
+
+def run_task_graph(tasks: List[Dict[str, Any]], run_task: Callable[[int, Dict[str, Any]], Any],
+                   is_side_effect_free: Callable[[Dict[str, Any]], bool], max_workers: int = 4) -> Iterator[Tuple[int, Any]]:
+    """
+    依相依關係並行執行任務，依計畫順序逐一產出 (索引, 結果)。
+    某個任務拋出例外時，在輪到它產出時重新拋出。
+    """
+    deps = task_dependencies(tasks, is_side_effect_free)
+    if max_workers <= 1:
+        for i, task in enumerate(tasks):
+            yield i, run_task(i, task)
+        return
+
+    done = set()
+    running = {}
+    finished = {}
+    next_emit = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while next_emit < len(tasks):
+            for i, task in enumerate(tasks):
+                if i not in done and i not in running.values() and deps[i] <= done:
+                    running[pool.submit(run_task, i, task)] = i
+            completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in completed:
+                i = running.pop(fut)
+                finished[i] = fut
+                done.add(i)
+            while next_emit in finished:
+                yield next_emit, finished.pop(next_emit).result()
+                next_emit += 1
+
+
+class PlanPrefetcher:
+    """
+    架構師還在生成規劃時，先執行開頭的可提前任務 (只讀檔、不呼叫模型的工具)。
+
+    任務依規劃順序交給單一背景執行緒；遇到第一個不可提前的任務 (或有 depends_on、解析失敗) 就不再提前，
+    之後的任務可能依賴它。規劃完成後以 reconcile() 對照最終的步驟：只有與最終規劃開頭一致的連續前綴
+    沿用提前執行的結果，從第一個不一致處起的結果全部捨棄，並把 context 還原到它執行前的狀態。
+    """
+
+    def __init__(self, run_task, can_prefetch, snapshot=None, restore=None):
+        """
+        :param run_task: (step) -> 結果；step 為 {"step", "tool", "params"}
+        :param can_prefetch: (step) -> 是否可提前執行
+        :param snapshot: () -> 可還原的狀態 (在每個任務執行前取得)；restore(狀態) 還原
+        """
+        self.run_task = run_task
+        self.can_prefetch = can_prefetch
+        self.snapshot = snapshot
+        self.restore = restore
+        self.entries = []
+        self.stopped = False
+        self._pool = None
+
+    def submit(self, index, step):
+        if self.stopped:
+            return
+        if step is None or index != len(self.entries) or step.get("depends_on") or not self.can_prefetch(step):
+            self.stopped = True
+            return
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        entry = {"index": index, "step": step, "state": None}
+
+        def job():
+            if self.snapshot is not None:
+                entry["state"] = self.snapshot()
+            return self.run_task(step)
+
+        entry["future"] = self._pool.submit(job)
+        self.entries.append(entry)
+
+    def reconcile(self, steps):
+        """回傳 {步驟索引: future}，只含與最終步驟一致的連續前綴；其餘等它們結束後捨棄"""
+        self.stopped = True
+        final = {s["step"] - 1: s for s in steps}
+        used = {}
+        for k, entry in enumerate(self.entries):
+            step = final.get(entry["index"])
+            if step is not None and step["tool"] == entry["step"]["tool"] and step["params"] == entry["step"]["params"]:
+                used[entry["index"]] = entry["future"]
+                continue
+            discarded = self.entries[k:]
+            wait([e["future"] for e in discarded])
+            if self.restore is not None and entry["state"] is not None:
+                self.restore(entry["state"])
+            break
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        return used
+
+    def discard(self):
+        """規劃作廢 (例如轉為對話模式)：捨棄全部提前執行的結果"""
+        return self.reconcile([])
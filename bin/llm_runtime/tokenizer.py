@@ -0,0 +1,37 @@
+"""
+以模型自己的 tokenizer 計算 token 數。
+
+只載入 GGUF 的詞表 (llama_cpp vocab_only，不讀權重、以 mmap 開檔)，每個模型檔在行程內載入一次；
+沒有安裝 llama_cpp 或模型檔不存在時回傳 None，由呼叫端改用 estimate_tokens 估算。
+daemon / llama-server 後端改由已載入模型的一方計算 (見 LLMBackend.count_tokens)。
+"""
+
+import os
+import threading
+
+_lock = threading.Lock()
+_vocabs = {}
+
+
+def _load_vocab(model_path):
+    with _lock:
+        if model_path not in _vocabs:
+            try:
+                import llama_cpp
+                _vocabs[model_path] = llama_cpp.Llama(model_path=model_path, vocab_only=True, verbose=False)
+            except Exception:
+                _vocabs[model_path] = None  # 載入失敗也記下來，不必每次重試
+        return _vocabs[model_path]
+
+
+def count_tokens(model_path, text):
+    """text 以 model_path 的詞表切分後的 token 數 (不含 BOS)；無法計算時回傳 None"""
+    if not text:
+        return 0
+    if not model_path or not os.path.exists(model_path):
+        return None
+    model_path = os.path.realpath(model_path)
+    vocab = _load_vocab(model_path)
+    if vocab is None:
+        return None
+    return len(vocab.tokenize(text.encode("utf-8"), add_bos=False, special=False))
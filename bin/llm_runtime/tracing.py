@@ -0,0 +1,249 @@
+"""
+每一輪 relay 的分段追蹤與指標輸出。
+
+    with tracer.turn(user_input):
+        with tracer.span("architect") as span:
+            ...
+            span["prompt_tokens"] = 123
+
+每個 span 記錄名稱、開始時間、耗時與屬性 (模型呼叫另有 prompt/生成 token 數、tokens/sec、模型載入時間、
+推測解碼的猜測/命中 token 數)，
+一輪結束時：
+- 逐行附加到 TRACE_DIR/trace-YYYYMMDD.jsonl (每行一個 span，最後一行是整輪摘要)
+- 累加到 TRACE_DIR/metrics.json，並重寫 Prometheus 文字格式的 TRACE_DIR/metrics.prom
+  (多個行程 (子聊天室) 共用時以 flock 保護)
+
+後端以 record_usage() 回報 token 用量 (同一執行緒內由 take_usage() 取走)，
+沒有回報的後端由呼叫端以字元數估算。
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台，不做跨行程鎖
+    fcntl = None
+
+_usage = threading.local()
+
+
+def record_usage(**fields):
+    """後端回報本執行緒最近一次推論的用量 (prompt_tokens、completion_tokens、load_seconds ...)"""
+    current = getattr(_usage, "fields", None)
+    if current is None:
+        current = _usage.fields = {}
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if key == "load_seconds":
+            current[key] = current.get(key, 0.0) + value
+        else:
+            current[key] = value
+
+
+def take_usage():
+    """取走並清除本執行緒累積的用量"""
+    fields = getattr(_usage, "fields", None) or {}
+    _usage.fields = None
+    return fields
+
+
+def estimate_tokens(text):
+    # Qwen 的 tokenizer 大約每 3 個字元一個 token (中英混合)，只在後端沒有回報時使用
+    return max(1, len(text or "") // 3)
+
+
+class Tracer:
+    def __init__(self, trace_dir, enabled=True):
+        self.trace_dir = trace_dir
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans = []
+        self._turn_id = None
+        self._turn_start = 0.0
+        self._local = threading.local()
+        # 最近一輪的摘要 (各階段次數與耗時)，批次模式附在每筆結果上
+        self.last_turn = None
+
+    @contextmanager
+    def turn(self, user_input=""):
+        """一輪 relay；巢狀呼叫時沿用外層的 turn"""
+        if not self.enabled or self._turn_id is not None:
+            yield self._turn_id
+            return
+        self._turn_id = uuid.uuid4().hex[:12]
+        self._turn_start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield self._turn_id
+        finally:
+            total = time.perf_counter() - t0
+            with self._lock:
+                spans, self._spans = self._spans, []
+            turn_id, self._turn_id = self._turn_id, None
+            try:
+                self._flush(turn_id, user_input, total, spans)
+            except OSError:
+                pass  # 追蹤失敗不影響主流程
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """量測一段工作；yield 出的 dict 可在區塊內補上屬性"""
+        record = dict(attrs)
+        if not self.enabled or self._turn_id is None:
+            yield record
+            return
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        span_id = uuid.uuid4().hex[:8]
+        stack.append(span_id)
+        start = time.time()
+        t0 = time.perf_counter()
+        error = None
+        try:
+            yield record
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            stack.pop()
+            entry = {"turn": self._turn_id, "span": span_id, "parent": parent, "name": name,
+                     "start": round(start, 6), "duration_ms": round((time.perf_counter() - t0) * 1000, 3),
+                     "thread": threading.current_thread().name}
+            if error is not None:
+                entry["error"] = error
+            entry["attrs"] = record
+            with self._lock:
+                self._spans.append(entry)
+
+    # --- 輸出 ---
+
+    def _flush(self, turn_id, user_input, total, spans):
+        os.makedirs(self.trace_dir, exist_ok=True)
+        stages = {}
+        for s in spans:
+            stage = stages.setdefault(s["name"], {"count": 0, "ms": 0.0})
+            stage["count"] += 1
+            stage["ms"] = round(stage["ms"] + s["duration_ms"], 3)
+        summary = {"turn": turn_id, "name": "turn", "start": round(self._turn_start, 6),
+                   "duration_ms": round(total * 1000, 3), "input": user_input[:200], "stages": stages}
+        self.last_turn = summary
+
+        path = os.path.join(self.trace_dir, time.strftime("trace-%Y%m%d.jsonl", time.localtime(self._turn_start)))
+        with open(path, "a", encoding="utf-8") as f:
+            for s in spans:
+                f.write(json.dumps(s, ensure_ascii=False, default=str) + "\n")
+            f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+        self._update_metrics(total, spans)
+
+    def _update_metrics(self, total, spans):
+        metrics_path = os.path.join(self.trace_dir, "metrics.json")
+        with open(os.path.join(self.trace_dir, ".metrics.lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(metrics_path, "r", encoding="utf-8") as f:
+                    metrics = json.load(f)
+            except (OSError, ValueError):
+                metrics = {}
+            turns = metrics.setdefault("turns", {"count": 0, "seconds": 0.0})
+            turns["count"] += 1
+            turns["seconds"] += total
+            stages = metrics.setdefault("stages", {})
+            models = metrics.setdefault("models", {})
+            for s in spans:
+                stage = stages.setdefault(s["name"], {"count": 0, "seconds": 0.0, "errors": 0})
+                stage["count"] += 1
+                stage["seconds"] += s["duration_ms"] / 1000
+                stage["errors"] += 1 if "error" in s else 0
+                attrs = s["attrs"]
+                if s["name"] == "llm" and attrs.get("model"):
+                    m = models.setdefault(attrs["model"], {"calls": 0, "cached": 0, "prompt_tokens": 0,
+                                                           "completion_tokens": 0, "seconds": 0.0,
+                                                           "load_seconds": 0.0, "tokens_per_second": 0.0})
+                    m["calls"] += 1
+                    m["cached"] += 1 if attrs.get("cached") else 0
+                    m["prompt_tokens"] += attrs.get("prompt_tokens", 0)
+                    m["completion_tokens"] += attrs.get("completion_tokens", 0)
+                    m["seconds"] += s["duration_ms"] / 1000
+                    m["load_seconds"] += attrs.get("load_seconds", 0.0)
+                    if attrs.get("tokens_per_second"):
+                        m["tokens_per_second"] = attrs["tokens_per_second"]
+                    if attrs.get("draft_tokens"):
+                        m["draft_tokens"] = m.get("draft_tokens", 0) + attrs["draft_tokens"]
+                        m["draft_accepted"] = m.get("draft_accepted", 0) + attrs.get("draft_accepted", 0)
+            metrics["updated"] = time.time()
+            tmp = metrics_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(metrics, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, metrics_path)
+            prom = os.path.join(self.trace_dir, "metrics.prom")
+            with open(prom + ".tmp", "w", encoding="utf-8") as f:
+                f.write(render_prometheus(metrics))
+            os.replace(prom + ".tmp", prom)
+
+    def snapshot(self):
+        """目前累積的 Prometheus 文字格式指標"""
+        try:
+            with open(os.path.join(self.trace_dir, "metrics.json"), "r", encoding="utf-8") as f:
+                return render_prometheus(json.load(f))
+        except (OSError, ValueError):
+            return render_prometheus({})
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(metrics):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{_label(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    turns = metrics.get("turns", {"count": 0, "seconds": 0.0})
+    metric("pi_ai_turns_total", "counter", "完成的 relay 輪數", [({}, turns["count"])])
+    metric("pi_ai_turn_seconds_total", "counter", "relay 總耗時", [({}, round(turns["seconds"], 6))])
+
+    stages = metrics.get("stages", {})
+    metric("pi_ai_stage_calls_total", "counter", "各階段執行次數",
+           [({"stage": k}, v["count"]) for k, v in sorted(stages.items())])
+    metric("pi_ai_stage_seconds_total", "counter", "各階段累計耗時",
+           [({"stage": k}, round(v["seconds"], 6)) for k, v in sorted(stages.items())])
+    metric("pi_ai_stage_errors_total", "counter", "各階段拋出例外次數",
+           [({"stage": k}, v.get("errors", 0)) for k, v in sorted(stages.items())])
+
+    models = metrics.get("models", {})
+    metric("pi_ai_llm_calls_total", "counter", "模型呼叫次數",
+           [({"model": k}, v["calls"]) for k, v in sorted(models.items())])
+    metric("pi_ai_llm_cached_total", "counter", "回應快取命中次數",
+           [({"model": k}, v["cached"]) for k, v in sorted(models.items())])
+    metric("pi_ai_llm_prompt_tokens_total", "counter", "prompt token 數",
+           [({"model": k}, v["prompt_tokens"]) for k, v in sorted(models.items())])
+    metric("pi_ai_llm_completion_tokens_total", "counter", "生成 token 數",
+           [({"model": k}, v["completion_tokens"]) for k, v in sorted(models.items())])
+    metric("pi_ai_llm_seconds_total", "counter", "模型呼叫累計耗時",
+           [({"model": k}, round(v["seconds"], 6)) for k, v in sorted(models.items())])
+    metric("pi_ai_model_load_seconds_total", "counter", "模型載入累計耗時",
+           [({"model": k}, round(v["load_seconds"], 6)) for k, v in sorted(models.items())])
+    metric("pi_ai_llm_tokens_per_second", "gauge", "最近一次呼叫的生成速度",
+           [({"model": k}, round(v["tokens_per_second"], 3)) for k, v in sorted(models.items())])
+    drafted = sorted((k, v) for k, v in models.items() if v.get("draft_tokens"))
+    metric("pi_ai_llm_draft_tokens_total", "counter", "推測解碼猜測的 token 數",
+           [({"model": k}, v["draft_tokens"]) for k, v in drafted])
+    metric("pi_ai_llm_draft_accepted_total", "counter", "推測解碼被接受的 token 數",
+           [({"model": k}, v.get("draft_accepted", 0)) for k, v in drafted])
+    metric("pi_ai_llm_draft_acceptance_ratio", "gauge", "推測解碼累計命中率",
+           [({"model": k}, round(v.get("draft_accepted", 0) / v["draft_tokens"], 4)) for k, v in drafted])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,228 @@
+"""
+耐久的背景寫入佇列 (write-behind)。
+
+回答完成後的互動參與度計算與 RAG 寫入 (rag_calculate_engagement、rag_store_knowledge、
+rag_store_failure_feedback) 不影響這一輪的回答，原本卻同步執行完才印出完成、存對話紀錄。
+WriteBehindQueue 把它們交給背景執行緒：
+
+- submit(job) 先把工作寫成 spool 目錄中的一個 JSON 檔 (暫存檔 + fsync + rename) 再排入佇列，立即返回
+- 背景執行緒一次取出佇列中所有等待的工作 (最多 batch_size 筆) 交給 handler(jobs)，成功後刪除檔案
+- handler 失敗時檔案保留並記錄次數，下次啟動重試；超過 max_attempts 次丟棄
+- 行程結束 (atexit) 時不再開始新的工作，只等進行中的一批最多 exit_wait 秒，使用者不必等全部寫完；
+  沒做完的工作留在 spool，下次啟動時 replay() 在背景補做
+
+每個工作有穩定的 job["id"] (spool 檔名)。handler 每完成一個有副作用的步驟就記在 job 裡並呼叫
+checkpoint(job) 寫回 spool；中斷後重做時依記錄略過已完成的步驟，不會重複寫入。
+
+多個行程可能共用同一個 spool 目錄：每個檔案從建立到刪除都由擁有者持有 flock，
+replay() 只接手拿得到鎖的檔案 (擁有者已結束)。
+
+    queue = WriteBehindQueue(".pi_ai_cache/rag_writes", handler)
+    queue.replay()
+    queue.submit({"kind": "turn", ...})
+"""
+
+import atexit
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台：不做跨行程鎖定
+    fcntl = None
+
+
+class _Entry:
+    __slots__ = ("path", "fd", "job", "attempts")
+
+    def __init__(self, path, fd, job, attempts=0):
+        self.path = path
+        self.fd = fd
+        self.job = job
+        self.attempts = attempts
+
+
+class WriteBehindQueue:
+    def __init__(self, spool_dir, handler, batch_size=16, max_attempts=3, exit_wait=2.0, log=sys.stderr):
+        """
+        :param handler: handler(jobs) 在背景執行緒處理一批工作；拋出例外時整批留待下次重試
+        :param exit_wait: 行程結束時等待進行中那一批的秒數
+        """
+        self.spool_dir = spool_dir
+        self.handler = handler
+        self.batch_size = max(1, int(batch_size))
+        self.max_attempts = max_attempts
+        self.exit_wait = exit_wait
+        self.log = log
+        self.done = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._inflight = {}     # id(job) -> _Entry (checkpoint 用)
+        self._busy = 0          # 進行中那一批的筆數
+        self._closed = False
+        self._thread = None
+        self._seq = 0
+        os.makedirs(spool_dir, exist_ok=True)
+        atexit.register(self.close)
+
+    # --- spool 檔 ---
+
+    def _write(self, fd, record):
+        data = json.dumps(record, ensure_ascii=False, default=str).encode("utf-8")
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        while data:
+            data = data[os.write(fd, data):]
+        os.fsync(fd)
+
+    def _release(self, entry, remove):
+        if remove:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+        os.close(entry.fd)  # 關閉即釋放 flock
+
+    def submit(self, job):
+        """寫入 spool 後排入佇列；回傳時工作已可在行程中斷後重做"""
+        with self._cond:
+            self._seq += 1
+            job_id = f"{time.time_ns()}-{os.getpid()}-{self._seq}"
+        job.setdefault("id", job_id)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=self.spool_dir)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._write(fd, {"attempts": 0, "job": job})
+            path = os.path.join(self.spool_dir, f"{job_id}.json")
+            os.replace(tmp, path)
+        except BaseException:
+            os.close(fd)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self._enqueue([_Entry(path, fd, job)])
+
+    def replay(self):
+        """接手 spool 中沒有擁有者的工作 (上次結束前沒做完的)，回傳接手的數量"""
+        entries = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            if name.startswith(".") or not name.endswith(".json"):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError:
+                continue
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.fstat(fd).st_nlink == 0:
+                    raise BlockingIOError  # 拿到鎖前已被擁有者做完刪除
+            except OSError:
+                os.close(fd)  # 擁有者仍在執行
+                continue
+            try:
+                with open(path, "rb") as f:
+                    record = json.loads(f.read().decode("utf-8"))
+                entries.append(_Entry(path, fd, record["job"], int(record.get("attempts", 0))))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"[-] 丟棄無法讀取的背景寫入 {name}: {e}", file=self.log, flush=True)
+                self._release(_Entry(path, fd, None), remove=True)
+        self._enqueue(entries)
+        return len(entries)
+
+    # --- 背景執行 ---
+
+    def _enqueue(self, entries):
+        if not entries:
+            return
+        with self._cond:
+            self._pending.extend(entries)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._worker, name="write-behind", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                self._busy = len(batch)
+                self._inflight = {id(entry.job): entry for entry in batch}
+            try:
+                self.handler([entry.job for entry in batch])
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"[-] 背景寫入失敗 ({len(batch)} 筆): {e}", file=self.log, flush=True)
+            with self._cond:
+                self._inflight = {}
+                for entry in batch:
+                    if ok:
+                        self.done += 1
+                        self._release(entry, remove=True)
+                        continue
+                    entry.attempts += 1
+                    self.failed += 1
+                    drop = entry.attempts >= self.max_attempts
+                    if not drop:
+                        try:
+                            self._write(entry.fd, {"attempts": entry.attempts, "job": entry.job})
+                        except OSError:
+                            pass
+                    # 失敗的工作本次行程不再重試 (通常是 rag_tool 的問題)，留到下次啟動
+                    self._release(entry, remove=drop)
+                self._busy = 0
+                self._cond.notify_all()
+
+    def checkpoint(self, job):
+        """handler 完成一個步驟後把 job 寫回 spool (fsync)；中斷後重做時從這裡繼續"""
+        with self._cond:
+            entry = self._inflight.get(id(job))
+        if entry is not None:
+            self._write(entry.fd, {"attempts": entry.attempts, "job": job})
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending) + self._busy
+
+    def flush(self, timeout=None):
+        """等佇列清空 (批次模式結束前使用)；逾時回傳 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        """停止開始新的工作，等進行中的一批最多 exit_wait 秒；其餘留在 spool 給下次啟動"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            deadline = time.monotonic() + self.exit_wait
+            while self._busy and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            left = len(self._pending) + self._busy
+            for entry in self._pending:
+                os.close(entry.fd)
+            self._pending.clear()
+        if left:
+            print(f"[*] {left} 筆背景寫入尚未完成，下次啟動時補做", file=self.log, flush=True)